@@ -14,20 +14,76 @@
 
 import sys
 import argparse
+import json
 import re
 import yaml
 import copy
+import hashlib
+import os
 from os import path, access, R_OK
 import fnmatch
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
 from collections import defaultdict
 
+# Sizes in bytes of the types that may appear in a MIML struct. Structs are packed,
+# so a struct's size is the sum of its fields; the generated static asserts catch
+# a platform where one of these is wrong. cg.conf can extend this with type_sizes.
+TYPE_SIZES = {'char': 1, 'unsigned char': 1, 'short': 2, 'unsigned short': 2,
+              'int': 4, 'unsigned int': 4, 'float': 4, 'double': 8,
+              'int8_t': 1, 'uint8_t': 1, 'int16_t': 2, 'uint16_t': 2,
+              'int32_t': 4, 'uint32_t': 4, 'int64_t': 8, 'uint64_t': 8}
+
+# NumPy dtype codes of the struct field types, for the log schema. Records are little-endian.
+DTYPES = {'char': 'i1', 'unsigned char': 'u1', 'short': 'i2', 'unsigned short': 'u2',
+          'int': 'i4', 'unsigned int': 'u4', 'float': 'f4', 'double': 'f8',
+          'int8_t': 'i1', 'uint8_t': 'u1', 'int16_t': 'i2', 'uint16_t': 'u2',
+          'int32_t': 'i4', 'uint32_t': 'u4', 'int64_t': 'i8', 'uint64_t': 'u8'}
+
+# Characters of generated fourccs.
+FOURCC_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+# Helper of max_rate_hz edges: true, and the next delivery moved one period on,
+# once the earliest time of the next delivery has come.
+RATE_GATE = """static inline int fcf_rate_gate(uint64_t *next, uint64_t period_ns) {
+    uint64_t ns = fcf_clock_ns();
+    if (ns < *next) {
+        return 0;
+    }
+    *next = ns + period_ns;
+    return 1;
+}"""
+
+# A struct parameter: (const) struct <name>*
+STRUCT_PARAM = re.compile(r"^(const\s+)?struct\s+(\w+)\s*\*$")
+
+# A pooled buffer parameter: every receiver gets a reference of its own (see fcf_buf in fcfutils.h).
+POOLED_PARAM = re.compile(r"^struct\s+fcf_buf\s*\*$")
+
+class CodeGenError(Exception):
+    # Raised by ErrorLogger.check with every error of the failed phase, and the
+    # warnings reported up to then. str() is what the command line prints.
+    def __init__(self, errors, warnings):
+        self.errors = list(errors)
+        self.warnings = list(warnings)
+        Exception.__init__(self, self.format())
+
+    def format(self):
+        lines = [str(len(self.errors)) + "  error(s) encountered!"] + [str(error) for error in self.errors]
+        return '\n'.join(lines)
+
 class ErrorLogger:
     # Log errors or warnings here, then check periodically.
-    # Code Generator uses no warnings, but they can be fun for debugging.
-    # The check method exits if errors exist, but just prints out warnings and keeps going.
-    def __init__(self):
+    # The check method raises CodeGenError if errors exist, but just reports warnings and keeps going.
+    # Reported warnings are kept in reported; they are printed too unless quiet.
+    def __init__(self, quiet=False):
         self.errors = []
         self.warnings = []
+        self.reported = []
+        self.quiet = quiet
 
     def new_error(self, message):
         self.errors.append(message)
@@ -65,15 +121,15 @@ class ErrorLogger:
         return False
 
     def check(self):
-        if self.has_warnings():
+        if self.has_warnings() and not self.quiet:
             print (len(self.warnings), " warning(s) encountered!")
             for warning in self.warnings:
                 print (warning)
+        # Warnings are only reported once.
+        self.reported.extend(self.warnings)
+        self.warnings = []
         if self.has_errors():
-            print (len(self.errors), " error(s) encountered!")
-            for error in self.errors:
-                print (error)
-            sys.exit(0)
+            raise CodeGenError(self.errors, self.reported)
 
 class OutputGenerator:
     # What we want here is:
@@ -94,6 +150,11 @@ class OutputGenerator:
     def append(self, mode, level, data):
         self.output[mode][level].append(data)
 
+    def add_mode(self, mode, filename, run):
+        # Modes of files that only exist in some builds, like the units of split builds.
+        if not mode in self.mode_flags_files:
+            self.mode_flags_files[mode] = {'run': run, 'file': filename}
+
     def display(self):
         for mode in self.output.keys():
             if self.mode_flags_files[mode]['run'] == True:
@@ -103,39 +164,181 @@ class OutputGenerator:
                         print (mode, "->", level, "->", message)
             print ("\n")  # separate modes
 
-    def write_out(self):
+    def render(self):
+        # Text of every mode that runs, by mode.
+        texts = {}
         for mode in self.output.keys():
             if self.mode_flags_files[mode]['run'] == True:
-                f = open(self.mode_flags_files[mode]['file'], "w")
-                for level in sorted(self.output[mode].keys()):
-                    for message in self.output[mode][level]:
-                        f.write(message + '\n')
+                texts[mode] = ''.join(message + '\n' for level in sorted(self.output[mode].keys())
+                                      for message in self.output[mode][level])
+        return texts
+
+    def write_out(self, directory=''):
+        for mode, text in self.render().items():
+            with open(path.join(directory, self.mode_flags_files[mode]['file']), "w") as f:
+                f.write(text)
+
+    def write_changed(self, directory='', always=()):
+        # Like write_out, but leaves files that would not change alone, so make
+        # does not rebuild from them. Modes in always are written anyway.
+        # Returns the names of the files written.
+        written = []
+        for mode, text in self.render().items():
+            filename = path.join(directory, self.mode_flags_files[mode]['file'])
+            try:
+                if mode in always:
+                    raise IOError
+                with open(filename, "r") as f:
+                    if f.read() == text:
+                        continue
+            except (IOError, OSError):
+                pass
+            with open(filename, "w") as f:
+                f.write(text)
+            written.append(filename)
+        return written
+
+class ModuleCache:
+    # Parsed module MIML files, by absolute path, so a batch of Parsers reads each file once.
+    # A file is parsed again when its modification time changes. Trees added with add()
+    # are not backed by a file. Parsers get a copy, since the phases edit module trees.
+    # It also remembers which handlers match a parse tree path, the same across Parsers
+    # with the same handlers.
+    def __init__(self):
+        self.trees = {}
+        self.handlers = {}
+
+    def add(self, filename, tree):
+        self.trees[path.abspath(filename)] = (None, tree)
+
+    def load(self, filename):
+        key = path.abspath(filename)
+        cached = self.trees.get(key)
+        if cached is None or cached[0] is not None:
+            stamp = os.stat(key).st_mtime_ns
+            if cached is None or cached[0] != stamp:
+                cached = (stamp, yaml.safe_load(open(key, 'r')))
+                self.trees[key] = cached
+        return copy.deepcopy(cached[1])
+
+class GenProfile:
+    # Where the time of a generation goes, for codeGen.py --profile: the time of each phase,
+    # each YAML file loaded (and whether it was parsed or came from the ModuleCache), nodes
+    # crawled and handler calls per phase, and fnmatch calls. summary() is a plain dict,
+    # written out as JSON, so builds can track the generator's cost per configuration.
+    # Use one GenProfile per generation.
+    def __init__(self):
+        self.phases = []
+        self.loads = []
+        self.nodes = defaultdict(int)
+        self.calls = defaultdict(lambda: defaultdict(int))
+        self.fnmatch_calls = 0
+        self.phase = None
+        self.start = time.perf_counter()
+
+    def timed(self, name, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.phases.append((name, time.perf_counter() - start))
+        return result
+
+    def load(self, filename, seconds, parsed):
+        self.loads.append((filename, seconds, parsed))
+
+    def finish(self, parser, texts):
+        self.miml = parser.miml_file
+        self.handler_paths = len(parser.handlers)
+        self.output_bytes = dict((mode, len(text)) for mode, text in texts.items())
+
+    def summary(self):
+        return {'miml': self.miml,
+                'seconds': time.perf_counter() - self.start,
+                'phases': [{'name': name, 'seconds': seconds} for (name, seconds) in self.phases],
+                'loads': [{'file': filename, 'seconds': seconds, 'parsed': parsed}
+                          for (filename, seconds, parsed) in self.loads],
+                'nodes': dict(self.nodes),
+                'handler_calls': dict((phase, dict(calls)) for phase, calls in self.calls.items()),
+                'fnmatch_calls': self.fnmatch_calls,
+                'handler_paths': self.handler_paths,
+                'output_bytes': self.output_bytes}
 
 class Parser:
-
-    def __init__(self, config, mainmiml, modeflages):
-        self.errors = ErrorLogger()
+    # config, mainmiml and counts are file names or the YAML documents themselves. A master
+    # MIML given as a document is named miml_name in the output, and its module MIML files
+    # are found relative to base_dir (by default the directory of mainmiml). Module files
+    # come from cache, a ModuleCache that several Parsers can share. A GenProfile given as
+    # profile collects where the time goes.
+
+    def __init__(self, config, mainmiml, modeflags, counts=None, hot_fraction=0.1, replay=False,
+                 miml_name='Main.miml', base_dir=None, cache=None, quiet=False, split=False,
+                 profile=None, trace=False):
+        self.errors = ErrorLogger(quiet)
+        self.profile = profile
         # declare modes_flags_files
         modes_flags_files = {'code': {'run': modeflags['c'], 'file': None},
                              'make': {'run': modeflags['m'], 'file': None},
-                             'header': {'run': modeflags['b'], 'file': None}}
+                             'header': {'run': modeflags['b'], 'file': None},
+                             'graph': {'run': modeflags.get('g', False), 'file': None},
+                             'schema': {'run': modeflags['c'], 'file': None},
+                             'trace': {'run': modeflags['c'], 'file': None}}
 
         # Read config file.
-        self.miml_file = mainmiml
-        self.errors.check_file(config)
+        if isinstance(mainmiml, dict):
+            self.miml_file = miml_name
+            self.miml_tree = mainmiml
+        else:
+            self.miml_file = mainmiml
+            self.miml_tree = None
+        if base_dir is None:
+            base_dir = '' if self.miml_tree is not None else path.dirname(mainmiml)
+        self.base_dir = base_dir
+        self.cache = cache if cache is not None else ModuleCache()
+        self.config = self.load_yaml(config)
         self.errors.check()
 
-        try:
-            self.config = yaml.load(open(config, 'r'))
-        except Exception as e:
-            self.errors.new_error("YAML parsing error: " + str(e))
-        self.errors.check()
+        # Optional call counts of generated functions, collected by a profiling run
+        # (see profiler/runprog.py --pgo). Used to mark message functions hot or cold.
+        self.counts = {}
+        self.hot_fraction = hot_fraction
+        if counts is not None:
+            self.counts = self.load_yaml(counts) or {}
+            self.errors.check()
 
         # get filename configuration data and remove from config, this makes
         # it so only handler data is left. Better for handlers!
         modes_flags_files['code']['file'] = self.config.pop('code_filename')
         modes_flags_files['header']['file'] = self.config.pop('header_filename')
         modes_flags_files['make']['file'] = self.config.pop('make_filename')
+        modes_flags_files['graph']['file'] = self.config.pop('graph_filename', 'fcfgraph.txt')
+        modes_flags_files['schema']['file'] = self.config.pop('schema_filename', 'fcflog.yaml')
+        modes_flags_files['trace']['file'] = self.config.pop('trace_filename', 'fcftrace.yaml')
+
+        # Log sink of logged messages: header declaring fcf_log_init/reserve/finalize, and its object.
+        self.log_include = self.config.pop('log_include', None)
+        self.log_object = self.config.pop('log_object', None)
+
+        # Replay builds feed a recorded log back in through the senders of logged messages.
+        self.replay = replay
+        self.replay_include = self.config.pop('replay_include', None)
+        self.replay_object = self.config.pop('replay_object', None)
+
+        # Trace builds record events around every fan-out and receiver call.
+        self.trace = trace
+        self.trace_include = self.config.pop('trace_include', None)
+        self.trace_object = self.config.pop('trace_object', None)
+
+        # Framer of modules that declare the framing of their serial protocol.
+        self.framer_include = self.config.pop('framer_include', None)
+        self.framer_object = self.config.pop('framer_object', None)
+
+        # USB transfer pools, whose depth modules get from usb_depth:.
+        self.usb_include = self.config.pop('usb_include', None)
+        self.usb_object = self.config.pop('usb_object', None)
+
+        # Split builds write the message functions of each sending module to a file pair of
+        # their own; units maps a sending module to the modules whose headers its file includes.
+        self.split = split
+        self.units = {}
 
         # get allowed types configuration data
         allowed_types = self.config.pop('allowed_types')
@@ -143,12 +346,18 @@ class Parser:
         # Frameworkinclude_dirs location
         framework_dir = self.config.pop('framework_dir', '')
 
+        # Sizes of struct field types, on top of TYPE_SIZES
+        self.type_sizes = dict(TYPE_SIZES)
+        self.type_sizes.update(self.config.pop('type_sizes', None) or {})
+
         # Setup a ParserHandlers objects
         # Since we have multiple MIML files now we need phases for processing.
         # Expansion allows handler functions that expect data in other files the opportunity
         #   to pull in that external data and place it in the parse tree.
         # Validation allows handler functions the opportunity to examine other data in the tree
         #   to ensure it is ready for use, including data pulled in by other functions.
+        # Optimization looks at the message graph as a whole: it drops duplicate edges, stubs out
+        #   unbound senders, flags recursion cycles and writes the graph report.
         # Parsing is where the actual parsing work happens, where handler functions generate output.
         # Actual output writing happens when all these phases are complete and is not part of "parsing".
         # There is a 4th stage (not really a stage), purge. In which a ParserHandlers function is called to
@@ -156,36 +365,96 @@ class Parser:
         # stage to a local ParserHandler structure in Parse, then stage later.
         self.handler_states = [Expand(self, allowed_types, framework_dir),
                                Validate(self, allowed_types, framework_dir),
+                               Optimize(self, allowed_types, framework_dir),
                                Parse(self, allowed_types, framework_dir)]
         self.handler_functions = ParseHandlers(self, allowed_types, framework_dir)
 
         self.output = OutputGenerator(modes_flags_files)
 
-    def parse(self):
-        # top level 'public' function. Since we have external MIML docs we need to pull those in
-        # before we crawl, so order of processing matters even though order of MIML elements does not.
+        # Handlers matching each parse tree path, shared with Parsers of the same handlers.
+        patterns = tuple(sorted((key, value['path']) for key, value in self.config.items()))
+        self.handlers = self.cache.handlers.setdefault(patterns, {})
+
+    def load_yaml(self, document):
+        # A YAML file, or a copy of a document that is already loaded (handlers edit what they get).
+        if not isinstance(document, str):
+            return copy.deepcopy(document)
+        if not self.errors.check_file(document):
+            return None
+        start = time.perf_counter()
         try:
-            self.master = yaml.load(open(self.miml_file, 'r'))
+            return yaml.safe_load(open(document, 'r'))
         except Exception as e:
             self.errors.new_error("YAML parsing error: " + str(e))
-            self.errors.check()
+        finally:
+            if self.profile is not None:
+                self.profile.load(document, time.perf_counter() - start, True)
+        return None
+
+    def load_module(self, filename):
+        # Module MIML files are named relative to the master MIML file.
+        filename = path.join(self.base_dir, filename)
+        if self.profile is None:
+            return self.cache.load(filename)
+        cached = self.cache.trees.get(path.abspath(filename))
+        start = time.perf_counter()
+        tree = self.cache.load(filename)
+        self.profile.load(filename, time.perf_counter() - start,
+                          self.cache.trees.get(path.abspath(filename)) is not cached)
+        return tree
+
+    def timed(self, name, function, *args):
+        # function(*args), timed as phase name when profiling.
+        if self.profile is None:
+            return function(*args)
+        return self.profile.timed(name, function, *args)
+
+    def parse(self):
+        # Command line entry: generate, then write the files.
+        self.generate()
+        if self.split:
+            # Units that come out the same keep their timestamps, so make only rebuilds
+            # the objects of what changed. miml.mk is always written, it is make's target.
+            self.timed("write_out", self.output.write_changed, '', ('make',))
+        else:
+            self.timed("write_out", self.output.write_out)
+
+    def generate(self):
+        # top level 'public' function. Since we have external MIML docs we need to pull those in
+        # before we crawl, so order of processing matters even though order of MIML elements does not.
+        # Returns the generated text of each mode that runs, by mode.
+        self.master = self.load_yaml(self.miml_tree if self.miml_tree is not None else self.miml_file)
+        self.errors.check()
+        if self.replay and not (self.master or {}).get('logged'):
+            self.errors.new_error("A replay build needs logged messages to replay, see logged: in " + self.miml_file)
+        if self.replay and self.replay_include is None:
+            self.errors.new_error("A replay build needs replay_include (and replay_object) in the code generator config.")
+        if self.trace and self.trace_include is None:
+            self.errors.new_error("A trace build needs trace_include (and trace_object) in the code generator config.")
+        self.errors.check()
 
         # Do Expand, Validate, Parse
         # Initialize the stage buffers
         self.buffer = self.master
         self.unhandled = {}
         for handler in self.handler_states:
-            self.transition(handler)
-            self.crawl(self.master)
+            state_name = handler.__class__.__name__
+            if self.profile is not None:
+                self.profile.phase = state_name
+            self.timed("transition " + state_name, self.transition, handler)
+            self.timed("crawl " + state_name, self.crawl, self.master)
 
         # purge staged data. Our 4th state, kinda...
-        self.handler_functions.purge()
+        self.timed("purge", self.handler_functions.purge)
+        self.errors.check()
         # Output
         # Let's you see stuff, uncomment when writing MIML extensions and trying to
         # figure out where to insert content in OutputGenerator.
         # self.output.display()
-        # Make files!!!
-        self.output.write_out()
+        texts = self.timed("render", self.output.render)
+        if self.profile is not None:
+            self.profile.finish(self, texts)
+        return texts
 
     def transition(self, handler):
         state_name = handler.__class__.__name__
@@ -229,16 +498,28 @@ class Parser:
         # This method returns True if a handler decides no other parsing is required for
         # the data it handles, for the mode it is in.
         return_value = False
-        for key, value in self.config.items():
+        self.path = path
+        location = '/'.join(path)
+        keys = self.handlers.get(location)
+        profile = self.profile
+        if keys is None:
             # match current location to a handler path
-            if fnmatch.fnmatchcase('/'.join(path), value['path']):
-                # verify data type is correct
-                if type(data).__name__ == self.config[key]['type']:
-                    # call hander function 'key', in ParserHandlers, passing data
-                    return_value = return_value or getattr(self.handler_functions, key)(data)
-                else:
-                    # type of data is not same as what was declared in cg.conf, so error.
-                    self.errors.new_error("Handler type mismatch. " + key + " expects " + self.config[key]['type'] + ", received " + type(data).__name__)
+            keys = [key for key, value in self.config.items() if fnmatch.fnmatchcase(location, value['path'])]
+            self.handlers[location] = keys
+            if profile is not None:
+                profile.fnmatch_calls += len(self.config)
+        if profile is not None:
+            profile.nodes[profile.phase] += 1
+        for key in keys:
+            # verify data type is correct
+            if type(data).__name__ == self.config[key]['type']:
+                if profile is not None:
+                    profile.calls[profile.phase][key] += 1
+                # call hander function 'key', in ParserHandlers, passing data
+                return_value = return_value or getattr(self.handler_functions, key)(data)
+            else:
+                # type of data is not same as what was declared in cg.conf, so error.
+                self.errors.new_error("Handler type mismatch. " + key + " expects " + self.config[key]['type'] + ", received " + type(data).__name__)
 
         return return_value
 
@@ -253,6 +534,21 @@ class ParseHandlers:
         # objects for single line make file
         self.objects = []
 
+        # gated edges ("SRC.func -> SRC.func"), indexes into fcf_dropped
+        self.gated = []
+        # code modes that use fcf_rate_gate
+        self.rate_gated = set()
+        # sending modules with logged messages
+        self.logging = set()
+        # trace ids of the messages and receivers ("SRC.func -> SRC.func") of trace builds
+        self.traced = []
+        self.trace_receivers = []
+        # code modes that include the trace header
+        self.tracing = set()
+        # framing tables, written out by purge, and the module declaring each name
+        self.framings = []
+        self.framing_names = {}
+
     def purge(self):
         # Required function, not part of config-based handlers
         # Called after Parsing phase, allows handlers to stage data and then commit to OutputGenerator after parse stage.
@@ -263,8 +559,117 @@ class ParseHandlers:
         o.append("code", 11, "\n")
         o.append("code", 16, "\n")
         o.append("make", 6, "\n")
+        # Modules include the header for struct definitions, so guard it.
+        guard = re.sub(r"\W", "_", path.basename(o.mode_flags_files['header']['file'])).upper() + "_"
+        o.append("header", 0, "#ifndef " + guard + "\n#define " + guard + "\n")
+        o.append("header", 99, "\n#endif /* " + guard + " */")
+        if self.framings:
+            o.append("header", 1, "#include \"" + self.parser.framer_include + "\"\n")
+            o.append("code", 2, "#include \"" + self.parser.framer_include + "\"")
+            for (name, table) in self.framings:
+                o.append("header", 10, "extern const struct fcf_framing fcf_framing_" + name + ";")
+                o.append("code", 17, "const struct fcf_framing fcf_framing_" + name + " = {\n    " + ',\n    '.join(table) + "\n};\n")
+            if self.parser.framer_object is not None and not self.parser.framer_object in self.objects:
+                self.objects.append(self.parser.framer_object)
+        if self.parser.trace:
+            self.purge_trace()
+        if self.parser.master.get('usb_depth'):
+            o.append("code", 2, "#include \"" + self.parser.usb_include + "\"")
+            if self.parser.usb_object is not None and not self.parser.usb_object in self.objects:
+                self.objects.append(self.parser.usb_object)
         if len(self.objects) > 0:
             self.parser.output.append("make", 5, "OBJECTS += " + ' '.join(self.objects))
+        if len(self.gated) > 0:
+            # Dropped deliveries of every gated edge, for modules to read or report.
+            o.append("header", 8, "#define FCF_GATED_EDGES " + str(len(self.gated)))
+            o.append("header", 8, "extern unsigned long fcf_dropped[FCF_GATED_EDGES];")
+            o.append("header", 8, "extern const char *fcf_gated_edges[FCF_GATED_EDGES];\n")
+            o.append("code", 17, "unsigned long fcf_dropped[" + str(len(self.gated)) + "];")
+            o.append("code", 17, "const char *fcf_gated_edges[" + str(len(self.gated)) + "] = {\n    " +
+                     ',\n    '.join('"' + edge + '"' for edge in self.gated) + "\n};")
+        for mode in sorted(self.rate_gated):
+            o.append(mode, 2, "#include <stdint.h>")
+            o.append(mode, 17, RATE_GATE)
+        if len(self.gated) > 0:
+            o.append("code", 17, "\n")
+        if self.parser.split:
+            self.purge_units()
+
+    def purge_trace(self):
+        # The ids the trace events carry, for tracereader.py.
+        p = self.parser
+        o = p.output
+        o.append("code", 2, "#include \"" + p.trace_include + "\"")
+        if p.trace_object is not None and not p.trace_object in self.objects:
+            self.objects.append(p.trace_object)
+        o.append("trace", 1, "# Ids of the messages and receivers in the events of a trace of " +
+                 o.mode_flags_files['code']['file'] + ", generated from " + p.miml_file + ".")
+        o.append("trace", 2, yaml.safe_dump({'messages': self.traced,
+                                             'receivers': [{'message': message, 'receiver': rec}
+                                                           for (message, rec) in self.trace_receivers]},
+                                            default_flow_style=False, sort_keys=False).rstrip())
+
+    def purge_units(self):
+        # Boilerplate of the units of a split build, and make rules that name the headers
+        # each object is compiled from, so an edit to one module rebuilds only its objects.
+        p = self.parser
+        o = p.output
+        modules = p.master['modules']
+        framework = path.join(self.framework_dir, "fcfutils.h")
+        core_code = o.mode_flags_files['code']['file']
+        core_header = o.mode_flags_files['header']['file']
+        extra = [include for include in (p.log_include if p.master.get('logged') else None,
+                                         p.replay_include if p.replay else None,
+                                         p.framer_include if self.framings else None,
+                                         p.usb_include if p.master.get('usb_depth') else None,
+                                         p.trace_include if p.trace else None) if include]
+        units = [source[0] for source in p.master['source_order'] if source[0] in p.units]
+        objects = []
+        unit_headers = []
+        for source in units:
+            code = o.mode_flags_files['code:' + source]['file']
+            header = o.mode_flags_files['header:' + source]['file']
+            guard = re.sub(r"\W", "_", path.basename(header)).upper() + "_"
+            o.append("header:" + source, 0, "#ifndef " + guard + "\n#define " + guard + "\n")
+            o.append("header:" + source, 1, "#include <stdint.h>")
+            o.append("header:" + source, 1, "#include \"" + core_header + "\"\n")
+            o.append("header:" + source, 99, "\n#endif /* " + guard + " */")
+            o.append("code:" + source, 1, "#include \"" + framework + "\"")
+            o.append("code:" + source, 2, "#include \"" + core_header + "\"")
+            o.append("code:" + source, 2, "#include \"" + header + "\"")
+            includes = [modules[token]['include'] for token in p.units[source] if 'include' in modules[token]]
+            for include in includes:
+                o.append("code:" + source, 5, "#include \"" + include + "\"")
+            o.append("code:" + source, 16, "\n")
+            # The core includes every unit header for the prototypes (and replay records).
+            o.append("code", 2, "#include \"" + header + "\"")
+            unit_headers.append(header)
+            obj = path.splitext(code)[0] + ".o"
+            objects.append(obj)
+            o.append("make", 10, obj + ": " + ' '.join([code, header, core_header] + includes + [framework] +
+                                                     [include for include in extra if include == p.log_include and source in self.logging] +
+                                                     ([p.trace_include] if p.trace else [])))
+        core_obj = path.splitext(core_code)[0] + ".o"
+        includes = [modules[source[0]]['include'] for source in p.master['source_order'] if 'include' in modules[source[0]]]
+        o.append("make", 10, core_obj + ": " + ' '.join([core_code, core_header] + unit_headers + includes + [framework] + extra))
+        if objects:
+            o.append("make", 5, "OBJECTS += " + ' '.join(objects))
+
+    def unit(self, kind, source, receivers=()):
+        # Output mode of the generated code ("code") or prototypes ("header") of a sending
+        # module: its own unit in split builds, fcfmain.c/.h otherwise.
+        p = self.parser
+        if not p.split:
+            return kind
+        tokens = p.units.setdefault(source, [source])
+        for token in receivers:
+            if not token in tokens:
+                tokens.append(token)
+        o = p.output
+        for base in ('code', 'header'):
+            (stem, ext) = path.splitext(o.mode_flags_files[base]['file'])
+            o.add_mode(base + ':' + source, stem + '_' + source.lower() + ext, o.mode_flags_files[base]['run'])
+        return kind + ':' + source
 
     def parse_sources(self, data):
         return True  # Nothing responds to data under here, left in so includes/final can figure out what order to stage data.
@@ -272,6 +677,12 @@ class ParseHandlers:
     def parse_messages(self, data):
         return False
 
+    def parse_structs(self, data):
+        return True
+
+    def parse_logged(self, data):
+        return True
+
     def parse_modules(self, data):
         # Must return False or other module matches will not happen.
         self.parser.buffer['modules'] = data
@@ -289,6 +700,36 @@ class ParseHandlers:
     def parse_init_final(self, data):
         return True
 
+    def parse_init_depends(self, data):
+        return True
+
+    def parse_batch(self, data):
+        return True
+
+    def parse_scheduling(self, data):
+        return True
+
+    def parse_usb_depth(self, data):
+        return True
+
+    def parse_framing(self, data):
+        return True
+
+    def framing_bytes(self, text):
+        # "24 42 49 4E ?? 00" => (bytes, mask), ?? matching any byte; None if malformed.
+        data = []
+        mask = []
+        for byte in str(text).split():
+            if byte == '??':
+                data.append(0)
+                mask.append(0)
+            elif re.match(r"[0-9A-Fa-f]{2}$", byte):
+                data.append(int(byte, 16))
+                mask.append(0xff)
+            else:
+                return None
+        return (data, mask)
+
     def validate_finals(self, data):
         return True
 
@@ -303,6 +744,55 @@ class ParseHandlers:
     def validate_params(self, data):
         return True
 
+    def edge(self, rec):
+        # A receiver entry is "SRC.func", or "SRC.func: {decimate: N}" / "SRC.func: {max_rate_hz: R}"
+        # to gate deliveries on that edge. Returns the receiver and its (possibly empty) gate.
+        if isinstance(rec, dict) and len(rec) == 1:
+            (name, gate), = rec.items()
+            return str(name), gate
+        return str(rec), {}
+
+    def gated_entry(self, entry):
+        # Whether a receiver entry is only called for some messages.
+        gate = self.edge(entry)[1]
+        return gate.get('decimate', 1) > 1 or 'max_rate_hz' in gate
+
+    def replayed_modules(self):
+        # In a replay build the replay source stands in for modules that only send logged
+        # messages: their init, final and object are left out.
+        p = self.parser
+        if not p.replay:
+            return []
+        logged = p.master.get('logged') or {}
+        messages = p.master.get('messages') or {}
+        receiving = set(self.edge(entry)[0].split('.')[0] for receivers in messages.values() for entry in receivers)
+        sending = defaultdict(list)
+        for message in messages:
+            sending[message.split('.')[0]].append(message)
+        return [source for source in p.master['modules']
+                if sending[source] and not source in receiving and all(m in logged for m in sending[source])]
+
+    def init_order(self, tokens, depends):
+        # Kahn's algorithm over init dependencies, taking ready modules in source order.
+        # Returns the order and the modules left over, which are on a cycle.
+        order = []
+        left = list(tokens)
+        while left:
+            ready = [t for t in left if all(d in order for d in depends.get(t) or [])]
+            if not ready:
+                break
+            order.append(ready[0])
+            left.remove(ready[0])
+        return order, left
+
+    def param_identity(self, datatype):
+        # What must match between a sender and a receiver parameter: the struct
+        # name for struct parameters, the type string otherwise.
+        struct = STRUCT_PARAM.match(datatype.strip())
+        if struct:
+            return "struct " + struct.group(2)
+        return ' '.join(datatype.replace('*', ' * ').split()).replace(' *', '*')
+
 class Expand(ParseHandlers):
     def parse_sources(self, data):
         p = self.parser
@@ -315,7 +805,7 @@ class Expand(ParseHandlers):
         for source in data:
             filename = source[1]
             try:
-                p.buffer['modules'][source[0]] = yaml.load(open(filename, 'r'))
+                p.buffer['modules'][source[0]] = p.load_module(filename)
             except Exception as err:
                 e.new_error("YAML parsing error: " + str(err))
         return True
@@ -326,6 +816,37 @@ class Expand(ParseHandlers):
         self.parser.buffer['messages'] = data
         return True
 
+    def parse_structs(self, data):
+        # Nothing to expand, but buffer structs for later passes.
+        del(self.parser.unhandled['structs'])
+        self.parser.buffer['structs'] = data
+        return True
+
+    def parse_logged(self, data):
+        del(self.parser.unhandled['logged'])
+        self.parser.buffer['logged'] = data
+        return True
+
+    def parse_init_depends(self, data):
+        del(self.parser.unhandled['init_depends'])
+        self.parser.buffer['init_depends'] = data
+        return True
+
+    def parse_batch(self, data):
+        del(self.parser.unhandled['batch'])
+        self.parser.buffer['batch'] = data
+        return True
+
+    def parse_scheduling(self, data):
+        del(self.parser.unhandled['scheduling'])
+        self.parser.buffer['scheduling'] = data
+        return True
+
+    def parse_usb_depth(self, data):
+        del(self.parser.unhandled['usb_depth'])
+        self.parser.buffer['usb_depth'] = data
+        return True
+
 class Validate(ParseHandlers):
     def parse_messages(self, data):
         p = self.parser
@@ -341,7 +862,12 @@ class Validate(ParseHandlers):
                 e.new_error("Sending message " + sender[1] + " not defined as sender for " + sender[0])
             else:
                 sender_params = p.master['modules'][sender[0]]['senders'][sender[1]]
-                for rec in data[message]:
+                if message in (p.master.get('batch') or {}):
+                    # Receivers of a batch take the samples and their count.
+                    sender_params = (sender_params or []) + [['count', 'int']]
+                for entry in data[message]:
+                    (rec, gate) = self.edge(entry)
+                    self.validate_gate(message, rec, gate)
                     receiver = rec.split('.')
                     if not len(sender) == 2:
                         e.new_error("Illegal Receiver syntax: " + rec + " for message " + message)
@@ -355,14 +881,249 @@ class Validate(ParseHandlers):
                     else:
                         pos = 0
                         for param in sender_params:
-                            if not param[1] == p.master['modules'][receiver[0]]['receivers'][receiver[1]][pos][1]:
+                            sent = self.param_identity(param[1])
+                            received = self.param_identity(p.master['modules'][receiver[0]]['receivers'][receiver[1]][pos][1])
+                            if not sent == received:
                                 e.new_error("Message " + message + " cannot send to receiver " +
-                                rec + ". Type mismatch on argument " + str(pos + 1))
+                                rec + ". Type mismatch on argument " + str(pos + 1) + ": " + sent + " vs " + received)
                             pos += 1
         del(p.unhandled['messages'])
         p.buffer['messages'] = data
         return True
 
+    def validate_gate(self, message, rec, gate):
+        # At most one of decimate (deliver every Nth message) or max_rate_hz per edge.
+        e = self.parser.errors
+        if not isinstance(gate, dict):
+            e.new_error("Edge " + message + " -> " + rec + ": attributes must be a mapping, like {decimate: 10}")
+            return
+        for key, value in gate.items():
+            if key == 'decimate':
+                if not (isinstance(value, int) and not isinstance(value, bool) and value >= 1):
+                    e.new_error("Edge " + message + " -> " + rec + ": decimate must be an integer >= 1, not " + str(value))
+            elif key == 'max_rate_hz':
+                if not (isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0):
+                    e.new_error("Edge " + message + " -> " + rec + ": max_rate_hz must be a number > 0, not " + str(value))
+            else:
+                e.new_error("Edge " + message + " -> " + rec + ": unknown attribute " + str(key) +
+                            ", expected decimate or max_rate_hz")
+        if len(gate) > 1:
+            e.new_error("Edge " + message + " -> " + rec + ": use only one of decimate and max_rate_hz")
+
+    def parse_structs(self, data):
+        # Structs are packed, so fields must be fixed size types with a known size.
+        p = self.parser
+        e = p.errors
+        for name, fields in data.items():
+            if not re.match(r"^[A-Za-z_]\w*$", str(name)):
+                e.new_error("Illegal struct name: " + str(name))
+                continue
+            if not isinstance(fields, list) or len(fields) == 0:
+                e.new_error("Struct " + name + " must have a list of fields.")
+                continue
+            seen = []
+            for field in fields:
+                if not isinstance(field, list) or not len(field) in (2, 3):
+                    e.new_error("Illegal field definition: " + str(field) + " in struct " + name)
+                    continue
+                if field[0] in seen:
+                    e.new_error("Duplicate field " + str(field[0]) + " in struct " + name)
+                seen.append(field[0])
+                if not field[1] in self.allowed_types:
+                    e.new_error("Illegal field type: " + str(field[1]) + " in struct " + name)
+                elif not field[1] in p.type_sizes:
+                    e.new_error("Field type " + str(field[1]) + " in struct " + name + " has no known size, add it to type_sizes.")
+                if len(field) == 3 and not (isinstance(field[2], int) and field[2] > 0):
+                    e.new_error("Illegal array length: " + str(field[2]) + " for field " + str(field[0]) + " in struct " + name)
+        del(p.unhandled['structs'])
+        p.buffer['structs'] = data
+        return True
+
+    def parse_logged(self, data):
+        # logged: maps a message to its fourcc, or to nothing for a generated one. Afterwards every
+        # message maps to its fourcc. Generated fourccs hash the message name, so they are stable.
+        p = self.parser
+        e = p.errors
+        if p.log_include is None:
+            e.new_error("Logged messages need log_include (and log_object) in the code generator config.")
+        messages = p.master.get('messages') or {}
+        taken = {}
+        for message in sorted(data.keys()):
+            fourcc = data[message]
+            if not message in messages:
+                e.new_error("Logged message " + message + " is not in messages; bind it, an empty receiver list will do.")
+            elif message.count('.') == 1 and message.split('.')[1] in ((p.master['modules'].get(message.split('.')[0]) or {}).get('senders') or {}):
+                (src, func) = message.split('.')
+                for param in p.master['modules'][src]['senders'][func] or []:
+                    if POOLED_PARAM.match(param[1].strip()):
+                        e.new_error("Logged message " + message + " cannot log pooled buffer " + str(param[0]) +
+                                    ", its length is not known before it is sent.")
+                    elif not (STRUCT_PARAM.match(param[1].strip()) or param[1].strip() in p.type_sizes):
+                        e.new_error("Logged message " + message + " cannot log parameter " + str(param[0]) + " of type " +
+                                    str(param[1]) + ", only fixed size types and const struct pointers have a known size.")
+            if fourcc is None:
+                continue
+            if not re.match(r"^\w{4}$", str(fourcc)):
+                e.new_error("Illegal fourcc " + str(fourcc) + " for logged message " + message + ", use 4 letters, digits or _.")
+            elif str(fourcc) in taken:
+                e.new_error("Fourcc " + str(fourcc) + " of " + message + " is already used by " + taken[str(fourcc)])
+            else:
+                taken[str(fourcc)] = message
+        for message in sorted(data.keys()):
+            if data[message] is None:
+                salt = 0
+                fourcc = self.fourcc(message, salt)
+                while fourcc in taken:
+                    salt += 1
+                    fourcc = self.fourcc(message, salt)
+                taken[fourcc] = message
+                data[message] = fourcc
+            else:
+                data[message] = str(data[message])
+        del(p.unhandled['logged'])
+        p.buffer['logged'] = data
+        return True
+
+    def parse_init_depends(self, data):
+        # init_depends: maps a source token to the tokens whose init must finish before its own.
+        p = self.parser
+        e = p.errors
+        for token, depends in data.items():
+            if not token in p.master['modules']:
+                e.new_error("Init dependencies of " + str(token) + ": not loaded as module.")
+                continue
+            if not isinstance(depends, list):
+                e.new_error("Init dependencies of " + str(token) + " must be a list of source tokens, like [GPS]")
+                data[token] = []
+                continue
+            for dep in depends:
+                if not dep in p.master['modules']:
+                    e.new_error("Init dependency " + str(dep) + " of " + str(token) + " not loaded as module.")
+                elif dep == token:
+                    e.new_error("Module " + str(token) + " cannot depend on its own init.")
+        if not e.has_errors():
+            order, cycle = self.init_order(p.master['modules'].keys(), data)
+            if cycle:
+                e.new_error("Init dependencies have a cycle among: " + ', '.join(cycle))
+        del(p.unhandled['init_depends'])
+        p.buffer['init_depends'] = data
+        return True
+
+    def parse_batch(self, data):
+        # batch: maps a message to the most samples it collects in a poll cycle. The sender
+        # passes one sample, a const struct pointer; receivers take (const struct X*, int).
+        p = self.parser
+        e = p.errors
+        messages = p.master.get('messages') or {}
+        for message, size in data.items():
+            if not message in messages:
+                e.new_error("Batch message " + str(message) + " is not in messages.")
+                continue
+            if not (isinstance(size, int) and not isinstance(size, bool) and size >= 1):
+                e.new_error("Batch message " + message + ": the batch size must be an integer >= 1, not " + str(size))
+            (src, func) = message.split('.')
+            params = (((p.master['modules'].get(src) or {}).get('senders') or {}).get(func)) or []
+            if not (len(params) == 1 and STRUCT_PARAM.match(params[0][1].strip())):
+                e.new_error("Batch message " + message + " must send one const struct pointer, the sample.")
+        del(p.unhandled['batch'])
+        p.buffer['batch'] = data
+        return True
+
+    def parse_scheduling(self, data):
+        # scheduling: budget_us, the time the callbacks of a poll cycle may take before those
+        # of priority 0 and below are deferred, and priority, a source token => int map.
+        p = self.parser
+        e = p.errors
+        if not isinstance(data, dict):
+            e.new_error("Scheduling must be a map with budget_us and priority.")
+            data = {}
+        for key in data:
+            if not key in ('budget_us', 'priority'):
+                e.new_error("Scheduling contains illegal component: " + str(key))
+        budget = data.get('budget_us')
+        if budget is not None and not (isinstance(budget, int) and not isinstance(budget, bool) and budget > 0):
+            e.new_error("Scheduling budget_us must be an integer > 0, not " + str(budget))
+        priorities = data.get('priority') or {}
+        if not isinstance(priorities, dict):
+            e.new_error("Scheduling priority must map source tokens to integers, like {GPS: 10}")
+            data['priority'] = priorities = {}
+        for token, priority in priorities.items():
+            if not token in p.master['modules']:
+                e.new_error("Priority of " + str(token) + ": not loaded as module.")
+            if not (isinstance(priority, int) and not isinstance(priority, bool)):
+                e.new_error("Priority of " + str(token) + " must be an integer, not " + str(priority))
+        del(p.unhandled['scheduling'])
+        p.buffer['scheduling'] = data
+        return True
+
+    def parse_usb_depth(self, data):
+        # usb_depth: source token => transfers per USB transfer pool its init creates.
+        p = self.parser
+        e = p.errors
+        if not isinstance(data, dict):
+            e.new_error("USB depth must map source tokens to integers, like {IMU: 8}")
+            data = {}
+        if data and p.usb_include is None:
+            e.new_error("USB depth needs usb_include (and usb_object) in the code generator config.")
+        for token, depth in data.items():
+            if not token in p.master['modules']:
+                e.new_error("USB depth of " + str(token) + ": not loaded as module.")
+            if not (isinstance(depth, int) and not isinstance(depth, bool) and depth >= 1):
+                e.new_error("USB depth of " + str(token) + " must be an integer >= 1, not " + str(depth))
+        del(p.unhandled['usb_depth'])
+        p.buffer['usb_depth'] = data
+        return True
+
+    def parse_framing(self, data):
+        # framing: the serial protocols of a module, by name. fcf_framer_new() takes them as
+        # fcf_framing_<name>; see examples/utils/utils_framer.h for the frame layout.
+        p = self.parser
+        e = p.errors
+        source = p.path[1]
+        if p.framer_include is None:
+            e.new_error("Module " + source + " declares framing, which needs framer_include (and framer_object) in the code generator config.")
+        for name, framing in data.items():
+            where = "Framing " + str(name) + " of " + source
+            if not re.match(r"[A-Za-z_]\w*$", str(name)):
+                e.new_error(where + ": the name must be a C identifier.")
+            if name in self.framing_names:
+                e.new_error(where + ": also declared by " + self.framing_names[name])
+            self.framing_names[name] = source
+            if not isinstance(framing, dict):
+                e.new_error(where + " must be a map with sync, length, header and max_length.")
+                continue
+            for key in framing:
+                if not key in ('sync', 'length', 'header', 'payload_extra', 'trailer', 'max_length'):
+                    e.new_error(where + " contains illegal component: " + str(key))
+            for key in ('sync', 'length', 'header', 'max_length'):
+                if not key in framing:
+                    e.new_error(where + " needs " + key)
+            sync = self.framing_bytes(framing.get('sync', ''))
+            if not sync or not sync[0] or len(sync[0]) > 255 or sync[1][0] != 0xff:
+                e.new_error(where + ": sync must be up to 255 hex bytes, like \"24 42 49 4E ?? 00\", the first not ??")
+                sync = ([0], [0xff])
+            trailer = self.framing_bytes(framing.get('trailer', ''))
+            if trailer is None or 0 in trailer[1] or len(trailer[0]) > 255:
+                e.new_error(where + ": trailer must be up to 255 hex bytes, like \"0D 0A\"")
+            length = framing.get('length', {})
+            if not (isinstance(length, dict) and set(length.keys()) <= set(['offset', 'width', 'endian']) and
+                    isinstance(length.get('offset'), int) and length.get('width') in (1, 2, 4) and
+                    length.get('endian', 'little') in ('little', 'big')):
+                e.new_error(where + ": length must be {offset: N, width: 1, 2 or 4, endian: little or big}")
+                length = {'offset': 0, 'width': 1}
+            header = framing.get('header', 0)
+            if not (isinstance(header, int) and len(sync[0]) <= header <= 65535 and length['offset'] + length['width'] <= header):
+                e.new_error(where + ": header must be an integer that covers the sync and the length field.")
+            for key, limit in (('payload_extra', 65535), ('max_length', 2 ** 32 - 1)):
+                value = framing.get(key, 0)
+                if not (isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= limit):
+                    e.new_error(where + ": " + key + " must be an integer from 0 to " + str(limit))
+        return True
+
+    def fourcc(self, message, salt):
+        digest = hashlib.sha1((message + ("#" + str(salt) if salt else "")).encode()).digest()
+        return ''.join(FOURCC_CHARS[b % len(FOURCC_CHARS)] for b in digest[:4])
+
     def parse_modules(self, data):
         p = self.parser
         e = p.errors
@@ -371,7 +1132,7 @@ class Validate(ParseHandlers):
         # No need for Expansion code, modules are created during source expansion.
         for source in data.keys():
             for key in data[source]:
-                if not key in ('include', 'object', 'init', 'final', 'senders', 'receivers'):
+                if not key in ('include', 'object', 'init', 'final', 'senders', 'receivers', 'framing'):
                     e.new_error("Module: " + source + " contains illegal component: " + key)
         del(p.unhandled['modules'])
         p.buffer['modules'] = data
@@ -424,13 +1185,221 @@ class Validate(ParseHandlers):
         for param in data:
             if not len(param) == 2:
                 e.new_error("Illegal parameter definition: " + str(param) + " in " + '/'.join(p.path))
+            if POOLED_PARAM.match(param[1].strip()):
+                continue
+            struct = STRUCT_PARAM.match(param[1].strip())
+            if struct:
+                # Receivers share the sender's struct, so it is passed as a const pointer.
+                if not struct.group(2) in (p.master.get('structs') or {}):
+                    e.new_error("Unknown struct: " + str(param[1]) + ", structs are declared in " + p.miml_file)
+                elif not struct.group(1):
+                    e.new_error("Struct parameter " + str(param[0]) + " must be a const pointer: const struct " + struct.group(2) + "*")
+                continue
             datatype = re.match(r"(?:const\s)?((?:unsigned\s)?\w+)(?:\s?[*&])?", param[1]).group(1)
             if not datatype in self.allowed_types:
                 e.new_error("Illegal parameter type: " + str(param[1]) + " in " + '/'.join(p.path))
         return True
 
+class Optimize(ParseHandlers):
+    # Whole-graph pass. The graph is indexed once, in parse_modules, in time linear
+    # in the number of edges; the other handlers only move their data along.
+
+    def parse_messages(self, data):
+        # Duplicate receivers are removed in place by parse_modules, whichever runs first.
+        del(self.parser.unhandled['messages'])
+        self.parser.buffer['messages'] = data
+        return True
+
+    def parse_structs(self, data):
+        del(self.parser.unhandled['structs'])
+        self.parser.buffer['structs'] = data
+        return True
+
+    def parse_init_final(self, data):
+        del(self.parser.unhandled['source_order'])
+        self.parser.buffer['source_order'] = data
+        return True
+
+    def parse_logged(self, data):
+        del(self.parser.unhandled['logged'])
+        self.parser.buffer['logged'] = data
+        return True
+
+    def parse_init_depends(self, data):
+        del(self.parser.unhandled['init_depends'])
+        self.parser.buffer['init_depends'] = data
+        return True
+
+    def parse_batch(self, data):
+        del(self.parser.unhandled['batch'])
+        self.parser.buffer['batch'] = data
+        return True
+
+    def parse_scheduling(self, data):
+        del(self.parser.unhandled['scheduling'])
+        self.parser.buffer['scheduling'] = data
+        return True
+
+    def parse_usb_depth(self, data):
+        del(self.parser.unhandled['usb_depth'])
+        self.parser.buffer['usb_depth'] = data
+        return True
+
+    def parse_modules(self, data):
+        p = self.parser
+        e = p.errors
+        messages = p.master.get('messages') or {}
+
+        # Adjacency index: sender "SRC.func" => receivers, module => modules it sends to.
+        edges = {}
+        targets = defaultdict(list)
+        duplicates = []
+        for message, receivers in messages.items():
+            seen = set()
+            unique = []
+            for entry in receivers:
+                rec = self.edge(entry)[0]
+                if rec in seen:
+                    duplicates.append(message + " -> " + rec)
+                    continue
+                seen.add(rec)
+                unique.append(entry)
+            receivers[:] = unique
+            edges[message] = [self.edge(entry)[0] for entry in unique]
+            src = message.split('.')[0]
+            for rec in edges[message]:
+                rsrc = rec.split('.')[0]
+                if not rsrc in targets[src]:
+                    targets[src].append(rsrc)
+        for duplicate in duplicates:
+            e.new_warning("Duplicate message edge removed: " + duplicate)
+
+        unbound = []
+        bound_receivers = set(rec for receivers in edges.values() for rec in receivers)
+        unused = []
+        for source in data.keys():
+            for func in data[source].get('senders') or {}:
+                if not source + '.' + func in edges:
+                    unbound.append((source, func))
+            for func in data[source].get('receivers') or {}:
+                if not source + '.' + func in bound_receivers:
+                    unused.append(source + '.' + func)
+
+        cycles = self.cycles(list(data.keys()), targets)
+        for cycle in cycles:
+            if len(cycle) == 1:
+                # A module sending to itself, e.g. a timer driving its own receiver: whether
+                # that receiver sends again is the module's own business, so only the report
+                # lists it.
+                continue
+            e.new_warning("Message cycle between modules " + ' -> '.join(cycle + [cycle[0]]) +
+                          ": a receiver that sends again recurses on the stack.")
+
+        self.stub_senders(unbound)
+        self.report(data, edges, unbound, unused, duplicates, cycles)
+
+        del(p.unhandled['modules'])
+        p.buffer['modules'] = data
+        return False
+
+    def cycles(self, modules, targets):
+        # Strongly connected components of the module graph (iterative Tarjan),
+        # keeping the ones that can recurse: more than one module, or a self-loop.
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        found = []
+        for root in modules:
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, child = work.pop()
+                if child == 0:
+                    index[node] = low[node] = len(index)
+                    stack.append(node)
+                    on_stack.add(node)
+                if child < len(targets[node]):
+                    work.append((node, child + 1))
+                    succ = targets[node][child]
+                    if not succ in index:
+                        work.append((succ, 0))
+                    elif succ in on_stack:
+                        low[node] = min(low[node], index[succ])
+                    continue
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 or node in targets[node]:
+                        found.append(list(reversed(component)))
+        return found
+
+    def stub_senders(self, unbound):
+        # Senders no message binds get an empty body, so the program links and the
+        # optimizer (with -flto across modules) deletes their call sites.
+        p = self.parser
+        o = p.output
+        for (source, func) in unbound:
+            params = p.master['modules'][source]['senders'][func] or []
+            o.append(self.unit("header", source), 10, "void " + func + "(" + ', '.join(param[1] for param in params) + ');')
+            o.append(self.unit("code", source), 20, "/* " + source + "." + func + " is not bound to any receiver. */")
+            # Nobody takes the sender's reference to a pooled buffer, so it is released here.
+            body = ''.join("    fcf_buf_unref(" + param[0] + ");\n" for param in params if POOLED_PARAM.match(param[1].strip()))
+            o.append(self.unit("code", source), 20, "void " + func + "(" + ', '.join(param[1] + " " + param[0] for param in params) + ') {\n' + body + '}\n')
+
+    def report(self, modules, edges, unbound, unused, duplicates, cycles):
+        o = self.parser.output
+        lines = ["Message graph of " + self.parser.miml_file,
+                 "  modules: %d, messages: %d, edges: %d" % (len(modules), len(edges), sum(len(r) for r in edges.values())),
+                 "", "Fan-out:"]
+        messages = self.parser.master.get('messages') or {}
+        for message in sorted(edges, key=lambda m: (-len(edges[m]), m)):
+            receivers = []
+            for entry in messages[message]:
+                (rec, gate) = self.edge(entry)
+                receivers.append(rec + ''.join(" (%s: %s)" % item for item in gate.items()))
+            lines.append("  %-40s %3d  %s" % (message, len(edges[message]), ', '.join(receivers)))
+        lines.append("\nUnbound senders (stubbed):")
+        lines.extend("  " + source + "." + func for (source, func) in unbound)
+        lines.append("\nUnbound receivers:")
+        lines.extend("  " + rec for rec in unused)
+        lines.append("\nDuplicate edges removed:")
+        lines.extend("  " + duplicate for duplicate in duplicates)
+        lines.append("\nCycles (modules that can recurse):")
+        lines.extend("  " + ' -> '.join(cycle + [cycle[0]]) for cycle in cycles)
+        o.append("graph", 1, '\n'.join(lines))
+
 class Parse(ParseHandlers):
 
+    def parse_structs(self, data):
+        # Struct definitions go in the header, ahead of the message prototypes.
+        p = self.parser
+        o = p.output
+        for name, fields in data.items():
+            size = 0
+            o.append("header", 5, "struct " + name + " {")
+            for field in fields:
+                count = field[2] if len(field) == 3 else 1
+                o.append("header", 5, "    " + field[1] + " " + field[0] + ("[" + str(count) + "]" if len(field) == 3 else "") + ";")
+                size += p.type_sizes[field[1]] * count
+            o.append("header", 5, "} __attribute__((packed));")
+            o.append("header", 5, "_Static_assert(sizeof(struct " + name + ") == " + str(size) +
+                     ", \"struct " + name + " is not " + str(size) + " bytes\");")
+            o.append("header", 5, "_Static_assert(__alignof__(struct " + name + ") == 1, \"struct " +
+                     name + " is not packed\");\n")
+        o.append("header", 1, "#include <stdint.h>\n")
+        o.append("code", 2, "#include \"" + o.mode_flags_files['header']['file'] + "\"")
+        return True
+
     def parse_sources(self, data):
         p = self.parser
         e = p.errors
@@ -447,6 +1416,7 @@ class Parse(ParseHandlers):
         p = self.parser
         e = p.errors
         o = p.output
+        batch = p.master.get('batch') or {}
         for message in data.keys():  # for each message
             (src, func) = message.split('.')
             args = []
@@ -456,14 +1426,256 @@ class Parse(ParseHandlers):
                 args.append(caller_param[1] + " " + caller_param[0])
                 params.append(caller_param[0])
                 types.append(caller_param[1])
-            o.append("header", 10, "void " + func + "(" + ', '.join(types) + ');')
-            o.append("code", 20, "void " + func + "(" + ', '.join(args) + ') {')
-            for receivers in data[message]:  # for each receiver
-                (rsrc, rfunc) = receivers.split('.')
-                o.append("code", 20, "    " + rfunc + "(" + ', '.join(params) + ');')
+            code = self.unit("code", src, [self.edge(entry)[0].split('.')[0] for entry in data[message]])
+            o.append(self.unit("header", src), 10, "void " + func + "(" + ', '.join(types) + ');')
+            o.append(code, 20, self.function_attributes(func) + "void " + func + "(" + ', '.join(args) + ') {')
+            if message in (p.master.get('logged') or {}):
+                o.append(code, 20, "    fcf_log_" + func + "(" + ', '.join(params) + ');')
+            pooled = [param[0] for param in p.master['modules'][src]['senders'][func] if POOLED_PARAM.match(param[1].strip())]
+            if message in batch:
+                # The sample is copied into the batch; the receivers get the whole batch
+                # at the end of the poll cycle, or as soon as it is full. There are two
+                # batches: a receiver that sends the message again fills the other one
+                # while the one it was given stays untouched.
+                array = "fcf_batch_" + func
+                struct = STRUCT_PARAM.match(types[0].strip()).group(2)
+                o.append(code, 17, "static struct " + struct + " " + array + "[2][" + str(batch[message]) + "];")
+                o.append(code, 17, "static int " + array + "_count, " + array + "_current;")
+                o.append(code, 20, "    if (" + array + "_count == " + str(batch[message]) + ") {")
+                o.append(code, 20, "        fcf_flush_" + func + "();")
+                o.append(code, 20, "    }")
+                o.append(code, 20, "    " + array + "[" + array + "_current][" + array + "_count++] = *" + params[0] + ";")
+                o.append(code, 20, "}\n")
+                o.append(self.unit("header", src), 10, "void fcf_flush_" + func + "(void);")
+                o.append(code, 20, "void fcf_flush_" + func + "(void) {")
+                o.append(code, 20, "    int fcf_count = " + array + "_count;")
+                o.append(code, 20, "    struct " + struct + " *fcf_samples = " + array + "[" + array + "_current];")
+                o.append(code, 20, "    if (fcf_count == 0) {")
+                o.append(code, 20, "        return;")
+                o.append(code, 20, "    }")
+                o.append(code, 20, "    " + array + "_current ^= 1;")
+                o.append(code, 20, "    " + array + "_count = 0;")
+                self.fan_out(code, message, data[message], ["fcf_samples", "fcf_count"], [])
+                o.append(code, 20, "}\n")
+                self.lib_repeat(code, func, p.master['modules'][src]['senders'][func])
+                continue
+            self.fan_out(code, message, data[message], params, pooled)
+            o.append(code, 20, "}\n")
+            self.lib_repeat(code, func, p.master['modules'][src]['senders'][func])
+        if batch:
+            # Called by the framework at the end of every poll cycle, and before the finals.
+            o.append("header", 10, "void fcf_flush_batches(void);")
+            o.append("code", 20, "void fcf_flush_batches(void) {")
+            for message in batch:
+                o.append("code", 20, "    fcf_flush_" + message.split('.')[1] + "();")
             o.append("code", 20, "}\n")
         return True
 
+    def lib_repeat(self, code, func, params):
+        # Shared library builds only: sends the message n times from C, for profiler.py,
+        # so that one ctypes call times n sends. Pooled parameters are left out and get
+        # a fresh buffer for every send, since the message takes the sender's reference.
+        # Returns the number of sends, fewer than n if the pool ran out.
+        o = self.parser.output
+        pooled = [(param[0], param[1]) for param in params if POOLED_PARAM.match(param[1].strip())]
+        args = [param[1] + " " + param[0] for param in params if not POOLED_PARAM.match(param[1].strip())]
+        o.append(code, 20, "#ifdef FCF_SHARED")
+        o.append(code, 20, "long fcf_lib_repeat_" + func + "(" + ', '.join(args + ["long fcf_n"]) + ") {")
+        o.append(code, 20, "    long fcf_i;")
+        o.append(code, 20, "    for (fcf_i = 0; fcf_i < fcf_n; fcf_i++) {")
+        for (name, ctype) in pooled:
+            o.append(code, 20, "        " + ctype + " " + name + " = fcf_buf_alloc();")
+        if pooled:
+            o.append(code, 20, "        if (" + ' || '.join(name + " == NULL" for (name, ctype) in pooled) + ") {")
+            if len(pooled) > 1:
+                for (name, ctype) in pooled:
+                    o.append(code, 20, "            if (" + name + " != NULL) fcf_buf_unref(" + name + ");")
+            o.append(code, 20, "            break;")
+            o.append(code, 20, "        }")
+        o.append(code, 20, "        " + func + "(" + ', '.join(param[0] for param in params) + ");")
+        o.append(code, 20, "    }")
+        o.append(code, 20, "    return fcf_i;")
+        o.append(code, 20, "}")
+        o.append(code, 20, "#endif\n")
+
+    def fan_out(self, code, message, entries, params, pooled):
+        # Calls the receivers of a message, through their gates.
+        p = self.parser
+        o = p.output
+        gated = [entry for entry in entries if self.gated_entry(entry)]
+        ungated = len(entries) - len(gated)
+        if p.trace:
+            # Events with the message's id, and each receiver's, around the fan-out and each call.
+            if p.split and not code in self.tracing:
+                self.tracing.add(code)
+                o.append(code, 2, "#include \"" + p.trace_include + "\"")
+            traced = len(self.traced)
+            self.traced.append(message)
+            o.append(code, 20, "    fcf_trace(FCF_TRACE_SEND, %d, FCF_TRACE_NONE);" % traced)
+        if pooled:
+            # Every receiver gets a reference. Without gates the sender's reference goes to
+            # one of them; with gates it is held until all receivers had their turn, since
+            # a receiver may release its reference before a gated one is called.
+            refs = ungated if gated or ungated == 0 else ungated - 1
+            if refs > 0:
+                for name in pooled:
+                    o.append(code, 20, "    fcf_buf_ref_n(" + name + ", " + str(refs) + ");")
+        for entry in entries:  # for each receiver
+            (rec, gate) = self.edge(entry)
+            (rsrc, rfunc) = rec.split('.')
+            call = rfunc + "(" + ', '.join(params) + ');'
+            if pooled and self.gated_entry(entry):
+                call = ' '.join("fcf_buf_ref(" + name + ");" for name in pooled) + " " + call
+            if p.trace:
+                receiver = len(self.trace_receivers)
+                self.trace_receivers.append((message, rec))
+                call = ("fcf_trace(FCF_TRACE_RECV, %d, %d); " % (traced, receiver) + call +
+                        " fcf_trace(FCF_TRACE_DONE, %d, %d);" % (traced, receiver))
+            if gate.get('decimate', 1) > 1:
+                # Delivers the first message and every Nth one after it.
+                idx = len(self.gated)
+                self.gated.append(message + " -> " + rec)
+                n = gate['decimate']
+                o.append(code, 17, "static unsigned int fcf_decimate_%d = %d;" % (idx, n - 1))
+                o.append(code, 20, "    if (++fcf_decimate_%d < %d) {" % (idx, n))
+                o.append(code, 20, "        fcf_dropped[%d]++;" % idx)
+                o.append(code, 20, "    } else {")
+                o.append(code, 20, "        fcf_decimate_%d = 0;" % idx)
+                o.append(code, 20, "        " + call)
+                o.append(code, 20, "    }")
+            elif 'max_rate_hz' in gate:
+                idx = len(self.gated)
+                self.gated.append(message + " -> " + rec)
+                o.append(code, 17, "static uint64_t fcf_next_%d;" % idx)
+                o.append(code, 20, "    if (fcf_rate_gate(&fcf_next_%d, %dULL)) {" %
+                         (idx, int(round(1e9 / gate['max_rate_hz']))))
+                o.append(code, 20, "        " + call)
+                o.append(code, 20, "    } else {")
+                o.append(code, 20, "        fcf_dropped[%d]++;" % idx)
+                o.append(code, 20, "    }")
+                self.rate_gated.add(code)
+            else:
+                o.append(code, 20, "    " + call)
+        if pooled and (gated or ungated == 0):
+            for name in pooled:
+                o.append(code, 20, "    fcf_buf_unref(" + name + ");")
+        if p.trace:
+            o.append(code, 20, "    fcf_trace(FCF_TRACE_SENT, %d, FCF_TRACE_NONE);" % traced)
+
+    def parse_logged(self, data):
+        # A packed record and a serializer per logged message. The serializer stores the arguments
+        # straight into the log bucket, one store per field; the schema describes the records.
+        p = self.parser
+        o = p.output
+        if not data:
+            return True
+        o.append("code", 2, "#include \"" + p.log_include + "\"")
+        if p.log_object is not None:
+            self.objects.append(p.log_object)
+        if not p.split:
+            o.append("code", 17, "_Static_assert(__BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__, \"log records are little-endian\");\n")
+        records = {}
+        for message in sorted(data.keys()):
+            (src, func) = message.split('.')
+            fourcc = data[message]
+            record = "fcf_record_" + func
+            fields = []
+            size = 0
+            # In split builds records go in the unit header, where the replay dispatch sees them.
+            code = self.unit("code", src)
+            structs = self.unit("header", src) if p.split else "code"
+            level = 5 if p.split else 17
+            if not src in self.logging:
+                self.logging.add(src)
+                if p.split:
+                    o.append(code, 2, "#include \"" + p.log_include + "\"")
+                    o.append(code, 17, "_Static_assert(__BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__, \"log records are little-endian\");\n")
+            o.append(structs, level, "struct " + record + " {")
+            for param in p.master['modules'][src]['senders'][func] or []:
+                struct = STRUCT_PARAM.match(param[1].strip())
+                if struct:
+                    o.append(structs, level, "    struct " + struct.group(2) + " " + param[0] + ";")
+                    for field in p.master['structs'][struct.group(2)]:
+                        count = field[2] if len(field) == 3 else 1
+                        fields.append({'name': param[0] + "." + field[0], 'type': field[1], 'dtype': '<' + DTYPES.get(field[1], 'V%d' % p.type_sizes[field[1]]),
+                                       'offset': size, 'count': count})
+                        size += p.type_sizes[field[1]] * count
+                else:
+                    datatype = param[1].strip()
+                    o.append(structs, level, "    " + datatype + " " + param[0] + ";")
+                    fields.append({'name': param[0], 'type': datatype, 'dtype': '<' + DTYPES.get(datatype, 'V%d' % p.type_sizes[datatype]),
+                                   'offset': size, 'count': 1})
+                    size += p.type_sizes[datatype]
+            o.append(structs, level, "} __attribute__((packed));")
+            o.append(structs, level, "_Static_assert(sizeof(struct " + record + ") == " + str(size) +
+                     ", \"struct " + record + " is not " + str(size) + " bytes\");\n")
+
+            params = p.master['modules'][src]['senders'][func] or []
+            o.append(code, 18, "static inline void fcf_log_" + func + "(" +
+                     ', '.join(param[1] + " " + param[0] for param in params) + ") {")
+            o.append(code, 18, "    struct " + record + " *fcf_record = fcf_log_reserve(FCF_FOURCC(" +
+                     ', '.join("'" + c + "'" for c in fourcc) + "), sizeof(*fcf_record));")
+            o.append(code, 18, "    if (fcf_record != NULL) {")
+            for param in params:
+                if STRUCT_PARAM.match(param[1].strip()):
+                    o.append(code, 18, "        fcf_record->" + param[0] + " = *" + param[0] + ";")
+                else:
+                    o.append(code, 18, "        fcf_record->" + param[0] + " = " + param[0] + ";")
+            o.append(code, 18, "    }")
+            o.append(code, 18, "}\n")
+            records[fourcc] = {'message': message, 'size': size, 'fields': fields}
+
+        if p.replay:
+            self.replay_dispatch(data)
+
+        o.append("schema", 1, "# Record layouts of the messages logged by " + o.mode_flags_files['code']['file'] +
+                 ", generated from " + p.miml_file + ".\n"
+                 "# A record is a 12 byte header, fourcc then big-endian 16-bit length and 48-bit\n"
+                 "# timestamp (ns, split into 16 high and 32 low bits), followed by the payload.")
+        o.append("schema", 2, yaml.safe_dump({'byte_order': 'little', 'header_size': 12, 'records': records},
+                                             default_flow_style=None, sort_keys=False).rstrip())
+        return True
+
+    def replay_dispatch(self, data):
+        # Sends a replayed record through the sender that logged it, switching on the fourcc.
+        p = self.parser
+        o = p.output
+        o.append("code", 2, "#include \"" + p.replay_include + "\"")
+        if p.replay_object is not None:
+            self.objects.append(p.replay_object)
+        o.append("code", 6, "static int fcf_replay_record(uint32_t fourcc, const void *payload, uint16_t length);")
+        o.append("code", 19, "static int fcf_replay_record(uint32_t fourcc, const void *payload, uint16_t length) {")
+        o.append("code", 19, "    switch (ntohl(fourcc)) {")
+        for message in sorted(data.keys()):
+            (src, func) = message.split('.')
+            record = "fcf_record_" + func
+            args = []
+            for param in p.master['modules'][src]['senders'][func] or []:
+                args.append(("&" if STRUCT_PARAM.match(param[1].strip()) else "") + "fcf_record->" + param[0])
+            o.append("code", 19, "    case 0x%08x: /* %s */" % (int.from_bytes(data[message].encode(), 'big'), data[message]))
+            o.append("code", 19, "        if (length == sizeof(struct " + record + ")) {")
+            o.append("code", 19, "            const struct " + record + " *fcf_record = payload;")
+            o.append("code", 19, "            " + func + "(" + ', '.join(args) + ");")
+            o.append("code", 19, "            return 1;")
+            o.append("code", 19, "        }")
+            o.append("code", 19, "        break;")
+        o.append("code", 19, "    }")
+        o.append("code", 19, "    return 0;")
+        o.append("code", 19, "}\n")
+
+    def function_attributes(self, func):
+        # Marks a generated message function hot or cold from profiled call counts.
+        # Functions that were never called are cold, functions called at least
+        # hot_fraction times as often as the busiest one are hot.
+        counts = self.parser.counts
+        if not counts or func not in counts:
+            return ""
+        if counts[func] == 0:
+            return "__attribute__((cold)) "
+        if counts[func] >= self.parser.hot_fraction * max(counts.values()):
+            return "__attribute__((hot)) "
+        return ""
+
     def parse_includes(self, data):
         # handles include files.
         p = self.parser
@@ -474,34 +1686,305 @@ class Parse(ParseHandlers):
     def parse_objects(self, data):
         # handles object files for the make file, needs to add 1 row to make file so stages
         # into (self.objects), purge makes output.
+        p = self.parser
+        if data in [p.master['modules'][source].get('object') for source in self.replayed_modules()]:
+            return True
         self.objects.append(data)
         return True
 
+    def parse_framing(self, data):
+        # A struct fcf_framing per framing; purge writes them out with the framer include.
+        for name in sorted(data.keys()):
+            framing = data[name]
+            (sync, mask) = self.framing_bytes(framing['sync'])
+            trailer = self.framing_bytes(framing.get('trailer', ''))[0]
+            length = framing['length']
+            c_bytes = lambda values: '(const unsigned char *) "' + ''.join('\\x%02x' % b for b in values) + '"'
+            self.framings.append((name, [
+                '.name = "' + name + '"',
+                '.sync = ' + c_bytes(sync),
+                '.sync_mask = ' + (c_bytes(mask) if 0 in mask else 'NULL'),
+                '.sync_length = ' + str(len(sync)),
+                '.length_offset = ' + str(length['offset']),
+                '.length_width = ' + str(length['width']),
+                '.length_big_endian = ' + str(int(length.get('endian', 'little') == 'big')),
+                '.header_length = ' + str(framing['header']),
+                '.payload_extra = ' + str(framing.get('payload_extra', 0)),
+                '.trailer = ' + (c_bytes(trailer) if trailer else 'NULL'),
+                '.trailer_length = ' + str(len(trailer)),
+                '.max_length = ' + str(framing['max_length'])]))
+        return True
+
     def parse_init_final(self, data):
         p = self.parser
         o = p.output
         e = p.errors
         finals = []
+        logged = p.master.get('logged')
+        replayed = self.replayed_modules()
         o.append("code", 10, "void fcf_initialize() {")
-        for source in data:
-            token = source[0]
-            if 'init' in p.master['modules'][token]:
+        if p.replay:
+            # Before the log, so log timestamps start on the virtual clock.
+            o.append("code", 10, "    fcf_replay_init(fcf_replay_record);")
+        if logged:
+            o.append("code", 10, "    fcf_log_init();")
+        if p.master.get('batch'):
+            o.append("code", 10, "    fcf_at_cycle_end(fcf_flush_batches);")
+        scheduling = p.master.get('scheduling') or {}
+        if scheduling.get('budget_us'):
+            o.append("code", 10, "    fcf_set_cycle_budget(" + str(scheduling['budget_us']) + " * 1000ULL);")
+        # fds take the priority of the module whose init adds them, and USB transfer pools
+        # the depth, so each init runs with the per-thread settings of its module.
+        settings = self.init_settings(scheduling.get('priority') or {}, p.master.get('usb_depth') or {})
+        depends = p.master.get('init_depends')
+        if depends is not None:
+            # Inits run on a thread pool as soon as their dependencies are done,
+            # finals run one after another in reverse dependency order.
+            tokens = [source[0] for source in data]
+            order = self.init_order(tokens, depends)[0]
+            self.init_tasks(tokens, depends, replayed, settings)
+            o.append("code", 10, "    fcf_run_inits(fcf_init_tasks, " + str(len(tokens)) + ", FCF_INIT_THREADS);")
+        else:
+            order = [source[0] for source in data]
+        current = {}
+        for token in order:
+            if token in replayed:
+                if depends is None:
+                    o.append("code", 10, "    /* " + token + " is replayed */")
+                continue
+            if depends is None and 'init' in p.master['modules'][token]:
+                for (setter, value) in settings(token):
+                    if current.get(setter, 0) != value:
+                        current[setter] = value
+                        o.append("code", 10, "    " + setter + "(" + str(value) + ");")
                 o.append("code", 10, "    " + p.master['modules'][token]['init'])
             if "final" in p.master['modules'][token]:
                 finals.append(p.master['modules'][token]['final'])
+        for setter in sorted(current):
+            if current[setter] != 0:
+                o.append("code", 10, "    " + setter + "(0);")
         o.append("code", 10, "}")
         o.append("code", 15, "void fcf_finalize() {")
+        if p.master.get('batch'):
+            # Samples of the last poll cycle.
+            o.append("code", 15, "    fcf_flush_batches();")
         while len(finals) > 0:
             o.append("code", 15, "    " + finals.pop())
+        if logged:
+            o.append("code", 15, "    fcf_log_finalize();")
+        if p.replay:
+            o.append("code", 15, "    fcf_replay_finalize();")
+        if p.trace:
+            o.append("code", 15, "    fcf_trace_finalize();")
         o.append("code", 15, "}")
         return True
 
+    def init_settings(self, priorities, depths):
+        # The per-thread settings of a module's init: (setter, value) pairs, 0 the default.
+        def settings(token):
+            return [("fcf_set_priority", priorities.get(token, 0)),
+                    ("fcf_usb_set_depth", depths.get(token, 0))]
+        return settings
+
+    def init_tasks(self, tokens, depends, replayed, settings):
+        # A wrapper per module init and the task table fcf_run_inits() schedules.
+        # The settings are per thread, so a wrapper sets them around its init.
+        p = self.parser
+        o = p.output
+        tasks = []
+        for token in tokens:
+            module = p.master['modules'][token]
+            init = "NULL"
+            if token in replayed:
+                o.append("code", 8, "/* " + token + " is replayed */")
+            elif 'init' in module:
+                init = "fcf_init_" + token
+                changed = [setter for (setter, value) in settings(token) if value != 0]
+                body = ["    " + setter + "(" + str(value) + ");" for (setter, value) in settings(token) if value != 0]
+                body.append("    " + module['init'])
+                body.extend("    " + setter + "(0);" for setter in changed)
+                o.append("code", 8, "static void " + init + "(void) {\n" + '\n'.join(body) + "\n}")
+            deps = [tokens.index(dep) for dep in depends.get(token) or []]
+            if deps:
+                o.append("code", 8, "static const int fcf_init_deps_" + token + "[] = {" + ', '.join(str(d) for d in deps) + "};")
+            # designated, so that ms and thread, which fcf_run_inits() sets, need no initializers
+            tasks.append('{.name = "' + token + '", .init = ' + init + ', .ndeps = ' + str(len(deps)) +
+                         ', .deps = ' + ('fcf_init_deps_' + token if deps else 'NULL') + '}')
+        o.append("code", 8, "static struct fcf_init_task fcf_init_tasks[] = {\n    " + ',\n    '.join(tasks) + "\n};\n")
+
+
+class Watcher:
+    # Waits for a set of files to change. Their directories are watched with inotify,
+    # which also sees editors that save by renaming a new file over the old one.
+    # Where inotify is not available the modification times are polled.
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    EVENT = struct.Struct('iIII')   # struct inotify_event, without the name
+
+    def __init__(self, interval=0.25, settle=0.05):
+        self.interval = interval    # polling period
+        self.settle = settle        # a save is often several events, wait for the last one
+        self.files = set()
+        self.stamps = {}
+        self.dirs = {}
+        self.libc = None
+        self.fd = -1
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd >= 0:
+                self.libc = libc
+                self.fd = fd
+        except (OSError, AttributeError):
+            pass
+
+    def stamp(self, filename):
+        try:
+            st = os.stat(filename)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def watch(self, filenames):
+        self.files = set(path.abspath(f) for f in filenames)
+        self.stamps = dict((f, self.stamp(f)) for f in self.files)
+        if self.fd < 0:
+            return
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        for directory in set(path.dirname(f) for f in self.files):
+            if directory in self.dirs.values():
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode(), mask)
+            if wd >= 0:
+                self.dirs[wd] = directory
+
+    def events(self, timeout):
+        # Watched files named by the inotify events that arrive within timeout seconds.
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            filename = path.join(self.dirs.get(wd, ''), name)
+            if filename in self.files:
+                changed.add(filename)
+        return changed
+
+    def wait(self):
+        # Blocks until a watched file changes, returns the changed files.
+        if self.fd >= 0:
+            changed = set()
+            while not changed:
+                changed = self.events(None)
+            more = self.events(self.settle)
+            while more:
+                changed |= more
+                more = self.events(self.settle)
+            return changed
+        while True:
+            time.sleep(self.interval)
+            changed = set(f for f in self.files if self.stamp(f) != self.stamps[f])
+            if changed:
+                return changed
+
+def watch(config, miml, modeflags, counts=None, hot_fraction=0.1, replay=False, split=False, trace=False):
+    # Regenerate whenever the config or a MIML file changes. Parsed files stay in a
+    # ModuleCache, so only the files that changed are read again, and outputs that come
+    # out the same are not rewritten. Errors are printed and the watch goes on.
+    cache = ModuleCache()
+    watcher = Watcher()
+    base_dir = path.dirname(miml)
+    while True:
+        start = time.time()
+        files = [config, miml] + ([counts] if counts is not None else [])
+        try:
+            master = cache.load(miml)
+            for source in (master or {}).get('sources') or []:
+                if isinstance(source, list) and len(source) == 2:
+                    files.append(path.join(base_dir, str(source[1])))
+            watcher.watch(files)
+            parser = Parser(cache.load(config), master, modeflags, counts, hot_fraction, replay,
+                            miml_name=miml, base_dir=base_dir, cache=cache, split=split, trace=trace)
+            parser.generate()
+            written = parser.output.write_changed()
+            print ("Regenerated in %.1f ms: %s" % ((time.time() - start) * 1e3,
+                                                  ', '.join(written) if written else "no changes"))
+        except CodeGenError as err:
+            print (err)
+        except yaml.YAMLError as err:
+            print ("YAML parsing error: " + str(err))
+        except (IOError, OSError) as err:
+            print ("File: '" + str(err.filename) + "' cannot be read: " + err.strerror)
+        watcher.watch(files)
+        changed = watcher.wait()
+        print ("Changed: " + ', '.join(sorted(path.relpath(f) for f in changed)))
+
+def modeflags_of(modes):
+    # "cmb" and the like, as on the command line.
+    return dict((flag, flag in modes) for flag in 'cmbg')
+
+def generate(config, miml, modes='cmb', **options):
+    # Generate one binding in memory. config and miml are file names or YAML documents,
+    # options are those of Parser. Returns the text of each mode by mode ('code', 'header',
+    # 'make', 'graph', 'schema'); raises CodeGenError.
+    options.setdefault('quiet', True)
+    return Parser(config, miml, modeflags_of(modes), **options).generate()
+
+def generate_batch(config, variants, modes='cmb', **options):
+    # Generate many bindings in one go: variants maps a name to a master MIML file or
+    # document. The config is read once and module MIML files are parsed once for the
+    # whole batch. Returns the texts of each variant by name; a CodeGenError carries the
+    # name of the variant that failed in its variant attribute.
+    options.setdefault('quiet', True)
+    options.setdefault('cache', ModuleCache())
+    if isinstance(config, str):
+        loader = ErrorLogger(True)
+        if loader.check_file(config):
+            try:
+                config = yaml.safe_load(open(config, 'r'))
+            except Exception as e:
+                loader.new_error("YAML parsing error: " + str(e))
+        loader.check()
+    results = {}
+    for name, miml in variants.items():
+        try:
+            results[name] = generate(config, miml, modes, **options)
+        except CodeGenError as err:
+            err.variant = name
+            raise
+    return results
+
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
     argparser.add_argument('-c', help='c files?', action='store_true')
     argparser.add_argument('-m', help='makefiles?', action='store_true')
     argparser.add_argument('-b', help='headers?', action='store_true')
+    argparser.add_argument('-g', help='message graph report?', action='store_true')
+    argparser.add_argument('--counts', help='YAML file of profiled call counts, marks message functions hot or cold')
+    argparser.add_argument('--hot-fraction', type=float, default=0.1,
+                           help='fraction of the busiest function\'s count that makes a function hot')
+    argparser.add_argument('--replay', action='store_true',
+                           help='replay build: logged messages are read back from a recorded log (FCF_REPLAY)')
+    argparser.add_argument('--trace', action='store_true',
+                           help='trace build: events around every fan-out and receiver call go to FCF_TRACE')
+    argparser.add_argument('--split', action='store_true',
+                           help='write the message functions of each sending module to a file pair of its own')
+    argparser.add_argument('--watch', action='store_true',
+                           help='keep running and regenerate when cg.conf or a MIML file changes')
+    argparser.add_argument('--profile', metavar='FILE',
+                           help='write phase timings, YAML loads, node, handler and fnmatch counts as JSON to FILE (- for stdout)')
+    argparser.add_argument('--pstats', metavar='FILE',
+                           help='run under cProfile and dump its statistics to FILE, for pstats or snakeviz')
     argparser.add_argument('miml', help='Main miml filename')
     args = argparser.parse_args()
 
@@ -509,5 +1992,32 @@ if __name__ == '__main__':
     modeflags['c'] = args.c
     modeflags['m'] = args.m
     modeflags['b'] = args.b
-    parser = Parser('cg.conf', args.miml, modeflags)
-    parser.parse()
+    modeflags['g'] = args.g
+    if args.watch:
+        try:
+            watch('cg.conf', args.miml, modeflags, args.counts, args.hot_fraction, args.replay, args.split, args.trace)
+        except KeyboardInterrupt:
+            sys.exit(0)
+    profile = GenProfile() if args.profile else None
+    if args.pstats:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        parser = Parser('cg.conf', args.miml, modeflags, args.counts, args.hot_fraction, args.replay,
+                        split=args.split, profile=profile, trace=args.trace)
+        parser.parse()
+    except CodeGenError as err:
+        print (err)
+        sys.exit(1)
+    finally:
+        if args.pstats:
+            profiler.disable()
+            profiler.dump_stats(args.pstats)
+    if profile is not None:
+        summary = json.dumps(profile.summary(), indent=1, sort_keys=True)
+        if args.profile == '-':
+            print (summary)
+        else:
+            with open(args.profile, 'w') as f:
+                f.write(summary + '\n')
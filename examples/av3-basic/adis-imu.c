@@ -9,6 +9,7 @@
 #include <stdio.h>
 #include <libusb.h>
 #include "usbutils.h"
+#include "../utils/utils_usbpool.h"
 #include "adis-imu.h"
 #include "logging.h"
 #include "miml.h"
@@ -51,7 +52,6 @@ static int is_adis(libusb_device * device){
 static void common_cb(struct libusb_transfer *transfer, uint32_t fourcc){
     unsigned char *buf = NULL;
     unsigned int act_len;
-    int retErr;
 
     switch(transfer->status){
     case LIBUSB_TRANSFER_COMPLETED:
@@ -63,13 +63,6 @@ static void common_cb(struct libusb_transfer *transfer, uint32_t fourcc){
         }else{
         	FCF_Log(fourcc, buf, act_len);
         }
-        retErr = libusb_submit_transfer(transfer);
-        if(retErr){
-            print_libusb_transfer_error(transfer->status, "adis_cb resub");
-        }
-        break;
-    case LIBUSB_TRANSFER_CANCELLED:
-        //do nothing.
         break;
     default:
         print_libusb_transfer_error(transfer->status, "adis_cb");
@@ -77,7 +70,7 @@ static void common_cb(struct libusb_transfer *transfer, uint32_t fourcc){
     }
 }
 
-static void adis_cb(struct libusb_transfer *transfer){
+static void adis_cb(struct libusb_transfer *transfer, void *data){
     if(transfer->actual_length != ADIS_PACKET_SIZE){
         common_cb(transfer, FOURCC('A','D','I','E'));
     }else{
@@ -89,49 +82,6 @@ static void ctrl_cb(struct libusb_transfer *transfer){
 
 }
 
-static int start_bulk_transfer(libusb_device_handle * handle,
-        unsigned int ep, libusb_transfer_cb_fn cb, void * data,
-        unsigned int timeout)
-{
-    int iso_packets = 0, usb_err, i, num_urbs_in_flight = 1;
-    struct libusb_transfer * trans[num_urbs_in_flight];
-    unsigned char * buf = NULL;
-    int packet_size = ADIS_PACKET_SIZE;//libusb_get_max_iso_packet_size(device, ep);
-    if(packet_size < 0){
-        return packet_size;
-    }
-
-    for(i = 0; i < num_urbs_in_flight; ++i){
-        trans[i] = libusb_alloc_transfer(iso_packets);
-        if(trans[i] == NULL){
-            for(--i; i >= 0; --i){
-                libusb_free_transfer(trans[i]);
-            }
-            return LIBUSB_ERROR_NO_MEM;
-        }
-        buf  = calloc(packet_size, sizeof(unsigned char));
-        if(buf == NULL){
-            for(; i>= 0; --i)
-                libusb_free_transfer(trans[i]);
-            return LIBUSB_ERROR_NO_MEM;
-        }
-        libusb_fill_bulk_transfer(trans[i], handle, ep, buf, packet_size, cb,
-                data, timeout);
-
-        trans[i]->flags = LIBUSB_TRANSFER_FREE_BUFFER;
-        usb_err = libusb_submit_transfer(trans[i]);
-        if(usb_err != 0){
-            for(--i; i >=0; --i){
-                libusb_cancel_transfer(trans[i]);
-                //todo: handle error besides LIBUSB_ERROR_NOT_FOUND for cancel
-                libusb_free_transfer(trans[i]);
-            }
-            return usb_err;
-        }
-    }
-    return 0;
-}
-
 void init_adis_imu(libusbSource * usb_source){
     int iface_nums[1] = {0};
     libusb_device_handle * imu = open_usb_device_handle(usb_source, is_adis,
@@ -148,6 +98,7 @@ void init_adis_imu(libusbSource * usb_source){
     libusb_fill_control_transfer(ctrl, imu, ctrl_buf, ctrl_cb, NULL, 0);
     libusb_submit_transfer(ctrl);
 
-    start_bulk_transfer(imu, BULK0_IN_EP, adis_cb, NULL, 0);
+    fcf_usb_pool_new(libusbSource_get_context(usb_source), imu, BULK0_IN_EP, LIBUSB_TRANSFER_TYPE_BULK,
+            ADIS_PACKET_SIZE, 1, adis_cb, NULL, 0);
 
 }
@@ -55,17 +55,20 @@ void handleErrorPoll(void) {
 int main(int argc, char **argv)
 {
     int opt;
-    while ( (opt = getopt (argc, argv, "g:")) != -1) {
+    while ( (opt = getopt (argc, argv, "g:f:")) != -1) {
         switch (opt) {
         case -1:
             break;
         case 'g':
             set_gps_devicepath (optarg);
             break;
+        case 'f':
+            set_flush_deadline (atoi(optarg));
+            break;
         case 't':
             break;
         default: /* '?' */
-            fprintf(stderr, "Usage: %s [-g Device path]\n",
+            fprintf(stderr, "Usage: %s [-g Device path] [-f Telemetry flush deadline in ms, 0: when full]\n",
                     argv[0]);
             exit(EXIT_FAILURE);
         }
@@ -13,10 +13,29 @@
 #include "miml.h"
 #include "gps.h"
 #include "fcfutils.h"
+#include "../utils/utils_framer.h"
 
 static const char *device = NULL;
 
-static unsigned char buf[4096], *cur = buf;
+/* NovAtel binary logs: "$BIN", a 16-bit block ID (at most 255), a 16-bit
+ * little-endian data length, the data, a 16-bit checksum and "\r\n". The
+ * checksum is passed on with the data; we want to see a frame even if it
+ * is mangled. */
+static const struct fcf_framing novatel_bin = {
+	.name = "novatel_bin",
+	.sync = (const unsigned char *) "$BIN\0\0",
+	.sync_mask = (const unsigned char *) "\xff\xff\xff\xff\x00\xff",
+	.sync_length = 6,
+	.length_offset = 6,
+	.length_width = 2,
+	.header_length = 8,
+	.payload_extra = 2,
+	.trailer = (const unsigned char *) "\r\n",
+	.trailer_length = 2,
+	.max_length = 4096 - 12,
+};
+
+static struct fcf_framer *framer = NULL;
 
 
 void set_gps_devicepath (const char *dev) {
@@ -24,54 +43,10 @@ void set_gps_devicepath (const char *dev) {
 }
 
 
-static void find_frames(void)
+static void gps_frame(void *arg, const unsigned char *frame, const unsigned char *payload, size_t length)
 {
-	unsigned char *pos = buf;
-	while((pos = memchr(pos, '$', cur - pos)))
-	{
-		/* Do we have enough for a complete header? */
-		if(cur - pos < 8)
-			break;
-
-		/* Check the rest of the synchronization string, and
-		 * also reject Block IDs greater than 255. */
-		if(memcmp(pos + 1, "BIN", 3) != 0 || pos[5] != 0)
-		{
-			/* Look for the next possible frame. */
-			++pos;
-			continue;
-		}
-
-		/* Have we finished reading the putative packet? */
-		int data_length = pos[6] | (pos[7] << 8);
-		if(cur - pos < data_length + 12)
-			break;
-
-		/* Check the frame epilogue. Ignore the checksum;
-		 * we want to see this frame even if mangled. */
-		if(memcmp(pos + data_length + 10, "\r\n", 2) != 0)
-		{
-			/* "$BIN" can't match '$' again. */
-			pos += 4;
-			continue;
-		}
-
-		/* Looks valid. Strip the framing and consume it. */
-		//JM write_tagged_message(FOURCC('G', 'P', 'S', pos[4]), pos + 8, data_length + 2);
-		FCF_Log (FOURCC('G', 'P', 'S', pos[4]), pos + 8, data_length + 2);
-		pos += data_length + 12;
-	}
-
-	/* If we can't find another '$', discard the rest of the buffer.
-	 * Otherwise, only discard up to the next '$', and preserve the
-	 * rest for the next round. */
-	if(pos == NULL)
-		cur = buf;
-	else
-	{
-		memmove(buf, pos, cur - pos);
-		cur -= pos - buf;
-	}
+	//JM write_tagged_message(FOURCC('G', 'P', 'S', frame[4]), payload, length);
+	FCF_Log (FOURCC('G', 'P', 'S', frame[4]), payload, length);
 }
 
 
@@ -81,26 +56,13 @@ static int read_gps_cb (struct pollfd *pfd) {
 		return 0;
 	}
 
-	ssize_t nread = read (pfd->fd, cur, sizeof(buf)-(cur-buf));
+	ssize_t nread = fcf_framer_read (framer, pfd->fd);
 
 	if (nread <= 0) {
 		//error or nothing was read
 		return 0;
 	}
 
-//	if (nread == -1) {
-//		//read returned with error
-//		if (errno == EAGAIN) {
-//			//read would block
-//			return 0;
-//		} else {
-//			//other error
-//			return 0;
-//		}
-//	}
-
-	cur += nread;
-	find_frames();
 	return 1;
 }
 
@@ -110,6 +72,12 @@ void init_gps(libusbSource * src)	//TODO FCF struct must not be part of libusbSo
 	if(!device)
 		device = "/dev/usbserial";
 
+	framer = fcf_framer_new (&novatel_bin, 4096, gps_frame, NULL);
+	if (framer == NULL) {
+		fprintf (stderr, "Can't create the GPS framer: %s\n", strerror(errno));
+		return;
+	}
+
 	int fd = open (device, O_RDONLY | O_NONBLOCK);
 	if (fd == -1) {
 		fprintf (stderr, "Can't connect to GPS on %s: %s\n", device, strerror(errno));
@@ -1,3 +1,5 @@
+#define _GNU_SOURCE	/* sendmmsg() */
+
 #include "logging.h"
 
 #include <errno.h>
@@ -7,8 +9,12 @@
 #include <stdlib.h>
 #include <string.h>
 #include <time.h>
+#include <unistd.h>
 #include <netinet/in.h>
+#include <sys/socket.h>
 #include <sys/stat.h>
+#include <sys/timerfd.h>
+#include "fcfutils.h"
 
 #define DEFAULT_LOGDIR "logs"
 #define LOGFILE_DIGITS 3
@@ -18,6 +24,11 @@
 #define UDP_HEADER_SIZE 8
 #define IPv4_MAX_HEADER_SIZE 60
 
+#define SEND_QUEUE 8	/* filled buckets sent with one sendmmsg(2) */
+#ifndef FLUSH_DEADLINE_MS
+#define FLUSH_DEADLINE_MS 20
+#endif
+
 //static gboolean loopback;
 //static gchar *logdir;
 
@@ -47,6 +58,14 @@ static FILE *logfile;
 static int net_fd;
 static struct timespec starttime;
 
+static unsigned int deadline_ms = FLUSH_DEADLINE_MS;
+static int deadline_fd = -1;	/* one-shot, armed by the first record after a send */
+static int stats_fd = -1;	/* fires every second */
+static int pending = 0;		/* records wait for deadline_fd */
+
+static struct logging_stats current;	/* the second in progress */
+static struct logging_stats last_second;
+
 static void open_logfile(void)
 {
 //	if(!logdir)
@@ -103,6 +122,141 @@ static void open_socket(void)
 	connect(net_fd, (struct sockaddr *) &remote, sizeof(struct sockaddr));
 }
 
+struct bucket {
+	uint32_t seq;
+	char buf[LINK_MTU - UDP_HEADER_SIZE - IPv4_MAX_HEADER_SIZE - sizeof(uint32_t)];
+};
+
+/* Filled buckets wait in queue[0..nqueued-1] for send_queue(), queue[nqueued]
+ * is being filled. */
+static struct bucket queue[SEND_QUEUE];
+static size_t queue_len[SEND_QUEUE];
+static int nqueued = 0;
+static uint32_t seq = 0;
+static char *pos = queue[0].buf;
+
+/* Sends the filled buckets, in order, with as few syscalls as the socket takes. */
+static void send_queue(void)
+{
+	struct mmsghdr msgs[SEND_QUEUE];
+	struct iovec iov[SEND_QUEUE];
+
+	memset(msgs, 0, sizeof(msgs));
+	for(int i = 0; i < nqueued; ++i)
+	{
+		iov[i].iov_base = &queue[i];
+		iov[i].iov_len = queue_len[i];
+		msgs[i].msg_hdr.msg_iov = &iov[i];
+		msgs[i].msg_hdr.msg_iovlen = 1;
+	}
+
+	int sent = 0;
+	while(sent < nqueued)
+	{
+		int rc = sendmmsg(net_fd, msgs + sent, nqueued - sent, 0);
+		current.syscalls++;
+		if(rc < 0)
+		{
+			if(errno == EINTR)
+				continue;
+			/* e.g. ECONNREFUSED from an earlier packet, nobody is listening:
+			 * drop the bucket it failed on and go on with the rest. */
+			current.dropped++;
+			sent++;
+			continue;
+		}
+		for(int i = sent; i < sent + rc; ++i)
+		{
+			current.packets++;
+			current.bytes += msgs[i].msg_len;
+		}
+		sent += rc;
+	}
+
+	nqueued = 0;
+	pos = queue[0].buf;
+	fflush(logfile);
+}
+
+/* Queues the bucket being filled, sending the queue when it is full. Without
+ * a deadline nothing else would send it, so full buckets go out at once. */
+static void close_bucket(enum flush_reason reason)
+{
+	if(pos == queue[nqueued].buf)
+		return;
+	queue[nqueued].seq = htonl(seq++);
+	queue_len[nqueued] = pos - (char *) &queue[nqueued];
+	current.flushes[reason]++;
+	if(++nqueued == SEND_QUEUE || deadline_ms == 0)
+		send_queue();
+	pos = queue[nqueued].buf;
+}
+
+static void arm(int fd, unsigned int ms, int periodic)
+{
+	struct itimerspec t = { { 0, 0 }, { ms / 1000, (ms % 1000) * 1000000L } };
+	if(periodic)
+		t.it_interval = t.it_value;
+	timerfd_settime(fd, 0, &t, NULL);
+}
+
+void flush_buffers(void)
+{
+	close_bucket(FLUSH_EXPLICIT);
+	if(nqueued > 0)
+		send_queue();
+	if(pending)
+	{
+		arm(deadline_fd, 0, 0);
+		pending = 0;
+	}
+}
+
+static int deadline_cb(struct pollfd *pfd)
+{
+	uint64_t expirations;
+	if(read(pfd->fd, &expirations, sizeof(expirations)) < 0)
+		return 0;
+	pending = 0;
+	close_bucket(FLUSH_DEADLINE);
+	if(nqueued > 0)
+		send_queue();
+	return 0;
+}
+
+static int stats_cb(struct pollfd *pfd)
+{
+	uint64_t expirations;
+	if(read(pfd->fd, &expirations, sizeof(expirations)) < 0)
+		return 0;
+	last_second = current;
+	memset(&current, 0, sizeof(current));
+
+	struct logging_stats net = {
+		htonl(last_second.packets),
+		htonl(last_second.bytes),
+		htonl(last_second.syscalls),
+		htonl(last_second.dropped),
+		{
+			htonl(last_second.flushes[FLUSH_FULL]),
+			htonl(last_second.flushes[FLUSH_DEADLINE]),
+			htonl(last_second.flushes[FLUSH_EXPLICIT]),
+		},
+	};
+	write_tagged_message(FOURCC('L', 'S', 'T', 'S'), &net, sizeof(net));
+	return 0;
+}
+
+void set_flush_deadline(unsigned int ms)
+{
+	deadline_ms = ms;
+}
+
+void get_logging_stats(struct logging_stats *stats)
+{
+	*stats = last_second;
+}
+
 void init_logging(void)
 {
 	open_logfile();
@@ -110,6 +264,15 @@ void init_logging(void)
 
 	clock_gettime(CLOCK_MONOTONIC, &starttime);
 
+	if(deadline_ms > 0)
+	{
+		deadline_fd = timerfd_create(CLOCK_MONOTONIC, TFD_NONBLOCK);
+		fcf_addfd(deadline_fd, POLLIN, deadline_cb);
+	}
+	stats_fd = timerfd_create(CLOCK_MONOTONIC, TFD_NONBLOCK);
+	arm(stats_fd, 1000, 1);
+	fcf_addfd(stats_fd, POLLIN, stats_cb);
+
 	printf_tagged_message(FOURCC('L', 'O', 'G', 'S'), "initialized");
 	flush_buffers();
 }
@@ -123,22 +286,6 @@ static uint64_t get_timestamp(void)
 	return now.tv_nsec + (uint64_t) now.tv_sec * 1000000000;
 }
 
-static struct {
-	uint32_t seq;
-	char buf[LINK_MTU - UDP_HEADER_SIZE - IPv4_MAX_HEADER_SIZE - sizeof(uint32_t)];
-} bucket = { 0 };
-static char *pos = bucket.buf;
-
-void flush_buffers(void)
-{
-	if(pos == bucket.buf)
-		return;
-	send(net_fd, &bucket, pos - (char *) &bucket, 0);
-	pos = bucket.buf;
-	bucket.seq = htonl(ntohl(bucket.seq) + 1);
-	fflush(logfile);
-}
-
 void write_tagged_message(uint32_t fourcc, const void *buf, uint16_t len)
 {
 	uint64_t timestamp = get_timestamp();
@@ -155,13 +302,19 @@ void write_tagged_message(uint32_t fourcc, const void *buf, uint16_t len)
 		htonl(timestamp),
 	};
 
-	if (pos - (char *) &bucket + sizeof(tag_header) + len > sizeof(bucket))
-		flush_buffers();
+	if (pos - (char *) &queue[nqueued] + sizeof(tag_header) + len > sizeof(struct bucket))
+		close_bucket(FLUSH_FULL);
 	memcpy(pos, &tag_header, sizeof(tag_header));
 	pos += sizeof(tag_header);
 	memcpy(pos, buf, len);
 	pos += len;
 
+	if(!pending && deadline_fd >= 0)
+	{
+		arm(deadline_fd, deadline_ms, 0);
+		pending = 1;
+	}
+
 	fwrite(&tag_header, sizeof(tag_header), 1, logfile);
 	fwrite(buf, len, 1, logfile);
 }
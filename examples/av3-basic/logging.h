@@ -12,7 +12,27 @@
 #define FCF_STRINGIFY(macro_or_string)	FCF_STRINGIFY_ARG (macro_or_string)
 #define	FCF_STRINGIFY_ARG(contents)	#contents
 
+/* Why a bucket was queued for sending. */
+enum flush_reason {
+	FLUSH_FULL,		/* the next record did not fit */
+	FLUSH_DEADLINE,		/* its first record was FLUSH_DEADLINE_MS old */
+	FLUSH_EXPLICIT,		/* flush_buffers() */
+	FLUSH_REASONS
+};
+
+/* Telemetry counts of one second. Also logged every second as an LSTS
+ * record, with each field in network order. */
+struct logging_stats {
+	uint32_t packets;	/* buckets sent */
+	uint32_t bytes;		/* UDP payload bytes sent */
+	uint32_t syscalls;	/* sendmmsg(2) calls */
+	uint32_t dropped;	/* buckets the socket refused */
+	uint32_t flushes[FLUSH_REASONS];
+};
+
 //GOptionGroup *options_logging(void);
+void set_flush_deadline(unsigned int ms);	/* before init_logging(), 0: only flush full buckets */
+void get_logging_stats(struct logging_stats *stats);	/* counts of the last full second */
 void init_logging(void);
 void flush_buffers(void);
 void write_tagged_message(uint32_t fourcc, const void *buf, uint16_t len);
@@ -6,6 +6,7 @@
 #include <stdlib.h>
 #include <stdio.h>
 #include "usbutils.h"
+#include "../utils/utils_usbpool.h"
 #include "mouse2.h"
 #include "miml.h"
 
@@ -36,7 +37,6 @@ static int is_mouse2(libusb_device * device){
 static void common_cb(struct libusb_transfer *transfer, uint32_t fourcc){
     unsigned char *buf = NULL;
     int act_len;
-    int retErr;
 
     switch(transfer->status){
     case LIBUSB_TRANSFER_COMPLETED:
@@ -60,13 +60,6 @@ static void common_cb(struct libusb_transfer *transfer, uint32_t fourcc){
 //                write_tagged_message(fourcc, buf, act_len -1);
 ////            }
 //        }
-        retErr = libusb_submit_transfer(transfer);
-        if(retErr){
-            print_libusb_transfer_error(transfer->status, "common_cb resub");
-        }
-        break;
-    case LIBUSB_TRANSFER_CANCELLED:
-        //do nothing.
         break;
     default:
         print_libusb_transfer_error(transfer->status, "common_cb");
@@ -75,7 +68,7 @@ static void common_cb(struct libusb_transfer *transfer, uint32_t fourcc){
 }
 
 //libusb_transfer has completed
-static void mouse_cb(struct libusb_transfer *transfer){
+static void mouse_cb(struct libusb_transfer *transfer, void *data){
     if(transfer->actual_length != g_packet_size){
         common_cb(transfer, FOURCC('M','S','2','E'));
     }else{
@@ -83,54 +76,6 @@ static void mouse_cb(struct libusb_transfer *transfer){
     }
 }
 
-static int start_mouse_transfer(libusb_device_handle * handle,
-        unsigned int ep, libusb_transfer_cb_fn cb, void * data,
-        unsigned int timeout)
-{
-    int iso_packets = 0, usb_err, i, num_urbs_in_flight = 8;
-
-    num_urbs_in_flight = 1;	//JM
-
-    struct libusb_transfer * trans[num_urbs_in_flight];
-    unsigned char * buf = NULL;
-
-
-    for(i = 0; i < num_urbs_in_flight; ++i){
-        trans[i] = libusb_alloc_transfer(iso_packets);
-        if(trans[i] == NULL){
-            for(--i; i >= 0; --i){
-                libusb_free_transfer(trans[i]);
-            }
-            return LIBUSB_ERROR_NO_MEM;
-        }
-        buf  = calloc(g_packet_size, sizeof(unsigned char));
-        if(buf == NULL){
-            for(; i>= 0; --i)
-                libusb_free_transfer(trans[i]);
-            return LIBUSB_ERROR_NO_MEM;
-        }
-
-        libusb_fill_interrupt_transfer(trans[i], handle, ep, buf, g_packet_size, cb, data, timeout);
-
-        trans[i]->flags = LIBUSB_TRANSFER_FREE_BUFFER;
-        usb_err = libusb_submit_transfer(trans[i]);
-        if(usb_err != 0){
-
-            printf_tagged_message(FOURCC('L', 'O', 'G', 'S'), "\n JM  error ");
-            flush_buffers();
-
-            for(--i; i >=0; --i){
-                libusb_cancel_transfer(trans[i]);
-                //todo: handle error besides LIBUSB_ERROR_NOT_FOUND for cancel
-                libusb_free_transfer(trans[i]);
-            }
-            return usb_err;
-        }
-    }
-    return 0;
-}
-
-
 void init_mouse2(libusbSource * usb_source){
 	int iface_nums[1] = {0};
 	libusb_device_handle * handle = open_usb_device_handle(usb_source, is_mouse2, iface_nums, 1);
@@ -140,5 +85,6 @@ void init_mouse2(libusbSource * usb_source){
 
 	g_packet_size = libusb_get_max_packet_size (libusb_get_device (handle), g_dev_IN_EP);
 
-	start_mouse_transfer(handle, g_dev_IN_EP, mouse_cb, NULL, 0);
+	fcf_usb_pool_new(libusbSource_get_context(usb_source), handle, g_dev_IN_EP, LIBUSB_TRANSFER_TYPE_INTERRUPT,
+			g_packet_size, 1, mouse_cb, NULL, 0);
 }
@@ -9,6 +9,7 @@
 #include <stdio.h>
 #include <libusb.h>
 #include "usbutils.h"
+#include "../utils/utils_usbpool.h"
 #include "theo-imu.h"
 #include "miml.h"
 
@@ -38,6 +39,7 @@
 #define IMU_ADDR(X)             ((X) & 0xF0)
 
 #define IMU_PACKET_SIZE 13
+#define IMU_DEPTH 8		//transfers in flight per endpoint
 #define SENSOR_DATA_OFFSET 6
 
 static int is_imu(libusb_device * device){
@@ -57,7 +59,6 @@ static int is_imu(libusb_device * device){
 static void common_cb(struct libusb_transfer *transfer, uint32_t fourcc){
     unsigned char *buf = NULL;
     unsigned int act_len;
-    int retErr;
 
     switch(transfer->status){
     case LIBUSB_TRANSFER_COMPLETED:
@@ -73,13 +74,6 @@ static void common_cb(struct libusb_transfer *transfer, uint32_t fourcc){
                 FCF_Log(fourcc, buf, act_len - 1);
             }
         }
-        retErr = libusb_submit_transfer(transfer);
-        if(retErr){
-            print_libusb_transfer_error(transfer->status, "imu_cb resub");
-        }
-        break;
-    case LIBUSB_TRANSFER_CANCELLED:
-        //do nothing.
         break;
     default:
         print_libusb_transfer_error(transfer->status, "imu_cb");
@@ -87,28 +81,28 @@ static void common_cb(struct libusb_transfer *transfer, uint32_t fourcc){
     }
 }
 
-static void mag_cb(struct libusb_transfer *transfer){
+static void mag_cb(struct libusb_transfer *transfer, void *data){
     if(transfer->actual_length != IMU_PACKET_SIZE){
         common_cb(transfer, FOURCC('M','A','G','E'));
     }else{
         common_cb(transfer, FOURCC('M','A','G','N'));
     }
 }
-static void acc_cb(struct libusb_transfer *transfer){
+static void acc_cb(struct libusb_transfer *transfer, void *data){
     if(transfer->actual_length != IMU_PACKET_SIZE){
         common_cb(transfer, FOURCC('A','C','C','E'));
     }else{
         common_cb(transfer, FOURCC('A','C','C','L'));
     }
 }
-static void gyr_cb(struct libusb_transfer *transfer){
+static void gyr_cb(struct libusb_transfer *transfer, void *data){
     if(transfer->actual_length != IMU_PACKET_SIZE){
         common_cb(transfer, FOURCC('G','Y','R','E'));
     }else{
         common_cb(transfer, FOURCC('G','Y','R','O'));
     }
 }
-static void cac_cb(struct libusb_transfer *transfer){
+static void cac_cb(struct libusb_transfer *transfer, void *data){
     if(transfer->actual_length != IMU_PACKET_SIZE){
         common_cb(transfer, FOURCC('C','A','C','E'));
     }else{
@@ -120,49 +114,6 @@ static void ctrl_cb(struct libusb_transfer *transfer){
 
 }
 
-static int start_bulk_transfer(libusb_device_handle * handle,
-        unsigned int ep, libusb_transfer_cb_fn cb, void * data,
-        unsigned int timeout)
-{
-    int iso_packets = 0, usb_err, i, num_urbs_in_flight = 8;
-    struct libusb_transfer * trans[num_urbs_in_flight];
-    unsigned char * buf = NULL;
-    int packet_size = IMU_PACKET_SIZE;//libusb_get_max_iso_packet_size(device, ep);
-    if(packet_size < 0){
-        return packet_size;
-    }
-
-    for(i = 0; i < num_urbs_in_flight; ++i){
-        trans[i] = libusb_alloc_transfer(iso_packets);
-        if(trans[i] == NULL){
-            for(--i; i >= 0; --i){
-                libusb_free_transfer(trans[i]);
-            }
-            return LIBUSB_ERROR_NO_MEM;
-        }
-        buf  = calloc(packet_size, sizeof(unsigned char));
-        if(buf == NULL){
-            for(; i>= 0; --i)
-                libusb_free_transfer(trans[i]);
-            return LIBUSB_ERROR_NO_MEM;
-        }
-        libusb_fill_bulk_transfer(trans[i], handle, ep, buf, packet_size, cb,
-                data, timeout);
-
-        trans[i]->flags = LIBUSB_TRANSFER_FREE_BUFFER;
-        usb_err = libusb_submit_transfer(trans[i]);
-        if(usb_err != 0){
-            for(--i; i >=0; --i){
-                libusb_cancel_transfer(trans[i]);
-                //todo: handle error besides LIBUSB_ERROR_NOT_FOUND for cancel
-                libusb_free_transfer(trans[i]);
-            }
-            return usb_err;
-        }
-    }
-    return 0;
-}
-
 void init_theo_imu(libusbSource * usb_source){
     int iface_nums[1] = {0};
     libusb_device_handle * imu = open_usb_device_handle(usb_source, is_imu,
@@ -179,8 +130,9 @@ void init_theo_imu(libusbSource * usb_source){
     libusb_fill_control_transfer(ctrl, imu, ctrl_buf, ctrl_cb, NULL, 0);
     libusb_submit_transfer(ctrl);
 
-    start_bulk_transfer(imu, MAG_EP, mag_cb, NULL, 0);
-    start_bulk_transfer(imu, GYR_EP, gyr_cb, NULL, 0);
-    start_bulk_transfer(imu, ACC_EP, acc_cb, NULL, 0);
-    start_bulk_transfer(imu, CAC_EP, cac_cb, NULL, 0);
+    libusb_context * context = libusbSource_get_context(usb_source);
+    fcf_usb_pool_new(context, imu, MAG_EP, LIBUSB_TRANSFER_TYPE_BULK, IMU_PACKET_SIZE, IMU_DEPTH, mag_cb, NULL, 0);
+    fcf_usb_pool_new(context, imu, GYR_EP, LIBUSB_TRANSFER_TYPE_BULK, IMU_PACKET_SIZE, IMU_DEPTH, gyr_cb, NULL, 0);
+    fcf_usb_pool_new(context, imu, ACC_EP, LIBUSB_TRANSFER_TYPE_BULK, IMU_PACKET_SIZE, IMU_DEPTH, acc_cb, NULL, 0);
+    fcf_usb_pool_new(context, imu, CAC_EP, LIBUSB_TRANSFER_TYPE_BULK, IMU_PACKET_SIZE, IMU_DEPTH, cac_cb, NULL, 0);
 }
@@ -96,6 +96,10 @@ libusbSource * libusbSource_new(void){
 }
 
 
+libusb_context * libusbSource_get_context(libusbSource * usb_source){
+	return usb_source->context;
+}
+
 static libusb_device * find_usb_device(libusbSource * usb_source, is_device is_device){
 	libusb_device **list = NULL;
 	libusb_device *found = NULL;
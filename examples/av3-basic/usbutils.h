@@ -17,6 +17,7 @@ typedef struct libusbSource libusbSource;
 
 
 libusbSource * libusbSource_new(void);
+libusb_context * libusbSource_get_context(libusbSource * usb_source);
 libusb_device_handle * open_usb_device_handle(libusbSource * usb_source,
     is_device is_device, int * iface_num, int num_ifaces);
 void print_libusb_error(int libusberrno, const char* str);
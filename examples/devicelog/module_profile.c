@@ -8,13 +8,15 @@
 #include <unistd.h>
 #include <poll.h>
 #include "module_profile.h"
-#include "fcfutils.h"
+#include "../../fcfutils.h"
+#include "fcfmain.h"	// struct profile_payload, build with MAINMIML=Profile.miml
 
 #define MAX_COUNT 10000000	//!< negative value indicates indefinite MAX_COUNT
 static const int PROFILEMODE = 1;
 
 static unsigned long int count = 0; //!< The number of times the loop has run.
 static unsigned char buf[1024];
+static struct profile_payload payload;
 static int fd = -1;	//!< timer fd
 static struct itimerspec t;
 static struct timeval start;
@@ -54,6 +56,46 @@ static void profiling3_cb (struct pollfd * pfd) {
 	sendMessage_profile3 (x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x,x);	//send messages
 }
 
+/**
+ * Like profiling3_cb but sends the values in a struct.
+ * Every receiver gets the same pointer, nothing is copied.
+ */
+static void profiling4_cb (struct pollfd * pfd) {
+	for (int i = 0; i < 26; i++) {
+		payload.values[i] = pfd->revents;
+	}
+	sendMessage_profile4 (&payload);	//send messages
+}
+
+/**
+ * Like profiling2_cb but sends the data in a pooled buffer.
+ * Receivers get a reference instead of a copy.
+ */
+static void profiling5_cb (struct pollfd * pfd) {
+	struct fcf_buf *pooled = fcf_buf_alloc();
+	if (pooled == NULL) {
+		return;
+	}
+	for (int i = 0; i < 64; i++) {
+		pooled->data[i] = pfd->revents;
+	}
+	pooled->length = 64;
+	sendMessage_profile5 (pooled);	//send messages, and our reference with them
+}
+
+/**
+ * Like profiling4_cb but sends 8 samples per callback, as a USB source
+ * with several transfers in flight does. They are delivered as one batch.
+ */
+static void profiling6_cb (struct pollfd * pfd) {
+	for (int n = 0; n < 8; n++) {
+		for (int i = 0; i < 26; i++) {
+			payload.values[i] = pfd->revents + n;
+		}
+		sendMessage_profile6 (&payload);	//collected until the end of the poll cycle
+	}
+}
+
 
 /**
  * Receive the message. If we've received MAX_COUNT, stop the loop.
@@ -84,6 +126,55 @@ void getMessage_profile3(int a, int b, int c, int d, int e, int f, int g, int h,
 }
 
 
+/**
+ * Receive the struct message. If we've received MAX_COUNT, stop the loop.
+ * @fm getMessage_profile4
+ * @param payload shared with every other receiver, read only
+ * @return
+ */
+void getMessage_profile4(const struct profile_payload *payload) {
+	int value = 0;
+	for (int i = 0; i < 26; i++) {
+		value += payload->values[i];
+	}
+	getMessage_profile(NULL, value);	//increase count
+}
+
+
+/**
+ * Receive the pooled buffer message. If we've received MAX_COUNT, stop the loop.
+ * @fm getMessage_profile5
+ * @param buf our reference to the buffer, released when done
+ * @return
+ */
+void getMessage_profile5(struct fcf_buf *buf) {
+	int value = 0;
+	for (int i = 0; i < buf->length; i++) {
+		value += buf->data[i];
+	}
+	fcf_buf_unref(buf);
+	getMessage_profile(NULL, value);	//increase count
+}
+
+
+/**
+ * Receive a batch of samples; each counts as a message.
+ * @fm getMessage_profile6
+ * @param samples the samples of a poll cycle, read only
+ * @param count number of samples
+ * @return
+ */
+void getMessage_profile6(const struct profile_payload *samples, int count) {
+	for (int n = 0; n < count; n++) {
+		int value = 0;
+		for (int i = 0; i < 26; i++) {
+			value += samples[n].values[i];
+		}
+		getMessage_profile(NULL, value);	//increase count
+	}
+}
+
+
 /**
  * Initialize the profiling system.
  * @fn init_profiling
@@ -109,7 +200,11 @@ void init_profiling() {
 		cb = profiling2_cb;
 		break;
 	case 3:
-		cb = profiling3_cb;
+	case 4:
+	case 5:
+	case 6:
+		cb = PROFILEMODE == 3 ? profiling3_cb : PROFILEMODE == 4 ? profiling4_cb :
+		     PROFILEMODE == 5 ? profiling5_cb : profiling6_cb;
 		for (int i = 0; i < 100; i++) {
 			//add dummy fds that will be looped over in main loop
 			//poll(2) ignores fds < 0
@@ -133,7 +228,7 @@ void finalize_profiling() {
 	struct timeval diff;
 	timersub(&end, &start, &diff);
 
-	printf("\n\nFinished with count: %lu in %ld.%ld sec\n\n", count, diff.tv_sec, diff.tv_usec);
+	printf("\n\nFinished with count: %lu in %ld.%06ld sec\n\n", count, diff.tv_sec, diff.tv_usec);
 
 	if (fd >= 0) {
 		fcf_remove_fd(fd);
@@ -6,9 +6,10 @@
 #include <unistd.h>
 #include <errno.h>
 #include <string.h>
+#include <arpa/inet.h>
 
 #include "module_virtdev.h"
-#include "../../utils_sockets.h"
+#include "../utils/utils_sockets.h"
 #include "../../fcfutils.h"
 
 static unsigned char buffer[1000];
@@ -17,11 +18,20 @@ static int fd_acc = -1;
 static const char *VIRT_GYR = "virt_gyr";
 static const char *VIRT_ACC = "virt_acc";
 
+// Packets of profiler/loadgen.py start with the number of the virtual device
+// and a sequence number, both 32-bit big-endian.
+#define STAMP_SIZE 8
+
 
 static int common_cb(const char *src, int fd){
 	int rc = readsocket(fd, buffer, sizeof(buffer));
 	if (rc > 0) {
 		sendMessage_virtdev(src, buffer, rc);
+		if (rc >= STAMP_SIZE) {
+			uint32_t stamp[2];
+			memcpy(stamp, buffer, sizeof(stamp));
+			sendStamp_virtdev(ntohl(stamp[0]), ntohl(stamp[1]), rc);
+		}
 	}
 	return rc;
 }
@@ -7,8 +7,13 @@
 #ifndef VIRTDEVSRV_H_
 #define VIRTDEVSRV_H_
 
+#include <stdint.h>
+
 void init_virtdev(void); // [miml:init]
 void finalize_virtdev(void); // [miml:final]
 extern void sendMessage_virtdev(const char * src, unsigned char *buffer, int length); // [miml:sender]
+// Device and sequence number of every packet of profiler/loadgen.py, for its
+// loss count; log it (see Load.miml) to measure a build's capacity.
+extern void sendStamp_virtdev(int32_t device, int32_t seq, int32_t length); // [miml:sender]
 
 #endif /* VIRTDEVSRV_H_ */
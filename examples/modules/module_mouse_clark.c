@@ -15,12 +15,11 @@ static const int PID = 0x0252;
 static const int EPT = 0x81;
 
 static libusb_device_handle *handle = NULL;
-static struct libusb_transfer *transfer = NULL;
+static struct fcf_usb_pool *pool = NULL;
 
-static void data_callback(struct libusb_transfer *transfer){
+static void data_callback(struct libusb_transfer *transfer, void *data){
 	unsigned char *buf = NULL;
     int act_len;
-    int retErr;
 
 	switch(transfer->status){
     case LIBUSB_TRANSFER_COMPLETED:
@@ -28,12 +27,6 @@ static void data_callback(struct libusb_transfer *transfer){
         buf = transfer->buffer;
         act_len = transfer->actual_length;
 
-        retErr = libusb_submit_transfer(transfer);
-
-		if(retErr){
-            // Error statement
-        }
-
 		// Call to CGS mouse handler.
 		sendMessage_mouse_clark("mouse_clark", buf, act_len);
 
@@ -53,13 +46,13 @@ void init_mouse_clark() {
 	handle = open_device("mouse_clark", VID, PID);
 
 	if (handle != NULL) {
-		transfer = start_usb_interrupt_transfer(handle, EPT, data_callback, NULL, -1, 0);
+		pool = start_usb_transfers(handle, EPT, LIBUSB_TRANSFER_TYPE_INTERRUPT, data_callback, NULL, -1, 0);
 	}
 }
 
 void finalize_mouse_clark() {
-	cancel_transfer(transfer);
+	stop_usb_transfers("mouse_clark", pool);
 	close_device(handle);
 	handle = NULL;
-	transfer = NULL;
+	pool = NULL;
 }
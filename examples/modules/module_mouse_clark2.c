@@ -15,25 +15,20 @@ static const int PID = 0x000a;
 static const int EPT = 0x81;
 
 static libusb_device_handle *handle = NULL;
-static struct libusb_transfer *transfer = NULL;
+static struct fcf_usb_pool *pool = NULL;
 
 
 /**	START FUNCTIONS */
 
-static void data_callback(struct libusb_transfer *transfer){
+static void data_callback(struct libusb_transfer *transfer, void *data){
 	unsigned char *buf = NULL;
     int act_len;
-    int retErr;
 
 	switch(transfer->status){
     case LIBUSB_TRANSFER_COMPLETED:
 
         buf = transfer->buffer;
         act_len = transfer->actual_length;
-        retErr = libusb_submit_transfer(transfer);
-		if(retErr){
-            //print_libusb_transfer_error(transfer->status, "common_cb resub");
-        }
 
 		/**
 		*	Data handler:
@@ -57,13 +52,13 @@ void init_mouse_clark2() {
 	handle = open_device("mouse_clark2", VID, PID);
 
 	if (handle != NULL) {
-		transfer = start_usb_interrupt_transfer(handle, EPT, data_callback, NULL, -1, 0);
+		pool = start_usb_transfers(handle, EPT, LIBUSB_TRANSFER_TYPE_INTERRUPT, data_callback, NULL, -1, 0);
 	}
 }
 
 void finalize_mouse_clark2() {
-	cancel_transfer(transfer);
+	stop_usb_transfers("mouse_clark2", pool);
 	close_device(handle);
 	handle = NULL;
-	transfer = NULL;
+	pool = NULL;
 }
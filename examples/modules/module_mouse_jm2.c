@@ -18,12 +18,11 @@ static const int PID = 0x00e1;
 static const int EPT = 0x81;
 
 static libusb_device_handle *handle = NULL;
-static struct libusb_transfer *transfer = NULL;
+static struct fcf_usb_pool *pool = NULL;
 
-static void data_callback(struct libusb_transfer *transfer){
+static void data_callback(struct libusb_transfer *transfer, void *data){
 	unsigned char *buf = NULL;
 	int act_len;
-	int retErr;
 
 	switch(transfer->status){
 	case LIBUSB_TRANSFER_COMPLETED:
@@ -31,13 +30,6 @@ static void data_callback(struct libusb_transfer *transfer){
 		buf = transfer->buffer;
 		act_len = transfer->actual_length;
 
-		retErr = libusb_submit_transfer(transfer);
-		//printf("Data from mouse: %02x \n", (char)buf[0]);
-
-		if(retErr){
-			//print_libusb_transfer_error(transfer->status, "common_cb resub");
-		}
-
 		// Call to CGS mouse handler.
 		sendMessage_mouse_jm2("mouse_jm2", buf, act_len);
 
@@ -61,13 +53,13 @@ void init_mouse_jm2() {
 	libusb_set_debug(context, 3);
 	handle = open_device("mouse_jm2", VID, PID);
 	if (handle != NULL) {
-		transfer = start_usb_interrupt_transfer(handle, EPT, data_callback, NULL, -1, 0);
+		pool = start_usb_transfers(handle, EPT, LIBUSB_TRANSFER_TYPE_INTERRUPT, data_callback, NULL, -1, 0);
 	}
 }
 
 void finalize_mouse_jm2() {
-	cancel_transfer(transfer);
+	stop_usb_transfers("mouse_jm2", pool);
 	close_device(handle);
 	handle = NULL;
-	transfer = NULL;
+	pool = NULL;
 }
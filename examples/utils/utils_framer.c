@@ -0,0 +1,253 @@
+/*
+ * utils_framer.c
+ *
+ * The ring buffer is a memfd mapped twice, back to back: the bytes at
+ * base[tail..tail+used) are contiguous even when they wrap, and so is the
+ * free space after them. A partial frame stays where it is until the rest
+ * arrives, and is not looked at again before it can be complete: each byte
+ * is scanned a bounded number of times, however it is split into reads.
+ */
+
+#define _GNU_SOURCE	/* memfd_create() */
+
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include "utils_framer.h"
+
+struct fcf_framer {
+	const struct fcf_framing *framing;
+	unsigned char *base;	/* size bytes, mapped at base and base + size */
+	size_t size;
+	size_t tail;		/* first unconsumed byte, < size */
+	size_t used;		/* unconsumed bytes */
+	size_t min_length;	/* bytes needed to check the sync and read the length */
+	size_t need;		/* parse() has nothing to do with fewer unconsumed bytes */
+	uint64_t sync_word;	/* sync and sync_mask, for sync_length <= 8 */
+	uint64_t sync_mask;
+	fcf_frame_cb cb;
+	void *arg;
+	struct fcf_framer_stats stats;
+};
+
+static size_t frame_length(const struct fcf_framing *f, uint32_t length) {
+	return (size_t) f->header_length + length + f->payload_extra + f->trailer_length;
+}
+
+static uint64_t load64(const unsigned char *p) {
+	uint64_t word;
+	memcpy(&word, p, sizeof(word));
+	return word;
+}
+
+static int sync_matches(const struct fcf_framing *f, uint64_t sync_word, uint64_t sync_mask,
+			const unsigned char *p, const unsigned char *end) {
+	if (sync_mask && end - p >= 8) {
+		return ((load64(p) ^ sync_word) & sync_mask) == 0;
+	}
+	for (int i = 1; i < f->sync_length; i++) {
+		unsigned char mask = f->sync_mask ? f->sync_mask[i] : 0xff;
+		if ((p[i] ^ f->sync[i]) & mask) {
+			return 0;
+		}
+	}
+	return 1;
+}
+
+static uint32_t length_field(const struct fcf_framing *f, const unsigned char *p) {
+	p += f->length_offset;
+	switch (f->length_width) {
+	case 1:
+		return p[0];
+	case 2:
+		return f->length_big_endian ? (p[0] << 8) | p[1] : p[0] | (p[1] << 8);
+	default:
+		return f->length_big_endian ?
+			((uint32_t) p[0] << 24) | (p[1] << 16) | (p[2] << 8) | p[3] :
+			p[0] | (p[1] << 8) | (p[2] << 16) | ((uint32_t) p[3] << 24);
+	}
+}
+
+static int trailer_matches(const struct fcf_framing *f, const unsigned char *p) {
+	for (int i = 0; i < f->trailer_length; i++) {
+		if (p[i] != f->trailer[i]) {
+			return 0;
+		}
+	}
+	return 1;
+}
+
+static void parse(struct fcf_framer *fr) {
+	/* Copies, so the callback does not make the compiler reload them. */
+	const struct fcf_framing framing = *fr->framing, *f = &framing;
+	const uint64_t sync_word = fr->sync_word, sync_mask = fr->sync_mask;
+	const size_t min_length = fr->min_length;
+	const fcf_frame_cb cb = fr->cb;
+	void *const arg = fr->arg;
+	const unsigned char *start = fr->base + fr->tail;
+	const unsigned char *end = start + fr->used;
+	const unsigned char *p = start;
+	size_t framed = 0;
+	uint64_t frames = 0, false_syncs = 0;
+	size_t need = 0;
+
+	while (p < end) {
+		const unsigned char *s = memchr(p, f->sync[0], end - p);
+		if (s == NULL) {
+			p = end;
+			break;
+		}
+		p = s;
+		if ((size_t) (end - p) < min_length) {
+			need = min_length;
+			break;
+		}
+		if (!sync_matches(f, sync_word, sync_mask, p, end)) {
+			p++;
+			continue;
+		}
+		uint32_t length = length_field(f, p);
+		if (length > f->max_length) {
+			false_syncs++;
+			p++;
+			continue;
+		}
+		size_t n = frame_length(f, length);
+		if ((size_t) (end - p) < n) {
+			need = n;	/* wait for the rest */
+			break;
+		}
+		if (!trailer_matches(f, p + n - f->trailer_length)) {
+			false_syncs++;
+			p++;
+			continue;
+		}
+		cb(arg, p, p + f->header_length, length + f->payload_extra);
+		frames++;
+		framed += n;
+		p += n;
+	}
+
+	size_t consumed = p - start;
+	fr->stats.frames += frames;
+	fr->stats.false_syncs += false_syncs;
+	fr->stats.discarded += consumed - framed;
+	fr->tail += consumed;
+	if (fr->tail >= fr->size) {
+		fr->tail -= fr->size;
+	}
+	fr->used -= consumed;
+	fr->need = need;
+}
+
+/* Where the next byte goes. */
+static unsigned char *head(const struct fcf_framer *fr) {
+	size_t offset = fr->tail + fr->used;
+	return fr->base + (offset >= fr->size ? offset - fr->size : offset);
+}
+
+struct fcf_framer *fcf_framer_new(const struct fcf_framing *framing, size_t size, fcf_frame_cb cb, void *arg) {
+	const struct fcf_framing *f = framing;
+	if (f->sync_length < 1 || (f->sync_mask && f->sync_mask[0] != 0xff) ||
+	    !(f->length_width == 1 || f->length_width == 2 || f->length_width == 4) ||
+	    f->length_offset + f->length_width > f->header_length ||
+	    f->sync_length > f->header_length || (f->trailer_length > 0 && f->trailer == NULL)) {
+		return NULL;
+	}
+	long page = sysconf(_SC_PAGESIZE);
+	size = (size + page - 1) / page * page;
+	if (size < frame_length(f, f->max_length)) {
+		return NULL;
+	}
+
+	struct fcf_framer *fr = calloc(1, sizeof(*fr));
+	if (fr == NULL) {
+		return NULL;
+	}
+	int fd = memfd_create("fcf_framer", MFD_CLOEXEC);
+	if (fd < 0 || ftruncate(fd, size) != 0) {
+		goto fail;
+	}
+	/* Reserve both halves, then map the memfd over each. */
+	unsigned char *base = mmap(NULL, 2 * size, PROT_NONE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+	if (base == MAP_FAILED) {
+		goto fail;
+	}
+	if (mmap(base, size, PROT_READ | PROT_WRITE, MAP_SHARED | MAP_FIXED, fd, 0) == MAP_FAILED ||
+	    mmap(base + size, size, PROT_READ | PROT_WRITE, MAP_SHARED | MAP_FIXED, fd, 0) == MAP_FAILED) {
+		munmap(base, 2 * size);
+		goto fail;
+	}
+	close(fd);
+
+	fr->framing = f;
+	fr->base = base;
+	fr->size = size;
+	fr->min_length = f->length_offset + f->length_width;
+	if (fr->min_length < f->sync_length) {
+		fr->min_length = f->sync_length;
+	}
+	if (f->sync_length <= 8) {
+		/* Compared as one word; bytes past the sync are masked out. */
+		unsigned char word[8] = { 0 }, mask[8] = { 0 };
+		memcpy(word, f->sync, f->sync_length);
+		for (int i = 0; i < f->sync_length; i++) {
+			mask[i] = f->sync_mask ? f->sync_mask[i] : 0xff;
+		}
+		fr->sync_word = load64(word);
+		fr->sync_mask = load64(mask);
+	}
+	fr->cb = cb;
+	fr->arg = arg;
+	return fr;
+
+fail:
+	if (fd >= 0) {
+		close(fd);
+	}
+	free(fr);
+	return NULL;
+}
+
+ssize_t fcf_framer_read(struct fcf_framer *fr, int fd) {
+	ssize_t n = read(fd, head(fr), fr->size - fr->used);
+	if (n > 0) {
+		fr->used += n;
+		fr->stats.bytes += n;
+		if (fr->used >= fr->need) {
+			parse(fr);
+		}
+	}
+	return n;
+}
+
+void fcf_framer_feed(struct fcf_framer *fr, const void *data, size_t len) {
+	const unsigned char *src = data;
+	while (len > 0) {
+		size_t n = fr->size - fr->used;
+		if (n > len) {
+			n = len;
+		}
+		memcpy(head(fr), src, n);
+		fr->used += n;
+		fr->stats.bytes += n;
+		src += n;
+		len -= n;
+		if (fr->used >= fr->need) {
+			parse(fr);
+		}
+	}
+}
+
+void fcf_framer_stats(const struct fcf_framer *fr, struct fcf_framer_stats *stats) {
+	*stats = fr->stats;
+}
+
+void fcf_framer_free(struct fcf_framer *fr) {
+	if (fr == NULL) {
+		return;
+	}
+	munmap(fr->base, 2 * fr->size);
+	free(fr);
+}
@@ -0,0 +1,81 @@
+/*
+ * utils_framer.h
+ *
+ * Framer of binary serial protocols whose frames are sync bytes, a header
+ * with a length field, the payload and an optional trailer, like NovAtel's
+ * "$BIN" logs. Bytes are read into a ring buffer that is mapped twice in a
+ * row, so every frame is contiguous in memory and is passed to the callback
+ * in place; consumed bytes are never moved. Garbage between frames is
+ * skipped with one memchr() per candidate sync byte.
+ *
+ * A protocol is a struct fcf_framing. Module MIML files can declare theirs
+ * under "framing:" and codeGen.py generates the table as fcf_framing_<name>.
+ */
+
+#ifndef UTILS_FRAMER_H_
+#define UTILS_FRAMER_H_
+
+#include <stddef.h>
+#include <stdint.h>
+#include <sys/types.h>
+
+/**
+ * Frame layout: sync, the rest of the header, payload_extra + length payload
+ * bytes, trailer.
+ */
+struct fcf_framing {
+	const char *name;
+	const unsigned char *sync;	//!< first bytes of every frame
+	const unsigned char *sync_mask;	//!< per sync byte, 0xff: must match, 0x00: any; NULL for all 0xff. Byte 0 must match.
+	uint8_t sync_length;
+	uint8_t length_offset;	//!< of the length field, from the start of the frame
+	uint8_t length_width;	//!< 1, 2 or 4 bytes
+	uint8_t length_big_endian;
+	uint16_t header_length;	//!< the payload starts here
+	uint16_t payload_extra;	//!< payload bytes the length does not count, e.g. a checksum
+	const unsigned char *trailer;	//!< last bytes of every frame, NULL for none
+	uint8_t trailer_length;
+	uint32_t max_length;	//!< longer length fields are taken for garbage
+};
+
+struct fcf_framer_stats {
+	uint64_t bytes;		//!< bytes read or fed
+	uint64_t frames;	//!< frames passed to the callback
+	uint64_t discarded;	//!< bytes skipped as garbage
+	uint64_t false_syncs;	//!< sync matches rejected by their length or trailer
+};
+
+/**
+ * Called for every frame, in place in the ring buffer.
+ * @param arg the framer's arg
+ * @param frame first byte of the frame (the sync)
+ * @param payload frame + header_length
+ * @param length payload length, payload_extra included
+ */
+typedef void (*fcf_frame_cb)(void *arg, const unsigned char *frame, const unsigned char *payload, size_t length);
+
+struct fcf_framer;
+
+/**
+ * @param framing protocol, must outlive the framer
+ * @param size ring buffer size, rounded up to whole pages; at least the longest frame
+ * @return NULL if the framing is invalid or the buffer cannot be mapped
+ */
+struct fcf_framer *fcf_framer_new(const struct fcf_framing *framing, size_t size, fcf_frame_cb cb, void *arg);
+
+/**
+ * read(2) as much of fd as fits in the ring buffer and pass on the frames.
+ * @return what read(2) returned
+ */
+ssize_t fcf_framer_read(struct fcf_framer *framer, int fd);
+
+/**
+ * Copy len bytes into the ring buffer and pass on the frames.
+ */
+void fcf_framer_feed(struct fcf_framer *framer, const void *data, size_t len);
+
+void fcf_framer_stats(const struct fcf_framer *framer, struct fcf_framer_stats *stats);
+
+void fcf_framer_free(struct fcf_framer *framer);
+
+#endif /* UTILS_FRAMER_H_ */
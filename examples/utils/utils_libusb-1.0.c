@@ -5,15 +5,21 @@
 */
 
 #include <sys/time.h>
+#include <pthread.h>
 #include <stdlib.h>
 #include <stdio.h>
 #include <libusb-1.0/libusb.h>
 #include <unistd.h>
 
 #include "fcfutils.h"
+#include "utils_usbpool.h"
+#include "utils_libusb-1.0.h"
 
 static libusb_context *context = NULL;
 static int opencount = 0;
+// Module inits may run concurrently (init_depends), so the shared context and
+// the count of open devices are only touched with this held.
+static pthread_mutex_t usb_lock = PTHREAD_MUTEX_INITIALIZER;
 
 static struct timeval nonblocking = {
 		.tv_sec = 0,
@@ -45,41 +51,17 @@ static void usb_fd_removed_cb(int fd, void* source){
 	fcf_remove_fd (fd);
 }
 
-struct libusb_transfer * start_usb_interrupt_transfer(libusb_device_handle * handle, unsigned int ep,
-		libusb_transfer_cb_fn cb, void * data, int packet_size, unsigned int timeout) {
+struct fcf_usb_pool * start_usb_transfers(libusb_device_handle * handle, unsigned int ep, unsigned char type,
+		fcf_usb_pool_cb cb, void * data, int packet_size, unsigned int timeout) {
 
-	if (packet_size < 0) {
-		//"auto-detect" if not specified
-		packet_size = libusb_get_max_packet_size (libusb_get_device(handle), ep);
-	}
-
-	struct libusb_transfer *transfer = libusb_alloc_transfer(0);
-
-	if(transfer == NULL){
-		libusb_free_transfer(transfer);
-		return NULL;
-	}
-
-	unsigned char *buf  = calloc(packet_size, sizeof(unsigned char));
-
-	if(buf == NULL){
-		libusb_free_transfer(transfer);
-		return NULL;
-	}
-
-	libusb_fill_interrupt_transfer(transfer, handle, ep, buf, packet_size, cb, data, timeout);
-
-	transfer->flags = LIBUSB_TRANSFER_FREE_BUFFER;	// libusb_free_transfer() will free(buf)
-	int usb_err = libusb_submit_transfer(transfer);
+	// depth 0: the module's usb_depth from the master MIML file, or FCF_USB_DEPTH
+	struct fcf_usb_pool *pool = fcf_usb_pool_new(context, handle, ep, type, packet_size, 0, cb, data, timeout);
 
-	if(usb_err != 0){
-		libusb_cancel_transfer(transfer);
-		libusb_free_transfer(transfer);
-		fprintf(stderr, "USB ERROR %d\n", usb_err);
-		return NULL;
+	if(pool == NULL){
+		fprintf(stderr, "USB ERROR: could not start transfers on endpoint 0x%02x\n", ep);
 	}
 
-    return transfer;
+	return pool;
 }
 
 
@@ -150,11 +132,14 @@ static libusb_device * find_device(libusb_device ** devices, int cnt, int vid, i
 
 
 libusb_context * init_libusb(const char *dev_name){
+	libusb_context *ctx;
 
+	pthread_mutex_lock(&usb_lock);
 	if (context == NULL){
 		int rc = libusb_init(&context);
 		if(rc){
 			context = NULL; //reset to NULL, just in case
+			pthread_mutex_unlock(&usb_lock);
 			fprintf(stderr, "[%s] libusb: init failed.\n", dev_name);
 			return NULL;
 		}
@@ -168,22 +153,25 @@ libusb_context * init_libusb(const char *dev_name){
 		}
 		free(fds);
 	}
+	ctx = context;
+	pthread_mutex_unlock(&usb_lock);
 
-	return context;
+	return ctx;
 }
 
 
 libusb_device_handle * open_device (char * dev_name, int vid, int pid) {
 	int cnt = 0;
+	libusb_context *ctx;
 	libusb_device_handle *handle = NULL;
 	libusb_device **devs = NULL, *device = NULL;
 
-	if (init_libusb(dev_name) == NULL) {
+	if ((ctx = init_libusb(dev_name)) == NULL) {
 		return NULL;
 	}
 
 	// Get a list of all the devices. Return on error.
- 	cnt = libusb_get_device_list(context, &devs);
+ 	cnt = libusb_get_device_list(ctx, &devs);
 	if(cnt < 0) {
 		fprintf(stderr, "[%s] libusb: Could not get device list.\n", dev_name);
 		return NULL;
@@ -205,11 +193,14 @@ libusb_device_handle * open_device (char * dev_name, int vid, int pid) {
 	}
 
 	libusb_free_device_list(devs, 1);
+	pthread_mutex_lock(&usb_lock);
 	opencount++;
+	pthread_mutex_unlock(&usb_lock);
 	return handle;
 }
 
 void close_device(libusb_device_handle *handle) {
+	pthread_mutex_lock(&usb_lock);
 	if (handle != NULL) {
 		libusb_close (handle);
 		opencount--;
@@ -218,13 +209,16 @@ void close_device(libusb_device_handle *handle) {
 		libusb_exit (context);
 		context = NULL;
 	}
+	pthread_mutex_unlock(&usb_lock);
 }
 
-void cancel_transfer(struct libusb_transfer *transfer) {
-	if (transfer != NULL) {
-		libusb_cancel_transfer(transfer);
-		libusb_handle_events_timeout(context, &nonblocking);
-		libusb_free_transfer (transfer);
+void stop_usb_transfers(const char *dev_name, struct fcf_usb_pool *pool) {
+	struct fcf_usb_pool_stats stats;
+
+	if (pool != NULL) {
+		fcf_usb_pool_stats(pool, &stats);
+		fprintf(stderr, "[%s] libusb: %lu transfers, %lu gaps, %lu timeouts, %lu errors, %lu resubmit errors\n",
+				dev_name, stats.completions, stats.gaps, stats.timeouts, stats.errors, stats.resubmit_errors);
+		fcf_usb_pool_free(pool);
 	}
 }
-
@@ -6,10 +6,12 @@
 #ifndef UTILS_LIBUSB_H_
 #define UTILS_LIBUSB_H_
 
+#include "utils_usbpool.h"
+
 libusb_context * init_libusb(const char *dev_name);
 libusb_device_handle * open_device (char * dev_name, int vid, int pid);
 void close_device(libusb_device_handle *handle);
-struct libusb_transfer * start_usb_interrupt_transfer(libusb_device_handle * handle, unsigned int ep, libusb_transfer_cb_fn cb, void * data, int packet_size, unsigned int timeout);
-void cancel_transfer(struct libusb_transfer *transfer);
+struct fcf_usb_pool * start_usb_transfers(libusb_device_handle * handle, unsigned int ep, unsigned char type, fcf_usb_pool_cb cb, void * data, int packet_size, unsigned int timeout);
+void stop_usb_transfers(const char *dev_name, struct fcf_usb_pool *pool);
 
 #endif /* UTILS_LIBUSB_H_ */
@@ -0,0 +1,128 @@
+/*
+ * utils_log.c
+ *
+ * Bucketed writer of tagged log records, after av3-basic's logging.c.
+ * Unlike write_tagged_message(), callers fill the payload in place: the
+ * bucket is the only copy of a record until it is flushed.
+ */
+
+#include <errno.h>
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <netinet/in.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include "utils_log.h"
+#include "../../fcfutils.h"
+
+#ifndef FCF_LOG_DIR
+#define FCF_LOG_DIR "logs"
+#endif
+#define LOGFILE_ATTEMPTS 1000
+#define REMOTE_PORT 5005
+
+#define LINK_MTU 1500
+#define UDP_HEADER_SIZE 8
+#define IPv4_MAX_HEADER_SIZE 60
+
+struct tag_header {
+	uint32_t fourcc;
+	uint16_t length;
+	uint16_t timestamp_hi;
+	uint32_t timestamp_lo;
+} __attribute__((packed));
+
+static FILE *logfile = NULL;
+static int net_fd = -1;
+static uint64_t starttime;	//< fcf_clock_ns() at fcf_log_init(), virtual under replay
+
+static struct {
+	uint32_t seq;
+	char buf[LINK_MTU - UDP_HEADER_SIZE - IPv4_MAX_HEADER_SIZE - sizeof(uint32_t)];
+} bucket = { 0 };
+static char *pos = bucket.buf;
+
+static int open_logfile(void) {
+	char name[sizeof(FCF_LOG_DIR) + 8];
+
+	/* Try to create the log directory, problems show up below. */
+	mkdir(FCF_LOG_DIR, 0777);
+	for (int i = 0; i < LOGFILE_ATTEMPTS; i++) {
+		snprintf(name, sizeof(name), "%s/%03d", FCF_LOG_DIR, i);
+		int fd = open(name, O_WRONLY | O_CREAT | O_EXCL, 0444);
+		if (fd == -1) {
+			if (errno == EEXIST || errno == EISDIR) {
+				continue;
+			}
+			fprintf(stderr, "fcf_log_init: cannot create logfile %s: %s\n", name, strerror(errno));
+			return -1;
+		}
+		logfile = fdopen(fd, "w");
+		return 0;
+	}
+	fprintf(stderr, "fcf_log_init: no free logfile name in %s\n", FCF_LOG_DIR);
+	return -1;
+}
+
+static void open_socket(void) {
+	struct sockaddr_in remote = { AF_INET };
+
+	net_fd = socket(AF_INET, SOCK_DGRAM, 0);
+	remote.sin_port = htons(REMOTE_PORT);
+	remote.sin_addr.s_addr = htonl(INADDR_LOOPBACK);
+	connect(net_fd, (struct sockaddr *) &remote, sizeof(remote));
+}
+
+int fcf_log_init(void) {
+	if (open_logfile() != 0) {
+		return -1;
+	}
+	open_socket();
+	starttime = fcf_clock_ns();
+	return 0;
+}
+
+void *fcf_log_reserve(uint32_t fourcc, uint16_t len) {
+	if (logfile == NULL || sizeof(struct tag_header) + len > sizeof(bucket.buf)) {
+		return NULL;
+	}
+	if (pos + sizeof(struct tag_header) + len > bucket.buf + sizeof(bucket.buf)) {
+		fcf_log_flush();
+	}
+
+	uint64_t timestamp = fcf_clock_ns() - starttime;
+	struct tag_header *header = (struct tag_header *) pos;
+	header->fourcc = fourcc;
+	header->length = htons(len);
+	header->timestamp_hi = htons(timestamp >> 32);
+	header->timestamp_lo = htonl(timestamp);
+	pos += sizeof(struct tag_header);
+
+	void *payload = pos;
+	pos += len;
+	return payload;
+}
+
+void fcf_log_flush(void) {
+	if (pos == bucket.buf) {
+		return;
+	}
+	send(net_fd, &bucket, pos - (char *) &bucket, 0);
+	fwrite(bucket.buf, pos - bucket.buf, 1, logfile);
+	pos = bucket.buf;
+	bucket.seq = htonl(ntohl(bucket.seq) + 1);
+}
+
+void fcf_log_finalize(void) {
+	if (logfile == NULL) {
+		return;
+	}
+	fcf_log_flush();
+	fclose(logfile);
+	logfile = NULL;
+	close(net_fd);
+	net_fd = -1;
+}
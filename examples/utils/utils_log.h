@@ -0,0 +1,48 @@
+/*
+ * utils_log.h
+ *
+ * Tagged binary log, in the record format of av3-basic's logging.c:
+ * fourcc, 16-bit length and 48-bit timestamp (fcf_clock_ns() since
+ * fcf_log_init), big-endian, then the payload. Records are collected in a
+ * bucket that is sent as one UDP datagram, led by a 32-bit sequence number,
+ * and appended to the log file when full or flushed.
+ *
+ * codeGen.py generates typed serializers for messages listed under "logged:"
+ * in the master MIML file; they fill the payload returned by fcf_log_reserve().
+ */
+
+#ifndef UTILS_LOG_H_
+#define UTILS_LOG_H_
+
+#include <stddef.h>
+#include <stdint.h>
+#include <arpa/inet.h>
+
+#define FCF_FOURCC(a,b,c,d) htonl(((uint32_t)(a) << 24) | ((b) << 16) | ((c) << 8) | (d))
+
+/**
+ * Open a new log file in FCF_LOG_DIR and the UDP socket.
+ * @return 0 on success, -1 if logging is disabled
+ */
+int fcf_log_init(void);
+
+/**
+ * Write the header of a record and reserve its payload in the bucket.
+ * @param fourcc tag of the record, in network order (see FCF_FOURCC)
+ * @param len payload length in bytes
+ * @return where to store the payload, NULL if logging is disabled or the
+ *         record does not fit in a bucket
+ */
+void *fcf_log_reserve(uint32_t fourcc, uint16_t len);
+
+/**
+ * Send the bucket and append it to the log file.
+ */
+void fcf_log_flush(void);
+
+/**
+ * Flush, then close the log file and the socket.
+ */
+void fcf_log_finalize(void);
+
+#endif /* UTILS_LOG_H_ */
@@ -0,0 +1,120 @@
+/*
+ * utils_replay.c
+ *
+ * The replay source is an eventfd that is always readable, so poll(2) never
+ * blocks on it. Each callback sends the next REPLAY_BATCH records, setting the
+ * virtual clock to every record's timestamp before it is sent.
+ */
+
+#include <fcntl.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include <arpa/inet.h>
+#include <sys/eventfd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include "utils_replay.h"
+#include "../../fcfutils.h"
+
+#define REPLAY_DEFAULT "replay.log"
+#define REPLAY_BATCH 64	//!< records sent per poll cycle
+
+struct tag_header {
+	uint32_t fourcc;
+	uint16_t length;
+	uint16_t timestamp_hi;
+	uint32_t timestamp_lo;
+} __attribute__((packed));
+
+static const char *path = NULL;
+static const unsigned char *log_data = MAP_FAILED;
+static size_t log_size = 0;
+static size_t pos = 0;
+static int fd = -1;	//!< eventfd of the replay source
+static fcf_replay_dispatch dispatch = NULL;
+
+static unsigned long sent = 0;
+static unsigned long skipped = 0;
+static uint64_t last_timestamp = 0;
+static struct timespec start;
+
+static void replay_cb(struct pollfd *pfd) {
+	for (int i = 0; i < REPLAY_BATCH; i++) {
+		struct tag_header header;
+		if (pos + sizeof(header) > log_size) {
+			fcf_stop_main_loop();
+			return;
+		}
+		memcpy(&header, log_data + pos, sizeof(header));
+		uint16_t length = ntohs(header.length);
+		if (pos + sizeof(header) + length > log_size) {
+			fprintf(stderr, "replay: %s ends in a truncated record\n", path);
+			pos = log_size;
+			fcf_stop_main_loop();
+			return;
+		}
+		last_timestamp = ((uint64_t) ntohs(header.timestamp_hi) << 32) | ntohl(header.timestamp_lo);
+		fcf_clock_set_virtual(last_timestamp);
+		if (dispatch(header.fourcc, log_data + pos + sizeof(header), length)) {
+			sent++;
+		} else {
+			skipped++;
+		}
+		pos += sizeof(header) + length;
+	}
+}
+
+void fcf_replay_init(fcf_replay_dispatch replay_dispatch) {
+	struct stat st;
+
+	path = getenv("FCF_REPLAY");
+	if (path == NULL) {
+		path = REPLAY_DEFAULT;
+	}
+	int log_fd = open(path, O_RDONLY);
+	if (log_fd < 0 || fstat(log_fd, &st) != 0) {
+		perror("replay: cannot open log (set FCF_REPLAY)");
+		exit(EXIT_FAILURE);
+	}
+	log_size = st.st_size;
+	if (log_size > 0) {
+		log_data = mmap(NULL, log_size, PROT_READ, MAP_PRIVATE, log_fd, 0);
+	}
+	close(log_fd);
+	if (log_size > 0 && log_data == MAP_FAILED) {
+		perror("replay: cannot map log");
+		exit(EXIT_FAILURE);
+	}
+
+	dispatch = replay_dispatch;
+	pos = 0;
+	fcf_clock_set_virtual(0);
+	clock_gettime(CLOCK_MONOTONIC, &start);
+
+	fd = eventfd(1, 0);
+	fcf_add_fd(fd, POLLIN, replay_cb);
+	printf("\nreplaying %s (%zu bytes)\n", path, log_size);
+}
+
+void fcf_replay_finalize(void) {
+	struct timespec end;
+
+	if (fd < 0) {
+		return;
+	}
+	clock_gettime(CLOCK_MONOTONIC, &end);
+	double wall = (end.tv_sec - start.tv_sec) + (end.tv_nsec - start.tv_nsec) / 1e9;
+	printf("\nReplayed %lu records (%lu skipped) of %.3f sec flight time in %.3f sec, %.0f records/sec\n",
+	       sent, skipped, last_timestamp / 1e9, wall, wall > 0 ? (sent + skipped) / wall : 0.0);
+
+	fcf_remove_fd(fd);
+	close(fd);
+	fd = -1;
+	if (log_data != MAP_FAILED) {
+		munmap((void *) log_data, log_size);
+		log_data = MAP_FAILED;
+	}
+}
@@ -0,0 +1,42 @@
+/*
+ * utils_replay.h
+ *
+ * Replay source: feeds the records of a recorded log (see utils_log.h) back
+ * into fc as the messages that logged them, as fast as the poll loop runs.
+ * The framework clock follows the record timestamps (fcf_clock_set_virtual),
+ * so a replay does not depend on the speed of the machine it runs on.
+ *
+ * codeGen.py --replay generates the dispatch function from the "logged:"
+ * section of the master MIML file and calls fcf_replay_init() first thing in
+ * fcf_initialize().
+ */
+
+#ifndef UTILS_REPLAY_H_
+#define UTILS_REPLAY_H_
+
+#include <stdint.h>
+
+/**
+ * Calls the sender of a record.
+ * @param fourcc tag of the record, in network order
+ * @param payload the record's payload
+ * @param length payload length in bytes
+ * @return 1 if the record was sent, 0 if the binding does not log this fourcc
+ */
+typedef int (*fcf_replay_dispatch)(uint32_t fourcc, const void *payload, uint16_t length);
+
+/**
+ * Map the log named by the FCF_REPLAY environment variable (default
+ * "replay.log"), switch to the virtual clock and register the replay source
+ * with the poll loop. The loop is stopped after the last record. Exits if the
+ * log cannot be read, since a replay has nothing else to run.
+ * @param dispatch generated dispatch function
+ */
+void fcf_replay_init(fcf_replay_dispatch dispatch);
+
+/**
+ * Print the replay statistics and unmap the log.
+ */
+void fcf_replay_finalize(void);
+
+#endif /* UTILS_REPLAY_H_ */
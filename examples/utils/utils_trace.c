@@ -0,0 +1,92 @@
+/*
+ * utils_trace.c
+ *
+ * The rings of all threads are kept on a list, pushed with a compare and
+ * swap, so a thread's first event takes no lock either. A ring is only
+ * written by its thread; fcf_trace_finalize() reads each head once.
+ */
+
+#include <errno.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include "utils_trace.h"
+
+#define TRACE_MAGIC "FCFTRACE"
+#define TRACE_VERSION 1
+
+/** Header of the trace file, followed by its events, thread by thread, oldest first. */
+struct trace_header {
+	char magic[8];
+	uint32_t version;
+	uint32_t event_size;
+	uint64_t events;	//!< in the file
+	uint64_t overwritten;	//!< events the rings had no room for
+} __attribute__((packed));
+
+__thread struct fcf_trace_ring *fcf_trace_ring;
+
+static struct fcf_trace_ring *rings;	//< all rings, newest first
+static int threads;
+static struct fcf_trace_ring lost;	//< shared by threads whose ring could not be allocated, never written out
+
+struct fcf_trace_ring *fcf_trace_ring_new(void) {
+	struct fcf_trace_ring *ring = calloc(1, sizeof(*ring));
+
+	if (ring == NULL) {
+		fprintf(stderr, "fcf_trace: no memory for the ring of a thread, its events are lost\n");
+		fcf_trace_ring = &lost;
+		return &lost;
+	}
+	ring->thread = __atomic_fetch_add(&threads, 1, __ATOMIC_RELAXED);
+	ring->next = __atomic_load_n(&rings, __ATOMIC_RELAXED);
+	while (!__atomic_compare_exchange_n(&rings, &ring->next, ring, 1, __ATOMIC_RELEASE, __ATOMIC_RELAXED)) {
+	}
+	fcf_trace_ring = ring;
+	return ring;
+}
+
+void fcf_trace_finalize(void) {
+	const char *name = getenv("FCF_TRACE");
+	struct trace_header header = { .version = TRACE_VERSION, .event_size = sizeof(struct fcf_trace_event) };
+	struct fcf_trace_ring *ring, *first = __atomic_load_n(&rings, __ATOMIC_ACQUIRE);
+	uint64_t heads[threads > 0 ? threads : 1];
+
+	if (name == NULL) {
+		name = "fcftrace.bin";
+	}
+	memcpy(header.magic, TRACE_MAGIC, sizeof(header.magic));
+	for (ring = first; ring != NULL; ring = ring->next) {
+		uint64_t head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE);
+		heads[ring->thread] = head;
+		if (head > FCF_TRACE_EVENTS) {
+			header.events += FCF_TRACE_EVENTS;
+			header.overwritten += head - FCF_TRACE_EVENTS;
+		} else {
+			header.events += head;
+		}
+	}
+
+	FILE *out = fopen(name, "w");
+	if (out == NULL) {
+		fprintf(stderr, "fcf_trace: cannot create %s: %s\n", name, strerror(errno));
+		return;
+	}
+	fwrite(&header, sizeof(header), 1, out);
+	for (ring = first; ring != NULL; ring = ring->next) {
+		uint64_t head = heads[ring->thread];
+		uint64_t start = head > FCF_TRACE_EVENTS ? head - FCF_TRACE_EVENTS : 0;
+		/* Oldest first: the part of the ring after the head, then the part before it. */
+		size_t split = start & (FCF_TRACE_EVENTS - 1);
+		if (start > 0) {
+			fwrite(&ring->events[split], sizeof(struct fcf_trace_event), FCF_TRACE_EVENTS - split, out);
+		}
+		fwrite(ring->events, sizeof(struct fcf_trace_event), head - start - (start > 0 ? FCF_TRACE_EVENTS - split : 0), out);
+	}
+	if (fclose(out) != 0) {
+		fprintf(stderr, "fcf_trace: cannot write %s: %s\n", name, strerror(errno));
+		return;
+	}
+	fprintf(stderr, "fcf_trace: %llu events of %d threads written to %s, %llu older ones overwritten\n",
+		(unsigned long long) header.events, threads, name, (unsigned long long) header.overwritten);
+}
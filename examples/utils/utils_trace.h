@@ -0,0 +1,80 @@
+/*
+ * utils_trace.h
+ *
+ * Message tracing: timestamped events around every generated fan-out and
+ * every receiver call, for the latency of message chains from a sensor to
+ * its last consumer. Each thread writes its events into a ring of its own,
+ * without locks; the ring keeps the last FCF_TRACE_EVENTS events. At
+ * fcf_trace_finalize() the rings are written to the file named by the
+ * FCF_TRACE environment variable (default "fcftrace.bin").
+ *
+ * codeGen.py --trace generates the calls and numbers the messages and
+ * receivers in fcftrace.yaml; tracereader.py turns a trace into Chrome trace
+ * JSON and per-receiver latency percentiles. Builds without --trace contain
+ * no trace code at all.
+ */
+
+#ifndef UTILS_TRACE_H_
+#define UTILS_TRACE_H_
+
+#include <stdint.h>
+#include <time.h>
+
+#ifndef FCF_TRACE_EVENTS
+#define FCF_TRACE_EVENTS (1 << 16)	//!< events kept per thread, a power of two
+#endif
+
+#define FCF_TRACE_SEND 0	//!< fan-out of a message starts
+#define FCF_TRACE_SENT 1	//!< fan-out of a message is done
+#define FCF_TRACE_RECV 2	//!< receiver is called
+#define FCF_TRACE_DONE 3	//!< receiver returned
+#define FCF_TRACE_NONE 0xffff	//!< receiver of SEND and SENT events
+
+/** One event, as written to the trace file (little-endian, 16 bytes). */
+struct fcf_trace_event {
+	uint64_t ns;		//!< CLOCK_MONOTONIC
+	uint16_t message;	//!< message id, see fcftrace.yaml
+	uint16_t receiver;	//!< receiver id, FCF_TRACE_NONE for SEND and SENT
+	uint16_t thread;	//!< ring number, in the order threads first traced
+	uint16_t type;		//!< FCF_TRACE_SEND ... FCF_TRACE_DONE
+};
+
+struct fcf_trace_ring {
+	uint64_t head;		//!< events written so far
+	uint16_t thread;
+	struct fcf_trace_ring *next;
+	struct fcf_trace_event events[FCF_TRACE_EVENTS];
+};
+
+extern __thread struct fcf_trace_ring *fcf_trace_ring;
+
+/**
+ * Ring of the calling thread, allocated on its first event.
+ */
+struct fcf_trace_ring *fcf_trace_ring_new(void);
+
+static inline void fcf_trace(uint16_t type, uint16_t message, uint16_t receiver) {
+	struct fcf_trace_ring *ring = fcf_trace_ring;
+	struct timespec now;
+
+	if (__builtin_expect(ring == NULL, 0)) {
+		ring = fcf_trace_ring_new();
+	}
+	clock_gettime(CLOCK_MONOTONIC, &now);
+	uint64_t head = ring->head;
+	struct fcf_trace_event *event = &ring->events[head & (FCF_TRACE_EVENTS - 1)];
+	event->ns = (uint64_t) now.tv_sec * 1000000000 + now.tv_nsec;
+	event->message = message;
+	event->receiver = receiver;
+	event->thread = ring->thread;
+	event->type = type;
+	__atomic_store_n(&ring->head, head + 1, __ATOMIC_RELEASE);
+}
+
+/**
+ * Write the events of all threads to the trace file and print how many
+ * there were. Other threads should be done tracing.
+ */
+void fcf_trace_finalize(void);
+
+#endif /* UTILS_TRACE_H_ */
@@ -0,0 +1,166 @@
+/*
+ * utils_usbpool.c
+ *
+ * The transfers of a pool share one slab of buffers, each rounded up to a
+ * cache line, and are never freed or refilled while the pool lives: a
+ * completed transfer goes back to libusb with the buffer, length and
+ * callback it had.
+ */
+
+#include <stdlib.h>
+#include <stdio.h>
+#include <sys/time.h>
+#include "utils_usbpool.h"
+
+#define SLAB_ALIGN 64
+
+struct fcf_usb_pool {
+	libusb_context *context;
+	fcf_usb_pool_cb cb;
+	void *data;
+	unsigned char *slab;
+	int depth;
+	int freeing;
+	struct fcf_usb_pool_stats stats;
+	struct libusb_transfer *transfers[];
+};
+
+static __thread int default_depth;
+
+static void pool_cb(struct libusb_transfer *transfer) {
+	struct fcf_usb_pool *pool = transfer->user_data;
+
+	pool->stats.in_flight--;
+	switch (transfer->status) {
+	case LIBUSB_TRANSFER_CANCELLED:
+		return;
+	case LIBUSB_TRANSFER_COMPLETED:
+		pool->stats.completions++;
+		if (pool->stats.in_flight == 0) {
+			pool->stats.gaps++;
+		}
+		break;
+	case LIBUSB_TRANSFER_TIMED_OUT:
+		pool->stats.timeouts++;
+		break;
+	default:
+		pool->stats.errors++;
+		break;
+	}
+
+	pool->cb(transfer, pool->data);
+
+	// a stalled, failed or overflowing endpoint would fail again at once
+	if (pool->freeing || (transfer->status != LIBUSB_TRANSFER_COMPLETED &&
+			transfer->status != LIBUSB_TRANSFER_TIMED_OUT)) {
+		return;
+	}
+	if (libusb_submit_transfer(transfer) == 0) {
+		pool->stats.in_flight++;
+	} else {
+		pool->stats.resubmit_errors++;
+	}
+}
+
+struct fcf_usb_pool *fcf_usb_pool_new(libusb_context *context, libusb_device_handle *handle,
+		unsigned char ep, unsigned char type, int packet_size, int depth,
+		fcf_usb_pool_cb cb, void *data, unsigned int timeout) {
+
+	if (type != LIBUSB_TRANSFER_TYPE_BULK && type != LIBUSB_TRANSFER_TYPE_INTERRUPT) {
+		return NULL;
+	}
+	if (packet_size < 0) {
+		//"auto-detect" if not specified
+		packet_size = libusb_get_max_packet_size(libusb_get_device(handle), ep);
+		if (packet_size < 0) {
+			return NULL;
+		}
+	}
+	if (depth <= 0) {
+		depth = default_depth > 0 ? default_depth : FCF_USB_DEPTH;
+	}
+
+	struct fcf_usb_pool *pool = calloc(1, sizeof(*pool) + depth * sizeof(pool->transfers[0]));
+	if (pool == NULL) {
+		return NULL;
+	}
+	pool->context = context;
+	pool->cb = cb;
+	pool->data = data;
+	pool->depth = depth;
+
+	size_t stride = (packet_size + SLAB_ALIGN - 1) / SLAB_ALIGN * SLAB_ALIGN;
+	if (posix_memalign((void **) &pool->slab, SLAB_ALIGN, depth * stride) != 0) {
+		pool->slab = NULL;
+		fcf_usb_pool_free(pool);
+		return NULL;
+	}
+
+	for (int i = 0; i < depth; i++) {
+		struct libusb_transfer *transfer = libusb_alloc_transfer(0);
+		if (transfer == NULL) {
+			fcf_usb_pool_free(pool);
+			return NULL;
+		}
+		pool->transfers[i] = transfer;
+		if (type == LIBUSB_TRANSFER_TYPE_BULK) {
+			libusb_fill_bulk_transfer(transfer, handle, ep, pool->slab + i * stride, packet_size,
+					pool_cb, pool, timeout);
+		} else {
+			libusb_fill_interrupt_transfer(transfer, handle, ep, pool->slab + i * stride, packet_size,
+					pool_cb, pool, timeout);
+		}
+	}
+
+	for (int i = 0; i < depth; i++) {
+		int usb_err = libusb_submit_transfer(pool->transfers[i]);
+		if (usb_err != 0) {
+			fprintf(stderr, "USB ERROR %d submitting transfer %d of %d on endpoint 0x%02x\n",
+					usb_err, i + 1, depth, ep);
+			break;
+		}
+		pool->stats.in_flight++;
+	}
+	if (pool->stats.in_flight == 0) {
+		fcf_usb_pool_free(pool);
+		return NULL;
+	}
+
+	return pool;
+}
+
+void fcf_usb_pool_free(struct fcf_usb_pool *pool) {
+	struct timeval timeout = {
+		.tv_sec = 0,
+		.tv_usec = 100000,
+	};
+
+	if (pool == NULL) {
+		return;
+	}
+	pool->freeing = 1;
+	for (int i = 0; i < pool->depth && pool->transfers[i] != NULL; i++) {
+		libusb_cancel_transfer(pool->transfers[i]);	// LIBUSB_ERROR_NOT_FOUND if not in flight
+	}
+	// the buffers belong to libusb until the cancellations complete
+	while (pool->stats.in_flight > 0) {
+		if (libusb_handle_events_timeout_completed(pool->context, &timeout, NULL) != 0) {
+			fprintf(stderr, "USB ERROR: %d transfers still in flight, leaking the pool\n",
+					pool->stats.in_flight);
+			return;
+		}
+	}
+	for (int i = 0; i < pool->depth && pool->transfers[i] != NULL; i++) {
+		libusb_free_transfer(pool->transfers[i]);
+	}
+	free(pool->slab);
+	free(pool);
+}
+
+void fcf_usb_pool_stats(const struct fcf_usb_pool *pool, struct fcf_usb_pool_stats *stats) {
+	*stats = pool->stats;
+}
+
+void fcf_usb_set_depth(int depth) {
+	default_depth = depth;
+}
@@ -0,0 +1,73 @@
+/*
+ * utils_usbpool.h
+ *
+ * Pool of transfers that keeps a bulk or interrupt IN endpoint busy: depth
+ * transfers are submitted at once, out of one buffer slab, and each is
+ * resubmitted as soon as its callback returns, so the endpoint always has
+ * another transfer queued while one is being handled. Transfers that fail
+ * are not resubmitted. Nothing is allocated
+ * after fcf_usb_pool_new().
+ *
+ * The depth of the pools a module creates can be set in the "usb_depth:"
+ * section of the master MIML file; the generated fcf_initialize() calls
+ * fcf_usb_set_depth() around the module's init.
+ */
+
+#ifndef UTILS_USBPOOL_H_
+#define UTILS_USBPOOL_H_
+
+#include <libusb-1.0/libusb.h>
+
+#ifndef FCF_USB_DEPTH
+#define FCF_USB_DEPTH 4	//!< transfers per pool unless set otherwise
+#endif
+
+/**
+ * Called for every transfer that completes, with data, a timeout or an
+ * error (not for cancelled ones). transfer->buffer holds
+ * transfer->actual_length bytes until the callback returns. Completed and
+ * timed out transfers are resubmitted after that; a transfer that ended
+ * with any other status (stall, error, overflow, no device) is not, and the
+ * pool has one transfer less in flight.
+ * @param data the pool's data
+ */
+typedef void (*fcf_usb_pool_cb)(struct libusb_transfer *transfer, void *data);
+
+struct fcf_usb_pool_stats {
+	unsigned long completions;	//!< transfers completed with data
+	unsigned long timeouts;		//!< transfers that timed out, resubmitted
+	unsigned long errors;		//!< transfers that ended with another error status, not resubmitted
+	unsigned long gaps;		//!< completions that left no transfer queued: the endpoint went idle
+	unsigned long resubmit_errors;	//!< failed resubmits, each one transfer less in flight
+	int in_flight;			//!< transfers submitted now
+};
+
+struct fcf_usb_pool;
+
+/**
+ * Allocate the transfers and the slab, and submit all transfers.
+ * @param context libusb context of the handle, used by fcf_usb_pool_free()
+ * @param type LIBUSB_TRANSFER_TYPE_BULK or LIBUSB_TRANSFER_TYPE_INTERRUPT
+ * @param packet_size bytes per transfer, < 0 for the endpoint's max packet size
+ * @param depth transfers, 0 for the depth set by fcf_usb_set_depth() or else FCF_USB_DEPTH
+ * @return NULL if allocating fails or no transfer could be submitted
+ */
+struct fcf_usb_pool *fcf_usb_pool_new(libusb_context *context, libusb_device_handle *handle,
+		unsigned char ep, unsigned char type, int packet_size, int depth,
+		fcf_usb_pool_cb cb, void *data, unsigned int timeout);
+
+/**
+ * Cancel the transfers, wait for the cancellations to complete and free
+ * the pool.
+ */
+void fcf_usb_pool_free(struct fcf_usb_pool *pool);
+
+void fcf_usb_pool_stats(const struct fcf_usb_pool *pool, struct fcf_usb_pool_stats *stats);
+
+/**
+ * Depth of the pools the calling thread creates with depth 0 from now on.
+ * @param depth transfers, 0 for FCF_USB_DEPTH
+ */
+void fcf_usb_set_depth(int depth);
+
+#endif /* UTILS_USBPOOL_H_ */
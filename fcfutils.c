@@ -27,6 +27,9 @@
 #include <string.h>
 #include <errno.h>
 #include <signal.h>
+#include <time.h>
+#include <stdint.h>
+#include <pthread.h>
 #include "fcfutils.h"
 
 #define FDS_INIT_SIZE 1
@@ -39,6 +42,9 @@
 struct fcffd{
   pollfd_callback callback;
   char cb_cat;
+  char was_deferred;		//< Deferred in its last ready cycle, not deferred again
+  int priority;
+  unsigned long deferred;	//< Callbacks put off by the cycle budget
 };
 
 static const char STANDARD = 0;	//< Standard callback
@@ -46,13 +52,109 @@ static const char PPC = 1;	//< Per poll cycle callback
 
 static struct pollfd * fds = NULL;	//< File descriptor array
 static struct fcffd  * fdx = NULL;	//< File description array
+static int * order = NULL;	//< Indices into fds, highest priority first
 static int nfds;		//< Number of file descriptors in arrays
 static int fd_array_size;	//< Allocated size of file descriptor array, fds
 static int run_fc;		//< Main loop is running true/false
+static int virtual_clock;	//< fcf_clock_ns() returns virtual_ns true/false
+static uint64_t virtual_ns;	//< Virtual time, set by a replay source
+static pthread_mutex_t fd_lock = PTHREAD_MUTEX_INITIALIZER;	//< Guards the fd arrays while inits run concurrently
+static void (*cycle_end[FCF_CYCLE_END_MAX])(void);	//< Called after the callbacks of every poll cycle
+static int ncycle_end;		//< Number of cycle_end functions
+static __thread int add_priority;	//< Priority of fds added by this thread, see fcf_set_priority()
+static uint64_t cycle_budget;	//< ns of callbacks per cycle before low priority ones are deferred, 0: none
+static unsigned long cycles_over;	//< Cycles that ran over the budget
+static unsigned long deferred_total;	//< Callbacks deferred
 
 extern void fcf_initialize(void);
 extern void fcf_finalize (void);
 
+/*
+ *    Buffer pool: FCF_BUF_COUNT slabs on a lock-free free list. The list head
+ *    packs the index of the first free slab plus one (0: empty) in its low 32
+ *    bits and a tag, bumped on every update, in the high 32 bits, so a slab
+ *    that is freed and reused between a load and a compare-exchange is noticed.
+ */
+static unsigned char pool_data[FCF_BUF_COUNT][FCF_BUF_SIZE] __attribute__((aligned(64)));
+static struct fcf_buf pool[FCF_BUF_COUNT];
+static uint64_t pool_head;		//< Tagged free list head
+static unsigned int pool_in_use;	//< Slabs handed out
+static unsigned int pool_high_water;	//< Most slabs handed out at once
+static unsigned long pool_allocs;	//< Successful fcf_buf_alloc() calls
+static unsigned long pool_failures;	//< fcf_buf_alloc() calls that found the pool empty
+
+#define POOL_TAG (1ULL << 32)
+
+static void init_pool(){
+  for(int i = 0; i < FCF_BUF_COUNT; i++){
+    pool[i].data = pool_data[i];
+    pool[i].length = 0;
+    pool[i].refs = 0;
+    pool[i].next = i + 2 <= FCF_BUF_COUNT ? i + 2 : 0;
+  }
+  pool_head = 1;
+  pool_in_use = pool_high_water = 0;
+  pool_allocs = pool_failures = 0;
+}
+
+struct fcf_buf *fcf_buf_alloc(){
+  uint64_t head = __atomic_load_n(&pool_head, __ATOMIC_ACQUIRE);
+  uint32_t idx;
+  do {
+    idx = (uint32_t) head;
+    if(idx == 0){
+      __atomic_add_fetch(&pool_failures, 1, __ATOMIC_RELAXED);
+      return NULL;
+    }
+    uint32_t next = __atomic_load_n(&pool[idx - 1].next, __ATOMIC_RELAXED);
+    if(__atomic_compare_exchange_n(&pool_head, &head, ((head & ~0xffffffffULL) + POOL_TAG) | next,
+                                   1, __ATOMIC_ACQUIRE, __ATOMIC_ACQUIRE))
+      break;
+  } while(1);
+
+  struct fcf_buf *buf = &pool[idx - 1];
+  buf->length = 0;
+  __atomic_store_n(&buf->refs, 1, __ATOMIC_RELAXED);
+
+  unsigned int in_use = __atomic_add_fetch(&pool_in_use, 1, __ATOMIC_RELAXED);
+  unsigned int high = __atomic_load_n(&pool_high_water, __ATOMIC_RELAXED);
+  while(in_use > high &&
+        !__atomic_compare_exchange_n(&pool_high_water, &high, in_use, 1, __ATOMIC_RELAXED, __ATOMIC_RELAXED))
+    ;
+  __atomic_add_fetch(&pool_allocs, 1, __ATOMIC_RELAXED);
+  return buf;
+}
+
+void fcf_buf_unref(struct fcf_buf *buf){
+  if(__atomic_sub_fetch(&buf->refs, 1, __ATOMIC_ACQ_REL) != 0)
+    return;
+  uint32_t idx = buf - pool + 1;
+  uint64_t head = __atomic_load_n(&pool_head, __ATOMIC_RELAXED);
+  do {
+    __atomic_store_n(&buf->next, (uint32_t) head, __ATOMIC_RELAXED);
+  } while(!__atomic_compare_exchange_n(&pool_head, &head, ((head & ~0xffffffffULL) + POOL_TAG) | idx,
+                                       1, __ATOMIC_RELEASE, __ATOMIC_RELAXED));
+  __atomic_sub_fetch(&pool_in_use, 1, __ATOMIC_RELAXED);
+}
+
+void fcf_buf_stats(struct fcf_buf_stats *stats){
+  stats->count = FCF_BUF_COUNT;
+  stats->size = FCF_BUF_SIZE;
+  stats->in_use = __atomic_load_n(&pool_in_use, __ATOMIC_RELAXED);
+  stats->high_water = __atomic_load_n(&pool_high_water, __ATOMIC_RELAXED);
+  stats->allocs = __atomic_load_n(&pool_allocs, __ATOMIC_RELAXED);
+  stats->failures = __atomic_load_n(&pool_failures, __ATOMIC_RELAXED);
+}
+
+static void report_pool(){
+  struct fcf_buf_stats stats;
+  fcf_buf_stats(&stats);
+  if(stats.allocs == 0 && stats.failures == 0)
+    return;
+  printf("\nbuffer pool: %lu allocs, high-water %u of %u slabs of %u bytes, %lu failed, %u still referenced\n",
+         stats.allocs, stats.high_water, stats.count, stats.size, stats.failures, stats.in_use);
+}
+
 /*
  * Initialization for fcf data structures
  */
@@ -62,8 +164,9 @@ static int init_fcf(){
   //initializing both file descriptor arrays
   fds = (struct pollfd *) malloc(fd_array_size * sizeof(struct pollfd));
   fdx = (struct fcffd *) malloc(fd_array_size * sizeof(struct fcffd));
+  order = (int *) malloc(fd_array_size * sizeof(int));
   
-  if(!fds){
+  if(!fds || !order){
 	  fprintf(stderr, "Could not allocate memory for file descriptor array.");
 	  return -1;
   }
@@ -74,6 +177,7 @@ static int init_fcf(){
 	
   nfds = 0;  //< Number of file descriptors in array
   run_fc = 0;  //< Main loop is running True/False
+  init_pool();
 
   return 0;
 }
@@ -83,8 +187,18 @@ static int init_fcf(){
  * Deallocate fcf data structures
  */
 static void finalize_fcf(){
+	report_pool();
+	if(deferred_total > 0){
+		printf("\npoll loop: %lu cycles over the %.0f us budget, %lu callbacks deferred\n",
+		       cycles_over, cycle_budget / 1e3, deferred_total);
+		for(int i = 0; i < nfds; i++){
+			if(fdx[i].deferred > 0)
+				printf(" fd %d (priority %d): %lu deferred\n", fds[i].fd, fdx[i].priority, fdx[i].deferred);
+		}
+	}
 	free(fds);
 	free(fdx);
+	free(order);
 	nfds = -1;
 }
 
@@ -112,13 +226,33 @@ static int expand_arrays(){
   }
   fdx = fdx_temp;
 
+  int * order_temp = realloc(order, fd_array_size * sizeof(int));
+  if(order_temp == NULL){
+    return -1;
+  }
+  order = order_temp;
+
   return 0;
 }
 
+/*
+ *	Sorts the dispatch order by priority, fds of equal priority in array order
+ */
+static void sort_order(){
+  for(int i = 0; i < nfds; i++){
+    int j = i;
+    for(; j > 0 && fdx[order[j - 1]].priority < fdx[i].priority; j--){
+      order[j] = order[j - 1];
+    }
+    order[j] = i;
+  }
+}
+
 /*
  *    Add file descriptor into both fdx and fds arrays
  */ 
-int fcf_add_fd(int fd, short events, pollfd_callback cb){
+static int add_fd(int fd, short events, pollfd_callback cb, char cb_cat, int priority){
+  pthread_mutex_lock(&fd_lock);
   // Checks to see if fd arrays are full, if they are expand arrays.
   if(fd_array_size == nfds){
     expand_arrays();
@@ -128,10 +262,23 @@ int fcf_add_fd(int fd, short events, pollfd_callback cb){
   fds[nfds].fd = fd;
   fds[nfds].events = events;
   fdx[nfds].callback = cb;
-  fdx[nfds].cb_cat = STANDARD;
-  nfds++;
+  fdx[nfds].cb_cat = cb_cat;
+  fdx[nfds].was_deferred = 0;
+  fdx[nfds].priority = priority;
+  fdx[nfds].deferred = 0;
+  int i = nfds++;
+  sort_order();
+  pthread_mutex_unlock(&fd_lock);
+
+  return i; // return value is the index of the newest file descriptor
+}
 
-  return nfds - 1; // return value is the index of the newest file descriptor
+int fcf_add_fd(int fd, short events, pollfd_callback cb){
+  return add_fd(fd, events, cb, STANDARD, add_priority);
+}
+
+int fcf_add_fd_prio(int fd, short events, pollfd_callback cb, int priority){
+  return add_fd(fd, events, cb, STANDARD, priority);
 }
 
 
@@ -139,11 +286,36 @@ int fcf_add_fd(int fd, short events, pollfd_callback cb){
  *    Per poll loop file descriptor add
  */
 int fcf_add_fd_ppc(int fd, short events, pollfd_callback cb){
-  int i = fcf_add_fd (fd, events, cb);
-  if(i >= 0){
-    fdx[i].cb_cat = PPC;
+  return add_fd(fd, events, cb, PPC, add_priority);
+}
+
+
+/*
+ *    Priority of the fds this thread adds from now on
+ */
+void fcf_set_priority(int priority){
+  add_priority = priority;
+}
+
+
+/*
+ *    Time budget of the callbacks of a poll cycle
+ */
+void fcf_set_cycle_budget(uint64_t ns){
+  cycle_budget = ns;
+}
+
+
+/*
+ *    Function called at the end of every poll cycle
+ */
+int fcf_at_cycle_end(void (*fn)(void)){
+  if(ncycle_end == FCF_CYCLE_END_MAX){
+    fprintf(stderr, "fcf_at_cycle_end: no room for more than %d functions\n", FCF_CYCLE_END_MAX);
+    return -1;
   }
-  return i;
+  cycle_end[ncycle_end++] = fn;
+  return 0;
 }
 
 /*
@@ -151,10 +323,7 @@ int fcf_add_fd_ppc(int fd, short events, pollfd_callback cb){
  */
 void fcf_remove_fd(int fd){
  
-  // If there are no fds, return
-  if(nfds <= 0)
-    return;
-
+  pthread_mutex_lock(&fd_lock);
   for(int i = 0; i < nfds; i++){
     if(fds[i].fd == fd && i == (nfds - 1)){
       nfds--;
@@ -165,6 +334,8 @@ void fcf_remove_fd(int fd){
       nfds--;
     }
   }
+  sort_order();
+  pthread_mutex_unlock(&fd_lock);
 }
 
 /*
@@ -181,6 +352,127 @@ void fcf_stop_main_loop(){
   run_fc = 0;
 }
 
+/*
+ *    Monotonic time in ns, never virtual
+ */
+static uint64_t monotonic_ns(){
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return (uint64_t) now.tv_sec * 1000000000ULL + now.tv_nsec;
+}
+
+/*
+ *    Monotonic time in ns, virtual while a replay source drives the clock
+ */
+uint64_t fcf_clock_ns(){
+  if(virtual_clock){
+    return virtual_ns;
+  }
+  return monotonic_ns();
+}
+
+/*
+ *    Switches to (and sets) the virtual clock
+ */
+void fcf_clock_set_virtual(uint64_t ns){
+  virtual_clock = 1;
+  virtual_ns = ns;
+}
+
+/*
+ *    Dependency-aware module initialization, on a pool of threads
+ */
+static pthread_mutex_t init_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t init_done = PTHREAD_COND_INITIALIZER;
+static struct fcf_init_task *init_tasks;
+static int init_ntasks;
+static int init_started;
+static char *init_state;	//< 0 waiting, 1 running, 2 done
+
+static double elapsed_ms(struct timespec *from, struct timespec *to){
+  return (to->tv_sec - from->tv_sec) * 1e3 + (to->tv_nsec - from->tv_nsec) / 1e6;
+}
+
+static int init_ready(int i){
+  for(int d = 0; d < init_tasks[i].ndeps; d++){
+    if(init_state[init_tasks[i].deps[d]] != 2)
+      return 0;
+  }
+  return 1;
+}
+
+static void *init_worker(void *arg){
+  int thread = (int) (intptr_t) arg;
+  pthread_mutex_lock(&init_lock);
+  while(init_started < init_ntasks){
+    int next = -1;
+    for(int i = 0; i < init_ntasks && next < 0; i++){
+      if(init_state[i] == 0 && init_ready(i))
+        next = i;
+    }
+    if(next < 0){
+      // everything left waits on a running init
+      pthread_cond_wait(&init_done, &init_lock);
+      continue;
+    }
+    init_state[next] = 1;
+    init_started++;
+    pthread_mutex_unlock(&init_lock);
+
+    struct timespec start, end;
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    if(init_tasks[next].init != NULL)
+      init_tasks[next].init();
+    clock_gettime(CLOCK_MONOTONIC, &end);
+    init_tasks[next].ms = elapsed_ms(&start, &end);
+    init_tasks[next].thread = thread;
+
+    pthread_mutex_lock(&init_lock);
+    init_state[next] = 2;
+    pthread_cond_broadcast(&init_done);
+  }
+  pthread_mutex_unlock(&init_lock);
+  return NULL;
+}
+
+int fcf_run_inits(struct fcf_init_task *tasks, int ntasks, int nthreads){
+  struct timespec start, end;
+  pthread_t threads[nthreads > 1 ? nthreads - 1 : 1];
+  int spawned = 0;
+
+  init_tasks = tasks;
+  init_ntasks = ntasks;
+  init_started = 0;
+  init_state = calloc(ntasks > 0 ? ntasks : 1, 1);
+  if(init_state == NULL){
+    fprintf(stderr, "Could not allocate memory for init states.");
+    return -1;
+  }
+
+  clock_gettime(CLOCK_MONOTONIC, &start);
+  // the calling thread is worker 0
+  for(int t = 1; t < nthreads && t < ntasks; t++){
+    if(pthread_create(&threads[spawned], NULL, init_worker, (void *) (intptr_t) t) == 0)
+      spawned++;
+  }
+  init_worker((void *) 0);
+  for(int t = 0; t < spawned; t++){
+    pthread_join(threads[t], NULL);
+  }
+  clock_gettime(CLOCK_MONOTONIC, &end);
+
+  double sum = 0;
+  for(int i = 0; i < ntasks; i++){
+    printf(" init %-16s %10.3f ms  [thread %d]\n", tasks[i].name, tasks[i].ms, tasks[i].thread);
+    sum += tasks[i].ms;
+  }
+  printf(" init: %d modules in %.3f ms on %d thread(s), %.3f ms one after another\n",
+         ntasks, elapsed_ms(&start, &end), spawned + 1, sum);
+  free(init_state);
+  init_state = NULL;
+  return 0;
+}
+
 /*
  *    Starts main poll loop running
  */
@@ -216,9 +508,20 @@ static int fcf_run_poll_loop(){
       break;
     default:
       nppc = 0;
-      for(int i = 0; i < nfds && rc > 0; i++){
+      int over = 0;
+      uint64_t start = cycle_budget ? monotonic_ns() : 0;
+      for(int k = 0; k < nfds && rc > 0; k++){
+	int i = order[k];
 	if(fds[i].revents != 0){
 	  rc--;
+	  if(over && fdx[i].priority <= 0 && !fdx[i].was_deferred){
+	    // over budget: still ready next cycle, since poll(2) is level triggered
+	    fdx[i].was_deferred = 1;
+	    fdx[i].deferred++;
+	    deferred_total++;
+	    continue;
+	  }
+	  fdx[i].was_deferred = 0;
 	  if(fdx[i].cb_cat == STANDARD){
 	    // callback for this active fd is a standard callback
 	    fdx[i].callback(&fds[i]);
@@ -238,6 +541,10 @@ static int fcf_run_poll_loop(){
 	      //printf("\n multiple active ppc, ignoring callback for fd[%d]: fd=%d", i, fds[i].fd);
 	    }
 	  }
+	  if(cycle_budget && !over && monotonic_ns() - start > cycle_budget){
+	    over = 1;
+	    cycles_over++;
+	  }
 	} // (revents set)
       } // (for i)
 
@@ -250,6 +557,11 @@ static int fcf_run_poll_loop(){
 	ppc[j](fds);
       }
 
+      // end of the cycle, e.g. batched messages are delivered
+      for(int j = 0; j < ncycle_end; j++){
+	cycle_end[j]();
+      }
+
       break;
     }
 
@@ -260,6 +572,52 @@ static int fcf_run_poll_loop(){
 }
 
 
+#ifdef FCF_SHARED
+
+/*
+ *    Shared library entry points, used instead of main() by in-process harnesses
+ */
+int fcf_lib_init(){
+  int rc = init_fcf();
+  if(rc == 0){
+    fcf_initialize();
+  }
+  return rc;
+}
+
+void fcf_lib_finalize(){
+  fcf_finalize();
+  finalize_fcf();
+}
+
+int fcf_lib_run(){
+  return fcf_run_poll_loop();
+}
+
+int fcf_lib_nfds(){
+  return nfds;
+}
+
+void fcf_lib_dispatch(int idx, long n){
+  if(idx < 0 || idx >= nfds)
+    return;
+  fds[idx].revents = fds[idx].events;
+  for(long i = 0; i < n; i++){
+    fdx[idx].callback(&fds[idx]);
+    for(int j = 0; j < ncycle_end; j++){
+      cycle_end[j]();
+    }
+  }
+}
+
+void fcf_lib_loop(long n){
+  for(long i = 0; i < n; i++){
+    __asm__ __volatile__("");
+  }
+}
+
+#else
+
 static void signalhandler(int signum){
   if(signum == SIGINT){
     fcf_stop_main_loop ();
@@ -291,3 +649,5 @@ int main(int argc, char *argv[]){
   }
   return EXIT_FAILURE;
 }
+
+#endif /* FCF_SHARED */
@@ -25,6 +25,8 @@ http://www.gnu.org/licenses/gpl.html.\n
 #define FALSE            0
 
 #include <poll.h>
+#include <stddef.h>
+#include <stdint.h>
 
 /**
  * @brief pollfd callback function pointer 
@@ -46,6 +48,40 @@ extern int fcf_add_fd(int fd, short events, pollfd_callback cb);
  */
 extern int fcf_add_fd_ppc(int fd, short events, pollfd_callback cb);
 
+/**
+ * @brief adds a file descriptor with a priority of its own
+ * @details Like fcf_add_fd(), but with priority instead of the one set by fcf_set_priority().
+ * @param priority - ready fds are dispatched highest priority first; 0 and below may be deferred by the cycle budget
+ * @return index value of newest file descriptor
+ */
+extern int fcf_add_fd_prio(int fd, short events, pollfd_callback cb, int priority);
+
+/**
+ * @brief sets the priority of the fds the calling thread adds from now on
+ * @details The generated fcf_initialize() sets the priority of each module, from the "scheduling:" section of the master MIML file, before calling its init. The default is 0.
+ * @param priority - see fcf_add_fd_prio()
+ */
+extern void fcf_set_priority(int priority);
+
+/**
+ * @brief sets the time budget of the callbacks of a poll cycle
+ * @details Once the callbacks of a cycle have taken longer than ns, the ready fds of priority 0 and below are left for the next cycle (poll is level triggered, so they are reported again) and counted; fcf prints the counts when it exits. An fd is not deferred twice in a row, so none starve.
+ * @param ns - budget in ns, 0 (the default) for none
+ */
+extern void fcf_set_cycle_budget(uint64_t ns);
+
+
+#ifndef FCF_CYCLE_END_MAX
+#define FCF_CYCLE_END_MAX 8	//!< functions fcf_at_cycle_end() takes
+#endif
+
+/**
+ * @brief calls a function at the end of every poll cycle
+ * @details After the callbacks of all ready fds, per poll cycle callbacks included, have run. The generated code delivers batch messages from here.
+ * @param fn - function to call
+ * @return 0 on success, -1 if FCF_CYCLE_END_MAX functions are registered already
+ */
+extern int fcf_at_cycle_end(void (*fn)(void));
 
 /**
  * @brief simply removes a specified file descriptor from the arrays
@@ -66,6 +102,156 @@ extern struct pollfd * fcf_get_fd(int idx);
  */
 extern void fcf_stop_main_loop(void);
 
+#ifndef FCF_INIT_THREADS
+#define FCF_INIT_THREADS 4	//!< threads that run module inits declared with init_depends
+#endif
+
+/**
+ * @brief a module init, for fcf_run_inits()
+ * @details Generated by codeGen.py when the master MIML file declares init_depends. deps are indices of the tasks that must finish first.
+ */
+struct fcf_init_task {
+  const char *name;		//!< source token of the module
+  void (*init)(void);		//!< the module's init, or NULL
+  int ndeps;			//!< number of dependencies
+  const int *deps;		//!< indices of the tasks this one waits for
+  double ms;			//!< time the init took, set by fcf_run_inits()
+  int thread;			//!< worker that ran the init, set by fcf_run_inits()
+};
+
+/**
+ * @brief runs module inits concurrently, in dependency order
+ * @details Every init starts as soon as the inits it depends on are done, on a pool of up to nthreads threads (the calling thread included). Returns after all inits are done and prints the time each took. fcf_add_fd() and fcf_remove_fd() may be called from the inits.
+ * @param tasks - the inits; the dependencies must not have cycles
+ * @param ntasks - number of tasks
+ * @param nthreads - size of the thread pool
+ * @return 0 on success, -1 if memory could not be allocated
+ */
+extern int fcf_run_inits(struct fcf_init_task *tasks, int ntasks, int nthreads);
+
+#ifndef FCF_BUF_COUNT
+#define FCF_BUF_COUNT 64	//!< slabs in the buffer pool
+#endif
+#ifndef FCF_BUF_SIZE
+#define FCF_BUF_SIZE 1024	//!< bytes in a slab of the buffer pool
+#endif
+
+/**
+ * @brief a reference counted buffer from the framework's pool
+ * @details Messages with a "struct fcf_buf*" parameter pass these. The sender's reference goes with the message; the generated code gives every receiver a reference of its own, which the receiver releases with fcf_buf_unref() when it is done with the data, possibly much later. Receivers must not write to a shared buffer.
+ */
+struct fcf_buf {
+  unsigned char *data;		//!< FCF_BUF_SIZE bytes
+  int length;			//!< bytes in use, set by the sender
+  int refs;			//!< references held, updated atomically
+  uint32_t next;		//!< free list link, used by the pool
+};
+
+/**
+ * @brief buffer pool counters, see fcf_buf_stats()
+ */
+struct fcf_buf_stats {
+  unsigned int count;		//!< slabs in the pool
+  unsigned int size;		//!< bytes in a slab
+  unsigned int in_use;		//!< slabs referenced now
+  unsigned int high_water;	//!< most slabs referenced at once
+  unsigned long allocs;		//!< buffers handed out
+  unsigned long failures;	//!< fcf_buf_alloc() calls that found the pool empty
+};
+
+/**
+ * @brief takes a buffer from the pool
+ * @details Lock-free, may be called from any thread.
+ * @return a buffer with one reference and length 0, or NULL if every slab is in use
+ */
+extern struct fcf_buf *fcf_buf_alloc(void);
+
+/**
+ * @brief adds a reference to a buffer
+ * @param buf - a buffer the caller holds a reference to
+ * @return buf
+ */
+static inline struct fcf_buf *fcf_buf_ref(struct fcf_buf *buf) {
+  __atomic_add_fetch(&buf->refs, 1, __ATOMIC_RELAXED);
+  return buf;
+}
+
+/**
+ * @brief adds n references to a buffer at once
+ * @param buf - a buffer the caller holds a reference to
+ * @param n - references to add
+ */
+static inline void fcf_buf_ref_n(struct fcf_buf *buf, int n) {
+  __atomic_add_fetch(&buf->refs, n, __ATOMIC_RELAXED);
+}
+
+/**
+ * @brief releases a reference; the buffer goes back to the pool with the last one
+ * @param buf - a buffer the caller holds a reference to
+ */
+extern void fcf_buf_unref(struct fcf_buf *buf);
+
+/**
+ * @brief reads the buffer pool counters
+ * @details The counters are also printed when the framework shuts down, if the pool was used.
+ * @param stats - filled in
+ */
+extern void fcf_buf_stats(struct fcf_buf_stats *stats);
+
+/**
+ * @brief monotonic time in ns
+ * @details CLOCK_MONOTONIC, unless a replay source switched the framework to virtual time with fcf_clock_set_virtual(). Generated rate gates and the log timestamps use this clock, so a replayed run is reproducible.
+ * @return current (virtual) monotonic time in ns
+ */
+extern uint64_t fcf_clock_ns(void);
+
+/**
+ * @brief switches the framework clock to virtual time
+ * @details From the first call on, fcf_clock_ns() returns the last time set here instead of reading CLOCK_MONOTONIC.
+ * @param ns - virtual time in ns
+ */
+extern void fcf_clock_set_virtual(uint64_t ns);
+
+#ifdef FCF_SHARED
+/**
+ * @brief initializes the framework and the user modules without running the main loop
+ * @details Only available when built with -DFCF_SHARED as a shared library (see "make lib" in examples/devicelog). Used by in-process harnesses such as profiler.py.
+ * @return 0 on success, -1 if the fd arrays could not be allocated
+ */
+extern int fcf_lib_init(void);
+
+/**
+ * @brief finalizes the user modules and the framework after fcf_lib_init()
+ */
+extern void fcf_lib_finalize(void);
+
+/**
+ * @brief runs the poll loop until fcf_stop_main_loop() is called
+ * @return 0 on success, -1 on poll error
+ */
+extern int fcf_lib_run(void);
+
+/**
+ * @brief returns the number of registered file descriptors
+ */
+extern int fcf_lib_nfds(void);
+
+/**
+ * @brief calls the callback registered at index idx n times in a row
+ * @details revents of the fd is set to its requested events before the first call. Every call counts as a poll cycle of its own: the fcf_at_cycle_end() functions run after it.
+ * @param idx - index value, as returned by fcf_add_fd
+ * @param n - number of calls
+ */
+extern void fcf_lib_dispatch(int idx, long n);
+
+/**
+ * @brief runs an empty loop of n iterations, which the compiler keeps
+ * @details The baseline of the generated fcf_lib_repeat_<message>(..., n) functions, which send a message n times: harnesses subtract its time to leave out the loop itself.
+ * @param n - number of iterations
+ */
+extern void fcf_lib_loop(long n);
+
+#else
 /**
  * @brief Main function for framework
  * @details Prints the licensing information, and software version number.  It contains the signal handler for graceful shutdown should the user CTRL-C out of the program. It then initializes the framework and runs the polling loop.
@@ -73,5 +259,6 @@ extern void fcf_stop_main_loop(void);
  * @return EXIT_FAILURE
  */
 int main(int argc, char *argv[]);
+#endif /* FCF_SHARED */
 
 #endif
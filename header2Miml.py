@@ -1,158 +1,585 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 #	Assumptions:
-#		- only parses extern functions
-#		- init/final functions only detected with "initialize" and "finalize" in name
-#		- any non-init/final functions with "initialize" or "finalize" aren't included
-#		- only data types recognized are [const|unsigned] [int|char]
+#		- function roles come from a "// [miml:<role>]" comment on the
+#		  prototype (anywhere inside it, or right after its ';' on the same line)
+#		- init/final functions are the ones marked [miml:init] / [miml:final]
+#		- prototypes may span lines; comments, preprocessor lines, typedefs
+#		  and object-like macros are understood, function bodies are skipped
+#		- parameter types outside cg.conf's allowed_types are still written
+#		  out, with a warning, since codeGen.py will reject them
+#		- struct pointers are written out as is; codeGen.py checks them
+#		  against the structs declared in the master MIML file
 #		- variable names not defined are replaced by ARG# variable name
+#		- a "[miml:framing <name> key=value ...]" comment anywhere declares
+#		  the framing of a serial protocol, written under "framing:"
+#
+#	Usage:
+#		header2Miml.py <header> [<miml>]
+#		header2Miml.py --dir <directory> [-j <jobs>] [--conf cg.conf]
+#			regenerates the MIML file of every module_*.h in <directory>
 
-import sys, re
-
-if (len(sys.argv) < 2):
-	print "Error: Too few arguments."
-	sys.exit(-1)
-elif len(sys.argv) > 3:
-	print "Error: Too many arguments."
-	sys.exit(-1)
-
-inputfile = sys.argv[1]
-rpos = inputfile.rfind(".")
-
-if len(sys.argv) == 2:
-	outputfile = inputfile
-	outputfile += ".miml"
-
-if str(inputfile[rpos:]) != ".h" and (rpos > 0):
-	print "Error: Input file not a .h file."
-	sys.exit(-1)
-elif rpos < 0:
-	objfile = inputfile + ".o"
-	inputfile += ".h"
-else:
-	objfile = inputfile[:rpos] + ".o"
-
-if len(sys.argv) == 3:
-	outputfile = sys.argv[2]
-	rpos = outputfile.rfind(".");
-	if (str(outputfile[rpos:]) != ".miml") and (rpos > 0):
-		print "Error: Output file not a .miml file."
-		sys.exit(-1)
-	elif rpos < 0:
-		outputfile += ".miml"
-
-try:
-	f = open(inputfile, 'r')
-except IOError as e:
-	print "I/O error({0}): Input header file --> {1}".format(e.errno, e.strerror)
-	sys.exit(-1)
-
-codeLines = f.readlines()
-f.close()
-
-try:
-	f = open('cg.conf', 'r')
-except IOError as e:
-	print "I/O error({0}): cg.conf --> {1}".format(e.errno, e.strerror)
-	sys.exit(-1)
-
-cgConf = f.readlines()
-f.close()
-
-for item in cgConf:
-	match = re.match( r'[\s]*allowed_types: \[(.*)\][\s]*', item, re.M|re.I)
-	if match:
-		allowedTypes = match.group(1)
-		allowedTypes = re.sub( r"\,[\s]*", "|", allowedTypes)
-		allowedTypes = re.sub( r"'", "", allowedTypes)
-		allowedTypes = re.sub( r"(const|unsigned)[\s]+", "", allowedTypes)
-		break
-
-
-outputCodeHeader = "%YAML 1.2\n---\ninclude: " + inputfile + "\nobject: " + objfile
-outputCodeInit = "init: "
-outputCodeFinal = "final: "
-outputCodeSenders = "# Functions that handle outgoing data\nsenders:\n"
-outputCodeReceivers = "# Functions that handle incoming data\nreceivers:\n"
-outputCodeUnknown = "[unknown:]\n"
-foundInit = 0
-foundFinal = 0
-foundUnknown = 0
-foundSenders = 0
-foundReceivers = 0
-
-def xstr(s):
-    if s is None:
-        return ''
-    return str(s)
-
-for item in codeLines:
-	#match = re.match( r'[\s]*(extern[\s]+)?([\w]+[\s]+)([\w_-]+)[\s]*\((.*)\).*', item.strip('\n'), re.M|re.I)
-	match = re.match( r'[\s]*(extern[\s]+)?([\w]+[\s]+)([\w_-]+)[\s]*\((.*)\)[\s]*;[\s]*(\/\/[\s]*\[[\s]*miml[\s]*:[\s]*(init|final|sender|receiver)[\s]*\])?.*', item.strip('\n'), re.M|re.I)
-	if match:
-		mimlType = match.group(6)
-		if(mimlType=="init"):
-			outputCodeInit += str(match.group(3)) + "();"
-			foundInit += 1
-			continue
-
-		if(mimlType=="final"):
-			outputCodeFinal += str(match.group(3)) + "();"
-			foundFinal += 1
-			continue
-
-		content = match.group(4).split(',')
-		counter = 0
-
-		argVals = ""
-		for item2 in content:
-			counter += 1
-			match2 = re.match( r'[\s]*((const|unsigned)[\s]+)?(' + allowedTypes + ')[\s]*(\*)?([\s]*([\w_-]+)[\s]*)?', item2, re.M|re.I)
-			if match2:
-				argType = xstr(match2.group(1)) + xstr(match2.group(3)) + xstr(match2.group(4))
-				argName = match2.group(6)
-				if argName is None:
-					argName = "ARG" + str(counter)
-				
-				argVals += "  - [" +argName + ", " + argType.strip() + "]\n"
-		
-		funcName = str(match.group(3))
-		if (mimlType=="receiver"):
-			outputCodeReceivers += "  " + funcName  + ":\n" + argVals
-			foundReceivers += 1
-		elif (mimlType=="sender"):
-			outputCodeSenders += "  " + funcName  + ":\n" + argVals
-			foundSenders += 1
-		else:
-			outputCodeUnknown += "  " + funcName  + ":\n" + argVals
-			foundUnknown += 1
-
-try:
-	fout = open(outputfile, 'w')
-except IOError as e:
-	print "I/O error({0}): Output Miml file --> {1}".format(e.errno, e.strerror)
-	sys.exit(-1)
-fout.write(outputCodeHeader + "\n")
-if(foundInit):
-	fout.write(outputCodeInit + "\n")
-if(foundFinal):
-	fout.write(outputCodeFinal + "\n\n")
-else:
-	fout.write("\n")
-fout.write(outputCodeSenders + "\n")
-fout.write(outputCodeReceivers + "\n")
-#if foundUnknown:
-#	fout.write("# Functions that have not been designated as\n")
-#	fout.write("# senders or receivers. Sort them accordingly\n")
-#	fout.write("# and delete the [unknown:] header.\n")
-#	fout.write(outputCodeUnknown + "\n")
-fout.close()
-
-print "\n " + inputfile + "  ->  " + outputfile
-print "======================================================"
-#print " Init\tFinal\tSenders\t  Receivers   Unknown			 "
-print " Init\tFinal\tSenders\t  Receivers					 "
-print "------------------------------------------------------"
-#print " " + str(foundInit) + "\t" + str(foundFinal) + "\t" + str(foundSenders) + "\t  " + str(foundReceivers) + "\t      " + str(foundUnknown)
-print " " + str(foundInit) + "\t" + str(foundFinal) + "\t" + str(foundSenders) + "\t  " + str(foundReceivers)
-print ""
+import sys
+import os
+import re
+import bisect
+import fnmatch
+import hashlib
+import json
+import argparse
+import multiprocessing
+import time
+import yaml
+
+# All patterns are compiled once, at import time.
+TOKEN_RE = re.compile(r"""\s*(?:
+      (?P<ident>[A-Za-z_]\w*)
+    | (?P<linecomment>//[^\n]*)
+    | (?P<blockcomment>/\*.*?\*/)
+    | (?P<preproc>\#(?:\\\n|[^\n])*)
+    | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+    | (?P<number>\d\w*(?:\.\w*)?)
+    | (?P<ellipsis>\.\.\.)
+    | (?P<punct>\S)
+    )""", re.S | re.X)
+NEWLINE_RE = re.compile(r"\n")
+DIRECTIVE_RE = re.compile(r"\[\s*miml\s*:\s*(init|final|sender|receiver)\s*\]", re.I)
+FRAMING_RE = re.compile(r"\[\s*miml\s*:\s*framing\s+(\w+)((?:\s+\w+\s*=\s*(?:\"[^\"]*\"|[^\s\]]+))*)\s*\]", re.I)
+FRAMING_ARG_RE = re.compile(r"(\w+)\s*=\s*(?:\"([^\"]*)\"|([^\s\]]+))")
+COMMENT_LINE_RE = re.compile(r"\n\s*(?://|\*(?!/))?")
+DEFINE_RE = re.compile(r"#\s*define\s+(\w+)(?!\()\s+(.*)$", re.S)
+
+TYPE_KEYWORDS = frozenset(['void', 'char', 'short', 'int', 'long', 'float', 'double',
+                           'signed', 'unsigned', 'const', 'volatile', '_Bool',
+                           'struct', 'union', 'enum'])
+TAG_KEYWORDS = frozenset(['struct', 'union', 'enum'])
+SKIP_KEYWORDS = frozenset(['extern', 'static', 'inline', '__inline', '__inline__', 'register'])
+
+
+# Tokens are (kind, text, offset) tuples.
+KIND, TEXT, OFFSET = range(3)
+
+
+class Function:
+    def __init__(self, name, params, role, line):
+        self.name = name
+        self.params = params  # list of [name, type]
+        self.role = role      # init, final, sender, receiver or None
+        self.line = line
+
+
+class Header:
+    # Result of parsing one header file.
+    def __init__(self):
+        self.functions = []
+        self.framings = []  # (name, framing dict), in header order
+        self.warnings = []
+
+    def role(self, role):
+        return [f for f in self.functions if f.role == role]
+
+
+def tokenize(text):
+    # Splits C source into tokens, keeping comments (they carry the miml
+    # directives) and whole preprocessor lines. Whitespace is dropped.
+    return [(m.lastgroup, m.group(m.lastgroup), m.start(m.lastgroup))
+            for m in TOKEN_RE.finditer(text) if m.lastgroup]
+
+
+def c_join(words):
+    # Joins declarator tokens the way they would be written by hand:
+    # "void", "(", "*", ")", "(", "int", ")" -> "void (*)(int)"
+    out = ''
+    for w in words:
+        if out and (w[0].isalnum() or w[0] == '_') and (out[-1].isalnum() or out[-1] in '_)'):
+            out += ' '
+        elif out and w == '(' and out[-1] != '(':
+            out += ' ' if out[-1] != ')' else ''
+        elif w == ',':
+            out += ', '
+            continue
+        out += w
+    return out
+
+
+def load_allowed_types(conf_file):
+    # allowed_types from cg.conf; const is not part of these names, the way
+    # codeGen.py's validate_params compares them.
+    config = yaml.safe_load(open(conf_file, 'r'))
+    return set(config['allowed_types'])
+
+
+class DeclarationParser:
+    # Splits a token stream into top-level declarations and turns function
+    # prototypes into Function objects.
+
+    def __init__(self, allowed_types):
+        self.allowed_types = allowed_types
+        self.typedefs = {}  # name -> list of type words
+        self.macros = {}    # object-like macro name -> list of tokens
+
+    def parse(self, text):
+        header = Header()
+        tokens = tokenize(text)
+        self.newlines = [m.start() for m in NEWLINE_RE.finditer(text)]
+        self.text = text
+        decl = []
+        role = None
+        depth = 0
+        linkage = []  # depth at each open extern "C" { block
+        i = 0
+        n = len(tokens)
+        while i < n:
+            kind, word, offset = tokens[i]
+            i += 1
+            if kind == 'preproc':
+                self.define(word)
+                continue
+            if kind == 'linecomment' or kind == 'blockcomment':
+                if 'framing' in word.lower():
+                    self.framing(word, offset, header)
+                if depth == 0 and decl:
+                    directive = DIRECTIVE_RE.search(word)
+                    if directive:
+                        role = directive.group(1).lower()
+                continue
+            if word == '{':
+                if depth == 0 and len(decl) == 2 and decl[0][TEXT] == 'extern' and decl[1][KIND] == 'string':
+                    # extern "C" { of the __cplusplus guard: its prototypes are top level
+                    linkage.append(depth)
+                    decl = []
+                    role = None
+                    continue
+                depth += 1
+                continue
+            if word == '}':
+                if linkage and linkage[-1] == depth:
+                    linkage.pop()
+                    continue
+                depth -= 1
+                if depth == 0 and decl and decl[-1][TEXT] == ')':
+                    # function definition, there is no ';' to wait for
+                    decl = []
+                    role = None
+                continue
+            if depth > 0:
+                continue
+            if word == ';':
+                # a directive may follow the ';' on the same line
+                if i < n and tokens[i][KIND] in ('linecomment', 'blockcomment') \
+                        and '\n' not in text[offset:tokens[i][OFFSET]]:
+                    directive = DIRECTIVE_RE.search(tokens[i][TEXT])
+                    if directive:
+                        role = directive.group(1).lower()
+                    i += 1
+                self.declaration(self.expand(decl), role, header)
+                decl = []
+                role = None
+                continue
+            decl.append((kind, word, offset))
+        return header
+
+    def framing(self, comment, offset, header):
+        # [miml:framing novatel_bin sync="24 42 49 4E ?? 00" length=6:2:little header=8
+        #  payload_extra=2 trailer="0D 0A" max_length=4084]
+        comment = COMMENT_LINE_RE.sub(" ", comment)  # the leading '*' of block comment lines
+        for match in FRAMING_RE.finditer(comment):
+            name = match.group(1)
+            framing = {}
+            for arg in FRAMING_ARG_RE.finditer(match.group(2)):
+                key = arg.group(1)
+                value = arg.group(2) if arg.group(2) is not None else arg.group(3)
+                if key in ('sync', 'trailer'):
+                    framing[key] = value
+                elif key == 'length':
+                    fields = value.split(':')
+                    try:
+                        framing[key] = {'offset': int(fields[0], 0), 'width': int(fields[1], 0),
+                                        'endian': fields[2] if len(fields) > 2 else 'little'}
+                    except (ValueError, IndexError):
+                        header.warnings.append("line %d: framing %s: length must be offset:width[:little|big]"
+                                               % (self.line(offset), name))
+                elif key in ('header', 'payload_extra', 'max_length'):
+                    try:
+                        framing[key] = int(value, 0)
+                    except ValueError:
+                        header.warnings.append("line %d: framing %s: %s is not a number" % (self.line(offset), name, key))
+                else:
+                    header.warnings.append("line %d: framing %s: unknown key %s" % (self.line(offset), name, key))
+            header.framings.append((name, framing))
+
+    def line(self, offset):
+        return bisect.bisect_left(self.newlines, offset) + 1
+
+    def define(self, text):
+        match = DEFINE_RE.match(text.replace('\\\n', ' '))
+        if match:
+            self.macros[match.group(1)] = [t for t in tokenize(match.group(2))
+                                           if t[KIND] not in ('linecomment', 'blockcomment')]
+
+    def expand(self, decl):
+        # One level of object-like macro expansion is enough for type aliases.
+        if not self.macros:
+            return decl
+        out = []
+        for tok in decl:
+            if tok[KIND] == 'ident' and tok[TEXT] in self.macros:
+                out.extend((t[KIND], t[TEXT], tok[OFFSET]) for t in self.macros[tok[TEXT]])
+            else:
+                out.append(tok)
+        return out
+
+    def declaration(self, decl, role, header):
+        if not decl:
+            return
+        words = [t[TEXT] for t in decl]
+        if words[0] == 'typedef':
+            self.typedef(words[1:])
+            return
+        if words[-1] != ')' or '(' not in words:
+            return
+        # name( params ) -- the name is the identifier before the first '('
+        # that is not part of a function pointer declarator.
+        open_idx = words.index('(')
+        if open_idx == 0 or decl[open_idx - 1][KIND] != 'ident' or words[open_idx - 1] in TYPE_KEYWORDS:
+            return
+        name = words[open_idx - 1]
+        line = self.line(decl[0][OFFSET])
+        params = self.split_params(words[open_idx + 1:-1])
+        result = []
+        for counter, param in enumerate(params, 1):
+            entry = self.parameter(param, counter, name, header, line)
+            if entry is not None:
+                result.append(entry)
+        header.functions.append(Function(name, result, role, line))
+
+    def typedef(self, words):
+        if len(words) >= 2 and '(' not in words:
+            self.typedefs[words[-1]] = words[:-1]
+
+    def split_params(self, words):
+        params = []
+        current = []
+        depth = 0
+        for w in words:
+            if w in ('(', '['):
+                depth += 1
+            elif w in (')', ']'):
+                depth -= 1
+            if w == ',' and depth == 0:
+                params.append(current)
+                current = []
+            else:
+                current.append(w)
+        if current:
+            params.append(current)
+        if params == [['void']]:
+            return []
+        return params
+
+    def parameter(self, words, counter, func, header, line):
+        if '(' in words:
+            # function pointer: keep the declarator as written
+            header.warnings.append("line %d: %s argument %d is a function pointer, check its MIML type"
+                                   % (line, func, counter))
+            inner = words[words.index('(') + 1:]
+            argname = next((w for w in inner if re.match(r"[A-Za-z_]\w*$", w)), "ARG" + str(counter))
+            declarator = [w for w in words if w != argname]
+            return [argname, c_join(declarator)]
+        words = [w for w in words if w not in SKIP_KEYWORDS]
+        stars = words.count('*')
+        words = [w for w in words if w != '*']
+        array = '[' in words
+        if array:
+            words = words[:words.index('[')]
+            stars += 1
+        argname = None
+        if len(words) > 1 and words[-1] not in TYPE_KEYWORDS and words[-1] not in self.typedefs \
+                and words[-2] not in TAG_KEYWORDS:
+            argname = words.pop()
+        if argname is None:
+            argname = "ARG" + str(counter)
+        base = [w for w in words if w not in ('const', 'volatile')]
+        resolved = self.resolve(base)
+        if resolved is not None and resolved != base:
+            words = [w for w in words if w in ('const', 'volatile')] + resolved
+            base = resolved
+        argtype = ' '.join(words) + '*' * stars
+        struct_pointer = len(base) == 2 and base[0] == 'struct' and stars == 1
+        if ' '.join(base) not in self.allowed_types and not struct_pointer:
+            header.warnings.append("line %d: %s argument %d has type '%s', which is not in allowed_types"
+                                   % (line, func, counter, argtype))
+        return [argname, argtype]
+
+    def resolve(self, base):
+        # Follows typedef chains down to a type in allowed_types, if any.
+        seen = set()
+        while len(base) == 1 and base[0] in self.typedefs and base[0] not in seen:
+            if ' '.join(base) in self.allowed_types:
+                return base
+            seen.add(base[0])
+            base = [w for w in self.typedefs[base[0]] if w not in ('const', 'volatile')]
+        if ' '.join(base) in self.allowed_types:
+            return base
+        return None
+
+
+def render_miml(header, inputfile, objfile):
+    out = ["%YAML 1.2\n---\ninclude: " + inputfile + "\nobject: " + objfile + "\n"]
+    inits = header.role('init')
+    finals = header.role('final')
+    if inits:
+        out.append("init: " + ''.join(f.name + "();" for f in inits) + "\n")
+    if finals:
+        out.append("final: " + ''.join(f.name + "();" for f in finals) + "\n\n")
+    else:
+        out.append("\n")
+    for title, role in (("# Functions that handle outgoing data\nsenders:\n", 'sender'),
+                        ("# Functions that handle incoming data\nreceivers:\n", 'receiver')):
+        out.append(title)
+        for f in header.role(role):
+            out.append("  " + f.name + ":\n")
+            for param in f.params:
+                out.append("  - [" + param[0] + ", " + param[1] + "]\n")
+        out.append("\n")
+    if header.framings:
+        out.append("# Framing of the serial protocols the module reads\nframing:\n")
+        for name, framing in header.framings:
+            out.append("  " + name + ":\n")
+            for key in ('sync', 'length', 'header', 'payload_extra', 'trailer', 'max_length'):
+                if key not in framing:
+                    continue
+                value = framing[key]
+                if key == 'length':
+                    value = "{offset: %d, width: %d, endian: %s}" % (value['offset'], value['width'], value['endian'])
+                elif isinstance(value, str):
+                    value = "'" + value + "'"
+                out.append("    " + key + ": " + str(value) + "\n")
+        out.append("\n")
+    return ''.join(out)
+
+
+def print_summary(inputfile, outputfile, header):
+    print("\n " + inputfile + "  ->  " + outputfile)
+    print("======================================================")
+    print(" Init\tFinal\tSenders\t  Receivers					 ")
+    print("------------------------------------------------------")
+    print(" " + str(len(header.role('init'))) + "\t" + str(len(header.role('final'))) + "\t" +
+          str(len(header.role('sender'))) + "\t  " + str(len(header.role('receiver'))))
+    print("")
+
+
+def file_names(argv):
+    # Returns (header, object, miml) file names for the command line arguments.
+    inputfile = argv[1]
+    rpos = inputfile.rfind(".")
+
+    if len(argv) == 2:
+        outputfile = inputfile
+        outputfile += ".miml"
+
+    if str(inputfile[rpos:]) != ".h" and (rpos > 0):
+        print("Error: Input file not a .h file.")
+        sys.exit(-1)
+    elif rpos < 0:
+        objfile = inputfile + ".o"
+        inputfile += ".h"
+    else:
+        objfile = inputfile[:rpos] + ".o"
+
+    if len(argv) == 3:
+        outputfile = argv[2]
+        rpos = outputfile.rfind(".")
+        if (str(outputfile[rpos:]) != ".miml") and (rpos > 0):
+            print("Error: Output file not a .miml file.")
+            sys.exit(-1)
+        elif rpos < 0:
+            outputfile += ".miml"
+    return inputfile, objfile, outputfile
+
+
+def generate_header(count):
+    # A large synthetic header for benchmarking: typedefs, macros, comments,
+    # single and multi-line prototypes with pointer and struct parameters.
+    out = ["#ifndef BENCH_H_\n#define BENCH_H_\n#define BUFTYPE unsigned char\ntypedef int count_t;\n"]
+    for i in range(count):
+        if i % 4 == 0:
+            out.append("/* block comment %d */\nextern void sendMessage_%d(const char *src,\n"
+                       "\tBUFTYPE *buffer, /* data */\n\tint length); // [miml:sender]\n" % (i, i))
+        elif i % 4 == 1:
+            out.append("extern void getMessage_%d(const char *src, unsigned char *buffer, count_t length); "
+                       "// [miml:receiver]\n" % i)
+        elif i % 4 == 2:
+            out.append("void getState_%d(struct state *s, char **names, int32_t n); // [miml:receiver]\n" % i)
+        else:
+            out.append("static inline int helper_%d(int a) { return a + 1; }\n" % i)
+    out.append("#endif\n")
+    return ''.join(out)
+
+
+def benchmark(count, allowed_types):
+    text = generate_header(count)
+    start = time.perf_counter()
+    header = DeclarationParser(allowed_types).parse(text)
+    elapsed = time.perf_counter() - start
+    print("parsed %d lines, %d prototypes in %.3f s (%.1f us/prototype, %.0f lines/s)"
+          % (text.count('\n'), len(header.functions), elapsed,
+             elapsed * 1e6 / max(len(header.functions), 1), text.count('\n') / elapsed))
+
+
+INDEX_FILE = ".header2miml.index"
+BATCH_PATTERN = "module_*.h"
+
+
+def write_if_changed(filename, text):
+    # Returns True if the file was (re)written.
+    try:
+        if open(filename, 'r').read() == text:
+            return False
+    except IOError:
+        pass
+    with open(filename, 'w') as f:
+        f.write(text)
+    return True
+
+
+def header_counts(header):
+    return [len(header.role(role)) for role in ('init', 'final', 'sender', 'receiver')]
+
+
+def batch_worker(job):
+    # Parses one header of a batch run and writes its MIML file if it changed.
+    # Runs in a worker process, so it only takes and returns plain data.
+    directory, name, allowed_types = job
+    base = name[:-len(".h")]
+    text = open(os.path.join(directory, name), 'r').read()
+    header = DeclarationParser(allowed_types).parse(text)
+    written = write_if_changed(os.path.join(directory, base + ".miml"),
+                               render_miml(header, name, base + ".o"))
+    return {'name': name, 'status': 'written' if written else 'unchanged',
+            'sha1': hashlib.sha1(text.encode()).hexdigest(),
+            'counts': header_counts(header), 'warnings': header.warnings}
+
+
+def batch(directory, conf_file, jobs):
+    # Regenerates <module>.miml for every module_*.h in directory. An index of
+    # mtime, size and content hash per header skips headers that did not
+    # change since the last run; a header whose mtime changed but whose content
+    # did not is only re-hashed. MIML files are only written when they differ.
+    start = time.time()
+    conf_text = open(conf_file, 'r').read()
+    allowed_types = set(yaml.safe_load(conf_text)['allowed_types'])
+    conf_hash = hashlib.sha1((conf_text + open(__file__, 'r').read()).encode()).hexdigest()
+
+    index_file = os.path.join(directory, INDEX_FILE)
+    try:
+        index = json.load(open(index_file, 'r'))
+    except (IOError, ValueError):
+        index = {}
+    if index.get('conf') != conf_hash:
+        # different cg.conf or a different header2Miml.py: redo everything
+        index = {'conf': conf_hash, 'headers': {}}
+
+    results = []
+    todo = []
+    for name in sorted(fnmatch.filter(os.listdir(directory), BATCH_PATTERN)):
+        filename = os.path.join(directory, name)
+        st = os.stat(filename)
+        entry = index['headers'].get(name)
+        miml = os.path.join(directory, name[:-len(".h")] + ".miml")
+        if entry is not None and os.path.isfile(miml):
+            if entry['mtime'] == st.st_mtime_ns and entry['size'] == st.st_size:
+                results.append(dict(entry, name=name, status='skipped'))
+                continue
+            sha1 = hashlib.sha1(open(filename, 'rb').read()).hexdigest()
+            if entry['sha1'] == sha1:
+                entry['mtime'] = st.st_mtime_ns
+                results.append(dict(entry, name=name, status='skipped'))
+                continue
+        todo.append((directory, name, allowed_types))
+
+    if jobs > 1 and len(todo) > 1:
+        with multiprocessing.Pool(min(jobs, len(todo))) as pool:
+            done = pool.map(batch_worker, todo)
+    else:
+        done = [batch_worker(job) for job in todo]
+
+    for result in done:
+        st = os.stat(os.path.join(directory, result['name']))
+        index['headers'][result['name']] = {'mtime': st.st_mtime_ns, 'size': st.st_size,
+                                            'sha1': result['sha1'], 'counts': result['counts'],
+                                            'warnings': result['warnings']}
+        results.append(result)
+    write_if_changed(index_file, json.dumps(index, indent=1, sort_keys=True))
+
+    results.sort(key=lambda r: r['name'])
+    for result in results:
+        for warning in result['warnings']:
+            print("Warning: " + result['name'] + ": " + warning)
+    print("\n " + directory + ": " + str(len(results)) + " module header(s)")
+    print("==========================================================================")
+    print(" %-34s %-10s %5s %6s %8s %10s" % ("Module", "Status", "Init", "Final", "Senders", "Receivers"))
+    print("--------------------------------------------------------------------------")
+    for result in results:
+        print(" %-34s %-10s %5d %6d %8d %10d" % tuple([result['name'], result['status']] + result['counts']))
+    print("--------------------------------------------------------------------------")
+    written = len([r for r in results if r['status'] == 'written'])
+    print(" %d written, %d unchanged, %d skipped in %.2f s\n"
+          % (written, len(done) - written, len(results) - len(done), time.time() - start))
+
+
+def main(argv):
+    if len(argv) >= 3 and argv[1] == '--dir':
+        argparser = argparse.ArgumentParser(prog=argv[0] + ' --dir')
+        argparser.add_argument('directory', help='directory of module_*.h files')
+        argparser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                               help='worker processes (default: one per core)')
+        argparser.add_argument('--conf', default='cg.conf', help='code generator config with allowed_types')
+        args = argparser.parse_args(argv[2:])
+        try:
+            batch(args.directory, args.conf, args.jobs)
+        except IOError as e:
+            print("I/O error({0}): {1} --> {2}".format(e.errno, e.filename, e.strerror))
+            sys.exit(-1)
+        return
+    if len(argv) == 3 and argv[1] == '--benchmark':
+        benchmark(int(argv[2]), load_allowed_types('cg.conf'))
+        return
+    if (len(argv) < 2):
+        print("Error: Too few arguments.")
+        sys.exit(-1)
+    elif len(argv) > 3:
+        print("Error: Too many arguments.")
+        sys.exit(-1)
+
+    inputfile, objfile, outputfile = file_names(argv)
+
+    try:
+        text = open(inputfile, 'r').read()
+    except IOError as e:
+        print("I/O error({0}): Input header file --> {1}".format(e.errno, e.strerror))
+        sys.exit(-1)
+
+    try:
+        allowed_types = load_allowed_types('cg.conf')
+    except IOError as e:
+        print("I/O error({0}): cg.conf --> {1}".format(e.errno, e.strerror))
+        sys.exit(-1)
+
+    header = DeclarationParser(allowed_types).parse(text)
+    for warning in header.warnings:
+        print("Warning: " + inputfile + ": " + warning)
+
+    try:
+        fout = open(outputfile, 'w')
+    except IOError as e:
+        print("I/O error({0}): Output Miml file --> {1}".format(e.errno, e.strerror))
+        sys.exit(-1)
+    fout.write(render_miml(header, inputfile, objfile))
+    fout.close()
+
+    print_summary(inputfile, outputfile, header)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+#
+# logreader.py -- reads fourcc-tagged flight logs into NumPy arrays.
+#
+# Logs are written by av3-basic's logging.c and examples/utils/utils_log.c. A
+# record is a 12 byte header followed by its payload:
+#
+#     fourcc (4 bytes) | length (>u2) | timestamp_hi (>u2) | timestamp_lo (>u4)
+#
+# where the timestamp is in ns since logging started. The same records travel
+# in UDP buckets (port 5005), each led by a big-endian sequence number.
+#
+# The log file is memory-mapped and its record boundaries are found in one
+# pass. The offsets of every fourcc are cached in <log>.idx.npz, so later loads
+# skip the scan. A stream is returned as one structured array, sliced from the
+# mapping with vectorized gathers: a 'timestamp' field (ns) and either the
+# fields of the fcflog.yaml schema written by codeGen.py, or the raw payload.
+#
+# Usage:
+#     logreader.py logs/000 [--schema fcflog.yaml] [--save streams.npz]
+#     logreader.py --pcap capture.pcap [--port 5005] [--schema fcflog.yaml]
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+import yaml
+
+HEADER_SIZE = 12
+HEADER = np.dtype([('fourcc', 'S4'), ('length', '>u2'), ('timestamp_hi', '>u2'), ('timestamp_lo', '>u4')])
+INDEX_VERSION = 1
+REMOTE_PORT = 5005
+
+
+class LogError(Exception):
+    pass
+
+
+##
+# Record boundaries of buf, a bytes-like object of concatenated records.
+# @return (offsets of the records as int64, offset of the first byte after the
+#          last complete record)
+def scan(buf):
+    offsets = []
+    append = offsets.append
+    size = len(buf)
+    end = size - HEADER_SIZE
+    pos = 0
+    # The walk is sequential by nature, every length leads to the next record;
+    # it only reads two bytes per record, everything else is vectorized later.
+    while pos <= end:
+        following = pos + HEADER_SIZE + ((buf[pos + 4] << 8) | buf[pos + 5])
+        if following > size:
+            break
+        append(pos)
+        pos = following
+    return np.array(offsets, dtype=np.int64), pos
+
+
+##
+# Split record offsets by fourcc.
+# @return A dict of fourcc => offsets in file order. Fourccs are str, decoded
+#         as latin-1, since some carry a binary id byte (e.g. GPS message ids).
+def index_offsets(data, offsets):
+    if len(offsets) == 0:
+        return {}
+    codes = gather(data, offsets, 4).view('>u4').ravel()
+    order = np.argsort(codes, kind='stable')
+    keys, starts = np.unique(codes[order], return_index=True)
+    groups = np.split(offsets[order], starts[1:])
+    return dict((fourcc_name(key), group) for key, group in zip(keys, groups))
+
+
+def fourcc_name(code):
+    return int(code).to_bytes(4, 'big').decode('latin-1')
+
+
+##
+# Bytes [offset, offset + width) of every offset, as an (n, width) uint8 array.
+# Indexes a sliding window view, so only the result is allocated.
+def gather(data, offsets, width):
+    if len(data) < width:
+        return np.empty((0, width), dtype=np.uint8)
+    return np.lib.stride_tricks.sliding_window_view(data, width)[offsets]
+
+
+##
+# Structured dtype of one record type of the schema, without the timestamp.
+def schema_dtype(record):
+    names, formats, offsets = [], [], []
+    for field in record['fields']:
+        names.append(field['name'])
+        dtype = np.dtype(field['dtype'])
+        formats.append(dtype if field.get('count', 1) == 1 else (dtype, (field['count'],)))
+        offsets.append(field['offset'])
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': record['size']})
+
+
+##
+# A log file, or the reassembled payload of a bucket capture.
+class FlightLog:
+
+    def __init__(self, path=None, schema=None, cache=True, data=None):
+        self.path = path
+        self.trailing = 0
+        self.gaps = []
+        self.schema = {}
+        if schema is not None:
+            self.schema = (yaml.safe_load(open(schema, 'r')) or {}).get('records') or {}
+        if data is None:
+            f = open(path, 'rb')
+            size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            f.close()
+        else:
+            self.map = data
+        self.data = np.frombuffer(self.map, dtype=np.uint8)
+        self.index = None
+        if cache and path is not None and data is None:
+            self.index = self.load_index()
+        if self.index is None:
+            offsets, end = scan(self.map)
+            self.trailing = len(self.map) - end
+            self.index = index_offsets(self.data, offsets)
+            if cache and path is not None and data is None:
+                self.save_index()
+
+    def index_file(self):
+        return self.path + ".idx.npz"
+
+    def stamp(self):
+        st = os.stat(self.path)
+        return np.array([INDEX_VERSION, st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+    def load_index(self):
+        # The cache is only used while the log's size and mtime are unchanged.
+        try:
+            with np.load(self.index_file()) as cached:
+                if not np.array_equal(cached['stamp'], self.stamp()):
+                    return None
+                self.trailing = int(cached['trailing'])
+                return dict((fourcc_name(int(name[len('fourcc_'):], 16)), cached[name])
+                            for name in cached.files if name.startswith('fourcc_'))
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+    def save_index(self):
+        arrays = dict(('fourcc_' + key.encode('latin-1').hex(), offsets) for key, offsets in self.index.items())
+        try:
+            np.savez(self.index_file(), stamp=self.stamp(), trailing=np.int64(self.trailing), **arrays)
+        except (IOError, OSError) as err:
+            sys.stderr.write("cannot write index %s: %s\n" % (self.index_file(), err))
+
+    def fourccs(self):
+        return sorted(self.index)
+
+    def count(self, fourcc):
+        return len(self.index.get(fourcc, ()))
+
+    ##
+    # Headers of every record of a fourcc, as a HEADER structured array.
+    def headers(self, fourcc):
+        offsets = self.index[fourcc]
+        return gather(self.data, offsets, HEADER_SIZE).view(HEADER).ravel()
+
+    ##
+    # One stream as a structured array: 'timestamp' (ns, uint64) and the schema
+    # fields of the fourcc, or 'payload' (raw bytes) when it has no schema.
+    # Records of different lengths (text, raw buffers) come back as 'offset' and
+    # 'length' fields instead; payload(fourcc, i) returns their bytes.
+    def stream(self, fourcc):
+        if fourcc not in self.index:
+            raise LogError("no records with fourcc %r" % fourcc)
+        offsets = self.index[fourcc]
+        headers = self.headers(fourcc)
+        timestamps = (headers['timestamp_hi'].astype(np.uint64) << np.uint64(32)) | headers['timestamp_lo']
+        lengths = headers['length'].astype(np.int64)
+        if len(lengths) == 0 or lengths.min() != lengths.max():
+            result = np.empty(len(offsets), dtype=[('timestamp', '<u8'), ('offset', '<i8'), ('length', '<u2')])
+            result['offset'] = offsets + HEADER_SIZE
+            result['length'] = lengths
+            result['timestamp'] = timestamps
+            return result
+        length = int(lengths[0])
+        if fourcc in self.schema:
+            payload_dtype = schema_dtype(self.schema[fourcc])
+            if payload_dtype.itemsize != length:
+                raise LogError("fourcc %s: records are %d bytes, the schema says %d" % (fourcc, length, payload_dtype.itemsize))
+        else:
+            payload_dtype = np.dtype([('payload', 'V%d' % length)]) if length else np.dtype([])
+        payload = gather(self.data, offsets + HEADER_SIZE, length).view(payload_dtype).ravel() if length else None
+        fields = [('timestamp', '<u8')] + [(name, payload_dtype.fields[name][0]) for name in payload_dtype.names]
+        result = np.empty(len(offsets), dtype=fields)
+        result['timestamp'] = timestamps
+        for name in payload_dtype.names:
+            result[name] = payload[name]
+        return result
+
+    def payload(self, fourcc, i):
+        offset = int(self.index[fourcc][i])
+        length = (self.data[offset + 4] << 8) | self.data[offset + 5]
+        return bytes(self.map[offset + HEADER_SIZE:offset + HEADER_SIZE + length])
+
+
+##
+# UDP payloads to a port from a libpcap capture (Ethernet, Linux cooked or raw
+# IP link types, IPv4 only).
+# @return A list of payloads, in capture order.
+def pcap_datagrams(path, port):
+    data = open(path, 'rb').read()
+    magic = data[:4]
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+        endian = '<'
+    elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        endian = '>'
+    else:
+        raise LogError("%s is not a pcap capture" % path)
+    linktype = struct.unpack(endian + 'I', data[20:24])[0]
+    link_header = {1: 14, 113: 16, 101: 0, 228: 0}.get(linktype)
+    if link_header is None:
+        raise LogError("unsupported pcap link type %d" % linktype)
+    record = struct.Struct(endian + 'IIII')
+    datagrams = []
+    pos = 24
+    while pos + record.size <= len(data):
+        caplen = record.unpack_from(data, pos)[2]
+        packet = data[pos + record.size:pos + record.size + caplen]
+        pos += record.size + caplen
+        ip = packet[link_header:]
+        if len(ip) < 20 or ip[0] >> 4 != 4 or ip[9] != 17:
+            continue
+        udp = ip[(ip[0] & 0x0f) * 4:]
+        if len(udp) < 8 or struct.unpack('>H', udp[2:4])[0] != port:
+            continue
+        datagrams.append(udp[8:struct.unpack('>H', udp[4:6])[0]])
+    return datagrams
+
+
+##
+# Reassemble buckets into one record stream, ordered by sequence number.
+# Duplicates are dropped; gaps lose whole buckets, never part of a record,
+# since a record is never split across buckets.
+# @return (concatenated records, list of (first missing seq, missing count))
+def reassemble(datagrams):
+    buckets = {}
+    for datagram in datagrams:
+        if len(datagram) >= 4:
+            buckets.setdefault(struct.unpack('>I', datagram[:4])[0], datagram[4:])
+    if not buckets:
+        return b'', []
+    seqs = np.array(sorted(buckets), dtype=np.int64)
+    steps = np.diff(seqs)
+    gaps = [(int(seqs[i]) + 1, int(steps[i]) - 1) for i in np.nonzero(steps > 1)[0]]
+    return b''.join(buckets[int(seq)] for seq in seqs), gaps
+
+
+def open_capture(path, port=REMOTE_PORT, schema=None):
+    data, gaps = reassemble(pcap_datagrams(path, port))
+    log = FlightLog(path, schema, cache=False, data=data)
+    log.gaps = gaps
+    return log
+
+
+def summary(log):
+    print("\n%-6s %10s %10s %14s %14s %10s" % ('fourcc', 'records', 'bytes', 'first [s]', 'last [s]', 'rate [Hz]'))
+    for fourcc in log.fourccs():
+        headers = log.headers(fourcc)
+        timestamps = (headers['timestamp_hi'].astype(np.uint64) << np.uint64(32)) | headers['timestamp_lo']
+        first, last = timestamps.min() / 1e9, timestamps.max() / 1e9
+        rate = (len(headers) - 1) / (last - first) if last > first else 0.0
+        print("%-6s %10d %10d %14.6f %14.6f %10.1f" % (fourcc, len(headers), int(headers['length'].astype(np.int64).sum()),
+                                                      first, last, rate))
+    if log.trailing:
+        print("(%d bytes of a truncated record at the end)" % log.trailing)
+    for (seq, missing) in log.gaps:
+        print("gap: %d bucket(s) missing from seq %d" % (missing, seq))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Read fourcc-tagged flight logs.')
+    argparser.add_argument('log', help='log file, or pcap capture with --pcap')
+    argparser.add_argument('--schema', help='record layouts written by codeGen.py (fcflog.yaml)')
+    argparser.add_argument('--pcap', action='store_true', help='log is a pcap capture of the UDP buckets')
+    argparser.add_argument('--port', type=int, default=REMOTE_PORT, help='UDP port of the buckets')
+    argparser.add_argument('--no-cache', action='store_true', help='neither read nor write the offset index')
+    argparser.add_argument('--save', help='save every stream to this .npz file')
+    args = argparser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        if args.pcap:
+            log = open_capture(args.log, args.port, args.schema)
+        else:
+            log = FlightLog(args.log, args.schema, cache=not args.no_cache)
+        streams = dict((fourcc, log.stream(fourcc)) for fourcc in log.fourccs())
+    except (LogError, IOError, OSError) as err:
+        sys.stderr.write("%s\n" % err)
+        sys.exit(-1)
+    summary(log)
+    print("loaded %d records in %.2f s" % (sum(len(s) for s in streams.values()), time.perf_counter() - start))
+    if args.save:
+        np.savez(args.save, **streams)
+
+
+if __name__ == '__main__':
+    main()
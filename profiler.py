@@ -1,15 +1,176 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
+#
+# profiler.py -- in-process microbenchmarks of generated message code.
+#
+# Loads the framework, the generated fcfmain.c and the user modules as a shared
+# library (built without main(), see "make lib" in examples/devicelog) and calls
+# the generated message functions and the registered poll callbacks directly in
+# tight loops. Reports ns/call after a warmup, over several repetitions.
+#
+# The loops run on the C side, so a sample costs one ctypes call however many
+# calls it times: message functions are sent n times by the generated
+# fcf_lib_repeat_<message>(), poll callbacks are looped by fcf_lib_dispatch().
+# The "net" column leaves out the loop itself, timed with the empty
+# fcf_lib_loop().
+
+import argparse
+import ctypes
+import csv
 import os
+import re
+import statistics
 import sys
+import time
+
+import yaml
+
+# MIML parameter base types => ctypes types, for non-pointer parameters.
+CTYPES = {
+    'int': ctypes.c_int,
+    'char': ctypes.c_byte,
+    'unsigned char': ctypes.c_ubyte,
+    'int32_t': ctypes.c_int32,
+}
+
+BUFFER_SIZE = 1024
+
+# Parameters that pass a buffer of the framework's pool, see fcf_buf_alloc().
+POOLED_TYPE = re.compile(r"^struct\s+fcf_buf\s*\*$")
+
+
+##
+# ctypes type and a sample value for one MIML parameter type string.
+def param_type(miml_type, int_value):
+    base = miml_type.replace('const', '').strip()
+    if base.endswith('*'):
+        return ctypes.c_void_p, ctypes.cast(ctypes.create_string_buffer(BUFFER_SIZE), ctypes.c_void_p)
+    if base not in CTYPES:
+        sys.stderr.write("unknown parameter type '%s', passing it as int\n" % miml_type)
+    ctype = CTYPES.get(base, ctypes.c_int)
+    return ctype, ctype(int_value)
+
+
+##
+# Sends of a message function, n at a time, through its fcf_lib_repeat_<func>().
+# Pooled parameters are not passed: the generated loop allocates a fresh buffer
+# for every send, so the time includes one round trip through the pool.
+# @return A function of n that sends the message n times.
+def repeat_calls(lib, func, miml_types, int_value):
+    params = [param_type(t, int_value) for t in miml_types if not POOLED_TYPE.match(t.strip())]
+    fn = lib['fcf_lib_repeat_' + func]
+    fn.restype = ctypes.c_long
+    fn.argtypes = [ctype for ctype, _ in params] + [ctypes.c_long]
+    values = [value for _, value in params]
+
+    def call(n):
+        if fn(*(values + [n])) < n:
+            raise RuntimeError("the buffer pool is empty, receivers of %s keep their references" % func)
+
+    return call
+
+
+##
+# Read Main.miml and the module MIMLs it references.
+# @return A dict of message function name => list of MIML parameter types.
+def message_signatures(miml_file):
+    base = os.path.dirname(os.path.abspath(miml_file))
+    master = yaml.safe_load(open(miml_file, 'r'))
+    modules = {}
+    for token, filename in master['sources']:
+        modules[token] = yaml.safe_load(open(os.path.join(base, filename), 'r'))
+    signatures = {}
+    for message in master.get('messages') or {}:
+        (src, func) = message.split('.')
+        signatures[func] = [param[1] for param in modules[src]['senders'][func] or []]
+    return signatures
+
+
+##
+# Time repeat runs of call(loops), a C loop of loops calls.
+# @return The ns/call of every repetition.
+def time_repeat(call, warmup, repeat, loops):
+    call(warmup)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        call(loops)
+        samples.append((time.perf_counter_ns() - start) / float(loops))
+    return samples
+
+
+def summary(name, samples, overhead):
+    # Below the empty loop is noise, not a negative cost.
+    median = statistics.median(samples)
+    return [name, len(samples), min(samples), median, statistics.mean(samples),
+            statistics.stdev(samples) if len(samples) > 1 else 0.0,
+            max(median - overhead, 0.0)]
+
 
 def main():
-  os.fsync()	# Clean any opened files
-  pid = os.fork()
-  time = da
-  if pid > 0:
-    os.execve(sys.argv[1])
-  
+    argparser = argparse.ArgumentParser(description='ctypes microbenchmarks of generated message code.')
+    argparser.add_argument('--lib', default='./libfc.so', help='shared library built with "make lib"')
+    argparser.add_argument('--miml', default='Main.miml', help='Main MIML file the library was generated from')
+    argparser.add_argument('--warmup', type=int, default=10000, help='calls before timing starts')
+    argparser.add_argument('--repeat', type=int, default=10, help='timed repetitions per function')
+    argparser.add_argument('--loops', type=int, default=100000, help='calls per repetition')
+    argparser.add_argument('--int-value', type=int, default=1, help='value passed for integer parameters')
+    argparser.add_argument('--callbacks', action='store_true',
+                           help='also loop every registered poll callback (callbacks that read their fd may block)')
+    argparser.add_argument('--csv', help='append the results to this CSV file')
+    argparser.add_argument('functions', nargs='*', help='message functions to run (default: all)')
+    args = argparser.parse_args()
+
+    lib = ctypes.CDLL(os.path.abspath(args.lib))
+    lib.fcf_lib_dispatch.argtypes = [ctypes.c_int, ctypes.c_long]
+    lib.fcf_lib_loop.argtypes = [ctypes.c_long]
+    signatures = message_signatures(args.miml)
+    functions = args.functions or sorted(signatures)
+
+    if lib.fcf_lib_init() != 0:
+        sys.stderr.write("fcf_lib_init failed\n")
+        sys.exit(-1)
+
+    rows = []
+    try:
+        overhead = statistics.median(time_repeat(lib.fcf_lib_loop, args.warmup, args.repeat, args.loops))
+        for func in functions:
+            if func not in signatures:
+                sys.stderr.write("%s is not a message function in %s\n" % (func, args.miml))
+                continue
+            try:
+                call = repeat_calls(lib, func, signatures[func], args.int_value)
+            except AttributeError:
+                sys.stderr.write("%s: no fcf_lib_repeat_%s() in %s, regenerate the code and rebuild it\n"
+                                 % (func, func, args.lib))
+                continue
+            try:
+                rows.append(summary(func, time_repeat(call, args.warmup, args.repeat, args.loops), overhead))
+            except RuntimeError as err:
+                sys.stderr.write("%s: %s\n" % (func, err))
+
+        if args.callbacks:
+            for idx in range(lib.fcf_lib_nfds()):
+                dispatch = lambda n: lib.fcf_lib_dispatch(idx, n)
+                rows.append(summary("callback[%d]" % idx,
+                                    time_repeat(dispatch, args.warmup, args.repeat, args.loops), overhead))
+    finally:
+        lib.fcf_lib_finalize()
+
+    print("\n%-32s %6s %10s %10s %10s %10s %10s" % ('function', 'reps', 'min', 'median', 'mean', 'stdev', 'net'))
+    for row in rows:
+        print("%-32s %6d %10.1f %10.1f %10.1f %10.1f %10.1f" % tuple(row))
+    print("(ns/call; net = median minus the empty loop, %.1f ns/iteration)" % overhead)
+
+    if args.csv:
+        write_header = not os.path.exists(args.csv)
+        with open(args.csv, 'a') as f:
+            target = csv.writer(f)
+            if write_header:
+                target.writerow(['Date', 'Library', 'Function', 'Repetitions', 'Min ns/call', 'Median ns/call',
+                                 'Mean ns/call', 'Stdev ns/call', 'Net ns/call'])
+            for row in rows:
+                target.writerow([time.strftime('%Y-%m-%d %H:%M:%S'), args.lib] + row)
 
 
-if __name__=="__main__":
-  main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+#
+# benchmatrix.py -- runtime throughput matrix for generated bindings.
+#
+# For every combination of fan-out, arity and optimization level this script
+# generates a small benchmark module plus a Main.miml binding, runs codeGen.py
+# on it, builds fc with the flags taken from examples/devicelog/Makefile and
+# runs the result several times. Each run reports how many messages were sent
+# in how much time; the runs are summarized as messages/sec with a confidence
+# interval and written to one CSV report. Every poll cycle sends a burst of
+# messages, so the fan-out and arity costs are not buried in the poll loop's.
+
+import argparse
+import csv
+import logging
+import math
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEVICELOG = os.path.join(ROOT, "examples", "devicelog")
+
+# Makefile variables that select an optimization level, by short name.
+OPT_LEVELS = {"live": "OPTSLIVE", "dev": "OPTSDEV", "prof": "OPTSPROF"}
+
+# Two-sided 95% critical values of Student's t distribution, by degrees of
+# freedom. Anything above 30 uses the normal approximation.
+T_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447,
+        7: 2.365, 8: 2.306, 9: 2.262, 10: 2.228, 11: 2.201, 12: 2.179,
+        13: 2.160, 14: 2.145, 15: 2.131, 16: 2.120, 17: 2.110, 18: 2.101,
+        19: 2.093, 20: 2.086, 21: 2.080, 22: 2.074, 23: 2.069, 24: 2.064,
+        25: 2.060, 26: 2.056, 27: 2.052, 28: 2.048, 29: 2.045, 30: 2.042}
+
+FINISHED_RE = re.compile(r"Finished with count: (\d+) in (\d+)\.(\d+) sec")
+
+REPORT_HEADER = ["Revision", "Optimization", "Arity", "Fan-out", "Burst", "Runs",
+                 "Messages/sec (mean)", "Messages/sec (95% CI +/-)",
+                 "Messages/sec (stdev)", "Messages/sec (min)",
+                 "Messages/sec (max)", "Deliveries/sec (mean)"]
+
+MODULE_H = """\
+/*
+ * module_bench.h
+ * generated by benchmatrix.py, arity %(arity)d, fan-out %(fanout)d
+ */
+
+#ifndef MODULE_BENCH_H_
+#define MODULE_BENCH_H_
+
+extern void init_bench(void); // [miml:init]
+extern void finalize_bench(void); // [miml:final]
+extern void sendMessage_bench(%(proto)s); // [miml:sender]
+%(receivers)s
+#endif /* MODULE_BENCH_H_ */
+"""
+
+MODULE_C = """\
+/*
+ * module_bench.c
+ * generated by benchmatrix.py, arity %(arity)d, fan-out %(fanout)d
+ *
+ * Works like devicelog's module_profile: a timer fd is armed once and never
+ * read, so it stays readable and the poll loop calls bench_cb on every cycle.
+ * Each call sends BENCH_BURST messages through the generated fan-out.
+ */
+#include <sys/timerfd.h>
+#include <stdio.h>
+#include <time.h>
+#include <unistd.h>
+#include <poll.h>
+#include "module_bench.h"
+#include "fcfutils.h"
+
+#ifndef BENCH_COUNT
+#define BENCH_COUNT 10000000
+#endif
+#ifndef BENCH_BURST
+#define BENCH_BURST 64
+#endif
+
+static unsigned long int sent = 0;
+static unsigned long int delivered = 0;
+static volatile long int sink = 0;
+static int fd = -1;
+static struct timespec start;
+static struct timespec end;
+
+static void bench_cb (struct pollfd * pfd) {
+	int x = pfd->revents;
+	(void) x;
+	for (int i = 0; i < BENCH_BURST; i++) {
+		sendMessage_bench(%(args)s);
+		if (++sent == BENCH_COUNT) {
+			clock_gettime(CLOCK_MONOTONIC, &end);
+			fcf_stop_main_loop();
+			return;
+		}
+	}
+}
+
+%(bodies)s
+void init_bench() {
+	struct itimerspec t = {{0, 0}, {0, 1}};
+	fd = timerfd_create(CLOCK_MONOTONIC, 0);
+	timerfd_settime(fd, 0, &t, NULL);
+	fcf_add_fd (fd, POLLIN, bench_cb);
+	clock_gettime(CLOCK_MONOTONIC, &start);
+	end = start;
+}
+
+void finalize_bench() {
+	if (end.tv_sec == start.tv_sec && end.tv_nsec == start.tv_nsec) {
+		clock_gettime(CLOCK_MONOTONIC, &end);
+	}
+	long int sec = end.tv_sec - start.tv_sec;
+	long int nsec = end.tv_nsec - start.tv_nsec;
+	if (nsec < 0) {
+		sec--;
+		nsec += 1000000000;
+	}
+	printf("\\n\\nFinished with count: %%lu in %%ld.%%09ld sec\\n", sent, sec, nsec);
+	printf("Delivered: %%lu\\n\\n", delivered);
+	if (fd >= 0) {
+		fcf_remove_fd(fd);
+		close(fd);
+		fd = -1;
+	}
+}
+"""
+
+RECEIVER_C = """\
+void getMessage_bench%(k)d(%(proto)s) {
+	delivered++;
+	sink += %(sum)s;
+}
+"""
+
+
+##
+# Read the simple ":=" / "=" variable assignments of a Makefile.
+# @param filename: The Makefile to read.
+# @return A dict of variable name => unexpanded value.
+def read_make_vars(filename):
+    assign = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)\s*[:?]?=\s*(.*)$")
+    variables = {}
+    for line in open(filename, "r"):
+        match = assign.match(line.rstrip("\n"))
+        if match:
+            variables[match.group(1)] = match.group(2).strip()
+    return variables
+
+
+##
+# Expand $(VAR) references in a Makefile value. $(shell ...) calls are
+# dropped, the benchmark does not link against anything they would add.
+def expand_make_value(value, variables):
+    value = re.sub(r"\$\(shell [^)]*\)", "", value)
+    value = re.sub(r"\$\((\w+)\)",
+                   lambda m: " ".join(expand_make_value(variables.get(m.group(1), ""), variables)),
+                   value)
+    return value.split()
+
+
+##
+# Collect the compiler and linker flags for one optimization level the same
+# way the Makefile's all/debug/prof targets do.
+# @return (cflags, ldflags, ldlibs) as lists.
+def variant_flags(variables, opt_var):
+    cflags = expand_make_value(variables["CFLAGS"], variables)
+    opts = expand_make_value(variables.get(opt_var, ""), variables)
+    cflags = [f for f in cflags if f != "-MD"] + opts
+    ldflags = opts
+    ldlibs = expand_make_value(variables.get("LDLIBS", ""), variables)
+    return cflags, ldflags, ldlibs
+
+
+def write_file(filename, text):
+    with open(filename, "w") as f:
+        f.write(text)
+
+
+##
+# Generate module_bench.{h,c,miml}, Main.miml and cg.conf in build_dir.
+def write_variant(build_dir, arity, fanout):
+    names = ["a%d" % i for i in range(arity)]
+    proto = ", ".join("int " + n for n in names) or "void"
+    subst = {
+        "arity": arity,
+        "fanout": fanout,
+        "proto": proto,
+        "args": ", ".join(["x"] * arity),
+        "receivers": "".join("extern void getMessage_bench%d(%s); // [miml:receiver]\n" % (k, proto)
+                             for k in range(fanout)),
+        "bodies": "\n".join(RECEIVER_C % {"k": k, "proto": proto, "sum": " + ".join(names) or "0"}
+                            for k in range(fanout)),
+    }
+    write_file(os.path.join(build_dir, "module_bench.h"), MODULE_H % subst)
+    write_file(os.path.join(build_dir, "module_bench.c"), MODULE_C % subst)
+
+    params = [[n, "int"] for n in names]
+    module = {
+        "include": "module_bench.h",
+        "object": "module_bench.o",
+        "init": "init_bench();",
+        "final": "finalize_bench();",
+        "senders": {"sendMessage_bench": params},
+        "receivers": dict(("getMessage_bench%d" % k, params) for k in range(fanout)),
+    }
+    binding = {
+        "sources": [["BENCH", "module_bench.miml"]],
+        "messages": {"BENCH.sendMessage_bench": ["BENCH.getMessage_bench%d" % k for k in range(fanout)]},
+    }
+    config = yaml.safe_load(open(os.path.join(DEVICELOG, "cg.conf"), "r"))
+    config["framework_dir"] = ROOT
+
+    write_file(os.path.join(build_dir, "module_bench.miml"), yaml.safe_dump(module))
+    write_file(os.path.join(build_dir, "Main.miml"), yaml.safe_dump(binding))
+    write_file(os.path.join(build_dir, "cg.conf"), yaml.safe_dump(config))
+
+
+##
+# Run codeGen.py in build_dir and compile fc.
+def build_variant(build_dir, flags, count, burst):
+    cflags, ldflags, ldlibs = flags
+    subprocess.check_call([sys.executable, os.path.join(ROOT, "codeGen.py"),
+                           "-c", "-b", "-m", "Main.miml"], cwd=build_dir)
+    if not os.path.isfile(os.path.join(build_dir, "fcfmain.c")):
+        raise RuntimeError("codeGen.py did not generate fcfmain.c in " + build_dir)
+    cc = os.environ.get("CC", "cc")
+    sources = [os.path.join(ROOT, "fcfutils.c"), "fcfmain.c", "module_bench.c"]
+    objects = []
+    for source in sources:
+        obj = os.path.splitext(os.path.basename(source))[0] + ".o"
+        subprocess.check_call([cc] + cflags + ["-I.", "-I" + ROOT, "-DBENCH_COUNT=%d" % count,
+                                               "-DBENCH_BURST=%d" % burst, "-c", "-o", obj, source], cwd=build_dir)
+        objects.append(obj)
+    subprocess.check_call([cc] + ldflags + ["-o", "fc"] + objects + ldlibs, cwd=build_dir)
+
+
+##
+# Run fc once and parse its "Finished with count" line.
+# @return (messages/sec, deliveries/sec)
+def run_variant(build_dir, timeout):
+    out = subprocess.run(["./fc"], cwd=build_dir, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, timeout=timeout,
+                         universal_newlines=True).stdout
+    match = FINISHED_RE.search(out)
+    delivered = re.search(r"Delivered: (\d+)", out)
+    if not match or not delivered:
+        raise RuntimeError("fc did not report a result:\n" + out)
+    seconds = int(match.group(2)) + int(match.group(3)) / 10.0 ** len(match.group(3))
+    return int(match.group(1)) / seconds, int(delivered.group(1)) / seconds
+
+
+##
+# Mean and half width of the 95% confidence interval of samples.
+def confidence_interval(samples):
+    mean = statistics.mean(samples)
+    if len(samples) < 2:
+        return mean, float("nan")
+    t = T_95.get(len(samples) - 1, 1.960)
+    return mean, t * statistics.stdev(samples) / math.sqrt(len(samples))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(rows):
+    print("%-6s %6s %8s %6s %16s %14s %18s" % ("opt", "arity", "fan-out", "burst", "msgs/sec", "95% CI +/-",
+                                               "deliveries/sec"))
+    for row in rows:
+        print("%-6s %6d %8d %6d %16.0f %14.0f %18.0f" % (row[1], row[2], row[3], row[4], row[6], row[7], row[11]))
+
+
+def int_list(text):
+    return [int(x) for x in text.split(",")]
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Throughput matrix for generated MIML bindings.")
+    argparser.add_argument("--fanouts", type=int_list, default=[1, 2, 4, 8],
+                           help="comma separated receiver counts (default 1,2,4,8)")
+    argparser.add_argument("--arities", type=int_list, default=[2, 26],
+                           help="comma separated int argument counts (default 2,26)")
+    argparser.add_argument("--opts", default="live,dev,prof",
+                           help="comma separated optimization levels out of " + ",".join(OPT_LEVELS))
+    argparser.add_argument("--runs", type=int, default=5, help="runs per variant (default 5)")
+    argparser.add_argument("--count", type=int, default=10000000, help="messages sent per run")
+    argparser.add_argument("--burst", type=int, default=64,
+                           help="messages sent per poll cycle (default 64, 1 measures mostly the poll loop)")
+    argparser.add_argument("--timeout", type=float, default=300, help="seconds before a run is killed")
+    argparser.add_argument("--makefile", default=os.path.join(DEVICELOG, "Makefile"),
+                           help="Makefile to take OPTSLIVE/OPTSDEV/OPTSPROF from")
+    argparser.add_argument("--workdir", help="keep build directories here instead of a temp dir")
+    argparser.add_argument("-o", "--output", default=os.path.join("profiler-data", "benchmatrix.csv"),
+                           help="CSV report to append to")
+    args = argparser.parse_args()
+    if os.path.exists(args.output):
+        with open(args.output, "r", newline="") as f:
+            header = next(csv.reader(f), None)
+        if header and header != REPORT_HEADER + ["Date"]:
+            sys.exit("%s has the columns of another version of this script, use -o to start a new report"
+                     % args.output)
+
+    variables = read_make_vars(args.makefile)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmatrix-")
+    revision = git_revision()
+    rows = []
+    try:
+        for opt in args.opts.split(","):
+            flags = variant_flags(variables, OPT_LEVELS[opt])
+            for arity in args.arities:
+                for fanout in args.fanouts:
+                    build_dir = os.path.join(workdir, "%s-a%d-f%d" % (opt, arity, fanout))
+                    os.makedirs(build_dir, exist_ok=True)
+                    logging.info("building %s", build_dir)
+                    write_variant(build_dir, arity, fanout)
+                    build_variant(build_dir, flags, args.count, args.burst)
+                    rates = []
+                    deliveries = []
+                    for run in range(args.runs):
+                        rate, delivered = run_variant(build_dir, args.timeout)
+                        logging.info("  run %d: %.0f msgs/sec", run + 1, rate)
+                        rates.append(rate)
+                        deliveries.append(delivered)
+                    mean, ci = confidence_interval(rates)
+                    rows.append([revision, opt, arity, fanout, args.burst, len(rates), mean, ci,
+                                 statistics.stdev(rates) if len(rates) > 1 else 0.0,
+                                 min(rates), max(rates), statistics.mean(deliveries)])
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report_dir = os.path.dirname(args.output)
+    if report_dir and not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+    write_header = not os.path.exists(args.output)
+    with open(args.output, "a", newline="") as f:
+        target = csv.writer(f)
+        if write_header:
+            target.writerow(REPORT_HEADER + ["Date"])
+        for row in rows:
+            target.writerow(row + [time.strftime("%Y-%m-%d %H:%M:%S")])
+    print_table(rows)
+    logging.info("report written to %s", args.output)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(levelname)s\t[%(asctime)s]\t%(message)s",
+        level=logging.INFO)
+    main()
@@ -0,0 +1,186 @@
+/*
+ * framerbench.c
+ *
+ * Throughput of the ring buffer framer (examples/utils/utils_framer.c)
+ * against the linear buffer scanner gps.c used before it, on NovAtel "$BIN"
+ * streams: clean frames, frames in '$'-rich garbage, and large frames that
+ * arrive a few bytes per read, like a serial port delivers them.
+ *
+ *	make framerbench && ./framerbench [MB]
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include "../examples/utils/utils_framer.h"
+
+#define RUNS 3
+
+static const struct fcf_framing novatel_bin = {
+	.name = "novatel_bin",
+	.sync = (const unsigned char *) "$BIN\0\0",
+	.sync_mask = (const unsigned char *) "\xff\xff\xff\xff\x00\xff",
+	.sync_length = 6,
+	.length_offset = 6,
+	.length_width = 2,
+	.header_length = 8,
+	.payload_extra = 2,
+	.trailer = (const unsigned char *) "\r\n",
+	.trailer_length = 2,
+	.max_length = 4096 - 12,
+};
+
+struct result {
+	unsigned long frames;
+	unsigned long sum;	/* of payload bytes, to compare the two framers */
+};
+
+/* Not inlined: real callers pass frames on to another module. */
+__attribute__((noinline)) static void count(struct result *r, const unsigned char *payload, size_t length) {
+	r->frames++;
+	for (size_t i = 0; i < length; i += 64) {
+		r->sum += payload[i];
+	}
+	r->sum += length;
+}
+
+/* gps.c's find_frames(), with its 4096 byte buffer. The length check is new:
+ * without it a false "$BIN" with a length beyond the buffer stalls it forever. */
+static unsigned char buf[4096], *cur = buf;
+
+static void find_frames(struct result *r) {
+	unsigned char *pos = buf;
+	while ((pos = memchr(pos, '$', cur - pos))) {
+		if (cur - pos < 8)
+			break;
+		if (memcmp(pos + 1, "BIN", 3) != 0 || pos[5] != 0) {
+			++pos;
+			continue;
+		}
+		int data_length = pos[6] | (pos[7] << 8);
+		if (data_length + 12 > (int) sizeof(buf)) {
+			++pos;
+			continue;
+		}
+		if (cur - pos < data_length + 12)
+			break;
+		if (memcmp(pos + data_length + 10, "\r\n", 2) != 0) {
+			pos += 4;
+			continue;
+		}
+		count(r, pos + 8, data_length + 2);
+		pos += data_length + 12;
+	}
+	if (pos == NULL)
+		cur = buf;
+	else {
+		memmove(buf, pos, cur - pos);
+		cur -= pos - buf;
+	}
+}
+
+static void linear(const unsigned char *data, size_t len, size_t chunk, struct result *r) {
+	cur = buf;
+	for (size_t off = 0; off < len; off += chunk) {
+		size_t n = len - off < chunk ? len - off : chunk;
+		if (n > sizeof(buf) - (cur - buf))
+			n = sizeof(buf) - (cur - buf);
+		memcpy(cur, data + off, n);
+		cur += n;
+		find_frames(r);
+		off -= chunk - n;	/* the rest of the chunk comes next round */
+	}
+}
+
+static void frame_cb(void *arg, const unsigned char *frame, const unsigned char *payload, size_t length) {
+	count(arg, payload, length);
+}
+
+static void ring(const unsigned char *data, size_t len, size_t chunk, struct result *r) {
+	struct fcf_framer *framer = fcf_framer_new(&novatel_bin, 4096, frame_cb, r);
+	if (framer == NULL) {
+		perror("fcf_framer_new");
+		exit(EXIT_FAILURE);
+	}
+	for (size_t off = 0; off < len; off += chunk) {
+		fcf_framer_feed(framer, data + off, len - off < chunk ? len - off : chunk);
+	}
+	fcf_framer_free(framer);
+}
+
+static size_t put_frame(unsigned char *p, int id, int data_length) {
+	memcpy(p, "$BIN", 4);
+	p[4] = id;
+	p[5] = 0;
+	p[6] = data_length & 0xff;
+	p[7] = data_length >> 8;
+	for (int i = 0; i < data_length + 2; i++) {
+		p[8 + i] = rand();
+	}
+	memcpy(p + 8 + data_length + 2, "\r\n", 2);
+	return data_length + 12;
+}
+
+/* Fills data with frames of min..max data bytes, each after up to noise bytes of garbage. */
+static size_t stream(unsigned char *data, size_t len, int min, int max, int noise) {
+	static const char junk[] = "$$BI$BIN$BIN\x01\x01";
+	size_t n = 0;
+	srand(1);
+	while (n + max + 12 + noise <= len) {
+		for (int g = noise ? rand() % noise : 0; g > 0; g--) {
+			data[n++] = rand() % 4 ? junk[rand() % (sizeof(junk) - 1)] : rand();
+		}
+		n += put_frame(data + n, rand() & 0xff, min + rand() % (max - min + 1));
+	}
+	return n;
+}
+
+static double now(void) {
+	struct timespec t;
+	clock_gettime(CLOCK_MONOTONIC, &t);
+	return t.tv_sec + t.tv_nsec / 1e9;
+}
+
+int main(int argc, char *argv[]) {
+	size_t mb = argc > 1 ? atoi(argv[1]) : 64;
+	unsigned char *data = malloc(mb << 20);
+	unsigned long frames = 0;
+	static const struct {
+		const char *name;
+		int min, max, noise;
+		size_t chunk;
+	} cases[] = {
+		{ "clean, 4 KB reads", 20, 200, 0, 4096 },
+		{ "garbage, 4 KB reads", 20, 200, 64, 4096 },
+		{ "3 KB frames, 16 byte reads", 3000, 4000, 0, 16 },
+	};
+
+	printf("%-28s %10s %12s %12s %8s\n", "stream", "frames", "linear MB/s", "ring MB/s", "speedup");
+	for (size_t c = 0; c < sizeof(cases) / sizeof(cases[0]); c++) {
+		size_t len = stream(data, mb << 20, cases[c].min, cases[c].max, cases[c].noise);
+		double best[2] = { 1e9, 1e9 };
+
+		/* Best of RUNS, alternating, so neither framer gets the warmer caches. */
+		for (int run = 0; run < RUNS; run++) {
+			struct result a = { 0 }, b = { 0 };
+			double t0 = now();
+			linear(data, len, cases[c].chunk, &a);
+			double t1 = now();
+			ring(data, len, cases[c].chunk, &b);
+			double t2 = now();
+
+			if (a.frames != b.frames || a.sum != b.sum) {
+				fprintf(stderr, "%s: linear found %lu frames, ring %lu\n", cases[c].name, a.frames, b.frames);
+				return EXIT_FAILURE;
+			}
+			frames = b.frames;
+			best[0] = t1 - t0 < best[0] ? t1 - t0 : best[0];
+			best[1] = t2 - t1 < best[1] ? t2 - t1 : best[1];
+		}
+		printf("%-28s %10lu %12.0f %12.0f %7.1fx\n", cases[c].name, frames,
+		       len / best[0] / (1 << 20), len / best[1] / (1 << 20), best[0] / best[1]);
+	}
+	free(data);
+	return 0;
+}
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+#
+# loadgen.py -- virtual device load generator and capacity ramp for fc.
+#
+# Emulates N virtual devices that send UDP packets to the ports devicelog's
+# module_virtdev listens on (8081 and 8082), each device with its own port,
+# rate, payload size and jitter model. Every packet starts with the device's
+# number and a sequence number, 32-bit big-endian; module_virtdev reports both
+# through sendStamp_virtdev, which Load.miml logs as VDEV records. The records
+# come back in fc's telemetry buckets on UDP port 5005, so what fc actually
+# took in is measured by fc itself: received packets per device, their loss,
+# and the rate in fc's own timestamps.
+#
+# The offered load is ramped in steps, each scaling every device's rate by
+# --factor, until fc loses more than --max-loss of a step's packets or the
+# generator cannot send any faster. The highest rate fc took in is the
+# capacity of the build.
+#
+# Usage:
+#     cd examples/devicelog && make clean-objects && make MAINMIML=Load.miml
+#     ../../profiler/loadgen.py [--device PORT:RATE:SIZE:JITTER ...] ./fc
+#
+# Without a command, loadgen.py drives an fc that is already running.
+
+import argparse
+import asyncio
+import csv
+import logging
+import os
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+import numpy as np
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import logreader  # noqa: E402
+
+TELEMETRY_PORT = 5005
+DEFAULT_PORTS = [8081, 8082]
+STAMP = struct.Struct(">II")
+STAMP_MESSAGE = "VIRT.sendStamp_virtdev"
+JITTER_MODELS = ["none", "uniform", "normal", "exp", "burst"]
+BATCH = 256  # packets a device sends before it yields to the others
+
+REPORT_HEADER = ["Revision", "Label", "Devices", "Payload bytes", "Capacity packets/sec",
+                 "Capacity MB/sec", "Offered packets/sec", "Saturated at packets/sec", "Limit"]
+
+
+##
+# Gaps between the packets of one device, in seconds, for a mean period.
+#   none        every period
+#   uniform:F   period * (1 +- F), uniformly
+#   normal:F    period * (1 + N(0, F)), never below 0
+#   exp         exponential gaps: Poisson arrivals
+#   burst:N     N packets back to back every N periods
+class Jitter:
+
+    def __init__(self, spec, seed):
+        name, _, arg = spec.partition(":")
+        if name not in JITTER_MODELS:
+            raise ValueError("unknown jitter model %r, use one of %s" % (name, ", ".join(JITTER_MODELS)))
+        self.name = name
+        self.arg = float(arg) if arg else {"uniform": 0.1, "normal": 0.1, "burst": 8}.get(name, 0)
+        if name == "burst" and self.arg < 1:
+            raise ValueError("burst:N needs N >= 1")
+        self.random = random.Random(seed)
+        self.count = 0
+
+    def gap(self, period):
+        if self.name == "uniform":
+            return period * (1 + self.random.uniform(-self.arg, self.arg))
+        if self.name == "normal":
+            return max(0.0, period * (1 + self.random.gauss(0, self.arg)))
+        if self.name == "exp":
+            return self.random.expovariate(1.0 / period)
+        if self.name == "burst":
+            self.count += 1
+            return period * self.arg if self.count % int(self.arg) == 0 else 0.0
+        return period
+
+    def __str__(self):
+        return self.name if self.name in ("none", "exp") else "%s:%g" % (self.name, self.arg)
+
+
+##
+# One virtual device: a connected non-blocking UDP socket and a packet
+# template whose first 8 bytes are the stamp.
+class Device:
+
+    def __init__(self, number, port, rate, size, jitter, host):
+        if size < STAMP.size:
+            raise ValueError("device %d: payloads are at least %d bytes" % (number, STAMP.size))
+        self.number = number
+        self.port = port
+        self.rate = rate
+        self.size = size
+        self.jitter = jitter
+        self.seq = 0
+        self.refused = 0
+        self.packet = bytearray(os.urandom(size))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.connect((host, port))
+
+    def send(self):
+        STAMP.pack_into(self.packet, 0, self.number, self.seq)
+        try:
+            self.sock.send(self.packet)
+        except BlockingIOError:
+            return False
+        except ConnectionRefusedError:
+            # An earlier packet found nobody listening; this one was not sent.
+            self.refused += 1
+            return False
+        self.seq += 1
+        return True
+
+    ##
+    # Send at rate * scale packets a second until the loop time reaches
+    # until, or as fast as possible for a rate of 0. Packets that are due are
+    # sent at once, at most BATCH before yielding, so the mean rate holds when
+    # the event loop wakes up late.
+    async def run(self, scale, until):
+        loop = asyncio.get_running_loop()
+        period = 1.0 / (self.rate * scale) if self.rate > 0 else 0.0
+        due = loop.time()
+        while True:
+            now = loop.time()
+            if now >= until:
+                return
+            sent = 0
+            while due <= now and sent < BATCH:
+                if self.send():
+                    due += self.jitter.gap(period) if period else 0.0
+                sent += 1
+            if due > now:
+                await asyncio.sleep(min(due, until) - now)
+            else:
+                await asyncio.sleep(0)
+
+    def close(self):
+        self.sock.close()
+
+    def __str__(self):
+        rate = "%g/s" % self.rate if self.rate > 0 else "max"
+        return "device %d: port %d, %s, %d bytes, jitter %s" % (self.number, self.port, rate, self.size, self.jitter)
+
+
+##
+# Collects fc's telemetry buckets. Buckets are parsed in batches by
+# Telemetry.stamps(), outside the receive path.
+class Telemetry(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.datagrams = []
+        self.seqs = []
+
+    def datagram_received(self, data, addr):
+        self.datagrams.append(data)
+
+    ##
+    # Stamps of the buckets received since the last call.
+    # @return A structured array with 'timestamp' (ns), 'device', 'seq' and
+    #         'length' fields, the layout of fourcc in the schema.
+    def stamps(self, schema, fourcc):
+        datagrams, self.datagrams = self.datagrams, []
+        self.seqs.extend(struct.unpack(">I", d[:4])[0] for d in datagrams if len(d) >= 4)
+        data, _ = logreader.reassemble(datagrams)
+        log = logreader.FlightLog(schema=schema, cache=False, data=data)
+        if log.count(fourcc) == 0:
+            return np.empty(0, dtype=[("timestamp", "<u8"), ("device", "<i4"), ("seq", "<i4"), ("length", "<i4")])
+        return log.stream(fourcc)
+
+    ##
+    # Buckets lost on the way from fc, going by their sequence numbers.
+    def gaps(self):
+        if not self.seqs:
+            return 0
+        seqs = np.unique(self.seqs)
+        return int(seqs[-1] - seqs[0] + 1 - len(seqs))
+
+
+##
+# Fourcc of the stamp records in a schema written by codeGen.py.
+def stamp_fourcc(schema):
+    records = (yaml.safe_load(open(schema, "r")) or {}).get("records") or {}
+    for fourcc, record in records.items():
+        if record.get("message") == STAMP_MESSAGE:
+            return fourcc
+    raise logreader.LogError("%s: %s is not logged, build fc with Load.miml" % (schema, STAMP_MESSAGE))
+
+
+class Step:
+
+    def __init__(self, number, scale, devices):
+        self.number = number
+        self.scale = scale
+        self.offered = sum(d.rate * scale for d in devices if d.rate > 0)
+        self.unbounded = any(d.rate <= 0 for d in devices)
+        self.first = [d.seq for d in devices]
+        self.last = None
+        self.duration = 0.0
+        self.sent = 0
+        self.received = 0
+        self.rate = 0.0
+        self.loss = 0.0
+        self.refused = 0
+
+    ##
+    # Received packets and loss of the step, from the stamps of all steps so
+    # far. With final false, packets after the last one received are not
+    # counted as lost yet: their stamps may still wait in fc's open bucket.
+    def measure(self, stamps, devices, final):
+        received = 0
+        expected = 0
+        first_ns, last_ns = None, None
+        for device, first, last in zip(devices, self.first, self.last):
+            mine = stamps[(stamps["device"] == device.number) & (stamps["seq"] >= first) & (stamps["seq"] < last)]
+            seqs = np.unique(mine["seq"])
+            received += len(seqs)
+            if final:
+                expected += last - first
+            elif len(seqs):
+                expected += int(seqs[-1]) - first + 1
+            if len(mine):
+                lo, hi = int(mine["timestamp"].min()), int(mine["timestamp"].max())
+                first_ns = lo if first_ns is None else min(first_ns, lo)
+                last_ns = hi if last_ns is None else max(last_ns, hi)
+        self.received = received
+        self.loss = 1.0 - received / expected if expected else (1.0 if self.sent else 0.0)
+        # fc's rate, in its own clock; the step's length when all came at once.
+        span = (last_ns - first_ns) / 1e9 if first_ns is not None and last_ns > first_ns else self.duration
+        self.rate = (received - 1) / span if received > 1 and span > 0 else 0.0
+
+    def offered_text(self):
+        if self.unbounded:
+            return "max" if self.offered == 0 else "%.0f+max" % self.offered
+        return "%.0f" % self.offered
+
+    @property
+    def send_rate(self):
+        return self.sent / self.duration if self.duration else 0.0
+
+
+##
+# Devices from --device specs PORT[:RATE[:SIZE[:JITTER]]], or count devices
+# spread over the default ports.
+def make_devices(specs, count, rate, size, jitter, seed, host):
+    devices = []
+    if not specs:
+        specs = ["%d" % DEFAULT_PORTS[i % len(DEFAULT_PORTS)] for i in range(count)]
+    for number, spec in enumerate(specs):
+        parts = spec.split(":", 3)
+        port = int(parts[0])
+        device_rate = float(parts[1]) if len(parts) > 1 and parts[1] else rate
+        device_size = int(parts[2]) if len(parts) > 2 and parts[2] else size
+        device_jitter = parts[3] if len(parts) > 3 and parts[3] else jitter
+        devices.append(Device(number, port, device_rate, device_size, Jitter(device_jitter, seed + number), host))
+    return devices
+
+
+async def start_fc(command, warmup):
+    process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.DEVNULL)
+    await asyncio.sleep(warmup)
+    if process.returncode is not None:
+        raise RuntimeError("%s exited with %d before the first step" % (command[0], process.returncode))
+    return process
+
+
+async def stop_fc(process, timeout):
+    if process.returncode is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("fc did not stop on SIGINT, killing it")
+            process.kill()
+            await process.wait()
+
+
+async def ramp(args, devices, fourcc):
+    loop = asyncio.get_running_loop()
+    telemetry = Telemetry()
+    transport, _ = await loop.create_datagram_endpoint(lambda: telemetry, local_addr=(args.host, args.telemetry_port))
+    transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 24)
+    process = await start_fc(args.command, args.warmup) if args.command else None
+
+    steps = []
+    stamps = []
+    limit = "steps"
+    try:
+        scale = 1.0
+        for number in range(args.steps):
+            step = Step(number + 1, scale, devices)
+            refused = sum(d.refused for d in devices)
+            start = loop.time()
+            await asyncio.gather(*(d.run(scale, start + args.step) for d in devices))
+            step.duration = loop.time() - start
+            step.last = [d.seq for d in devices]
+            step.sent = sum(last - first for first, last in zip(step.first, step.last))
+            step.refused = sum(d.refused for d in devices) - refused
+            steps.append(step)
+
+            await asyncio.sleep(args.settle)
+            stamps.append(telemetry.stamps(args.schema, fourcc))
+            step.measure(np.concatenate(stamps), devices, final=False)
+            logging.info("step %d: offered %.0f/s, sent %.0f/s, fc took %.0f/s, loss %.2f%%",
+                         step.number, step.offered, step.send_rate, step.rate, 100 * step.loss)
+            if process is not None and process.returncode is not None:
+                limit = "fc exited"
+                break
+            if step.loss > args.max_loss:
+                limit = "fc"
+                break
+            if step.offered == 0 or (not step.unbounded and step.send_rate < (1 - args.max_loss) * step.offered):
+                limit = "generator"
+                break
+            scale *= args.factor
+    finally:
+        if process is not None:
+            await stop_fc(process, args.timeout)
+        # fc flushes its open bucket when it stops.
+        await asyncio.sleep(args.settle)
+        stamps.append(telemetry.stamps(args.schema, fourcc))
+        transport.close()
+
+    all_stamps = np.concatenate(stamps)
+    for step in steps:
+        step.measure(all_stamps, devices, final=process is not None)
+    return steps, limit, telemetry.gaps()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(steps):
+    print("\n%4s %14s %14s %14s %12s %9s %9s" % ("step", "offered/s", "sent/s", "fc took/s", "received", "loss %", "refused"))
+    for step in steps:
+        print("%4d %14s %14.0f %14.0f %12d %9.2f %9d" % (step.number, step.offered_text(), step.send_rate, step.rate,
+                                                     step.received, 100 * step.loss, step.refused))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Virtual device load generator and capacity ramp for fc.")
+    argparser.add_argument("command", nargs=argparse.REMAINDER,
+                           help="fc and its arguments, started and stopped by loadgen.py (default: drive a running fc)")
+    argparser.add_argument("-d", "--device", action="append", default=[],
+                           help="a device PORT[:RATE[:SIZE[:JITTER]]], repeatable; a rate of 0 sends as fast as possible")
+    argparser.add_argument("-n", "--devices", type=int, default=2,
+                           help="devices without --device, alternating over ports %s" % ",".join(map(str, DEFAULT_PORTS)))
+    argparser.add_argument("--rate", type=float, default=1000, help="packets/sec per device in the first step")
+    argparser.add_argument("--size", type=int, default=64, help="payload bytes (at least %d)" % STAMP.size)
+    argparser.add_argument("--jitter", default="none", help="jitter model: %s" % ", ".join(JITTER_MODELS))
+    argparser.add_argument("--factor", type=float, default=2.0, help="rate factor from one step to the next")
+    argparser.add_argument("--steps", type=int, default=16, help="most steps to ramp")
+    argparser.add_argument("--step", type=float, default=3.0, help="seconds per step")
+    argparser.add_argument("--settle", type=float, default=0.5, help="seconds to wait for telemetry after a step")
+    argparser.add_argument("--warmup", type=float, default=1.0, help="seconds between starting fc and the first step")
+    argparser.add_argument("--timeout", type=float, default=10.0, help="seconds fc gets to stop on SIGINT")
+    argparser.add_argument("--max-loss", type=float, default=0.01, help="loss that saturates fc (default 0.01)")
+    argparser.add_argument("--schema", default="fcflog.yaml", help="record layouts written by codeGen.py")
+    argparser.add_argument("--host", default="127.0.0.1", help="host of fc")
+    argparser.add_argument("--telemetry-port", type=int, default=TELEMETRY_PORT, help="UDP port of fc's buckets")
+    argparser.add_argument("--seed", type=int, default=0, help="seed of the jitter models")
+    argparser.add_argument("--label", help="name of the build in the report (default: the command)")
+    argparser.add_argument("-o", "--output", default=os.path.join("profiler-data", "loadgen.csv"),
+                           help="CSV report to append to")
+    args = argparser.parse_args()
+    if args.factor <= 1:
+        argparser.error("--factor must be above 1")
+
+    try:
+        fourcc = stamp_fourcc(args.schema)
+        devices = make_devices(args.device, args.devices, args.rate, args.size, args.jitter, args.seed, args.host)
+    except (logreader.LogError, IOError, OSError, ValueError) as err:
+        sys.stderr.write("%s\n" % err)
+        sys.exit(-1)
+    for device in devices:
+        logging.info("%s", device)
+
+    try:
+        steps, limit, gaps = asyncio.run(ramp(args, devices, fourcc))
+    except (RuntimeError, OSError) as err:
+        sys.stderr.write("%s\n" % err)
+        sys.exit(-1)
+    finally:
+        for device in devices:
+            device.close()
+
+    print_table(steps)
+    if gaps:
+        print("(%d telemetry bucket(s) lost, their packets count as lost)" % gaps)
+    if not steps:
+        return
+    best = max(steps, key=lambda s: s.rate)
+    size = sum(d.size for d in devices) / len(devices)
+    last = steps[-1]
+    print("\ncapacity: %.0f packets/sec (%.2f MB/sec of payload) at an offered %s/sec" %
+          (best.rate, best.rate * size / 1e6, best.offered_text()))
+    if limit == "fc":
+        print("saturated at an offered %s/sec with %.2f%% loss" % (last.offered_text(), 100 * last.loss))
+    elif limit == "generator":
+        print("limited by the load generator at %.0f/sec, fc may take more" % last.send_rate)
+    elif limit == "fc exited":
+        print("fc exited during step %d" % last.number)
+
+    report_dir = os.path.dirname(args.output)
+    if report_dir and not os.path.isdir(report_dir):
+        os.makedirs(report_dir)
+    write_header = not os.path.exists(args.output)
+    with open(args.output, "a", newline="") as f:
+        target = csv.writer(f)
+        if write_header:
+            target.writerow(REPORT_HEADER + ["Date"])
+        target.writerow([git_revision(), args.label or " ".join(args.command) or "running fc", len(devices),
+                         "%g" % size, "%.0f" % best.rate, "%.3f" % (best.rate * size / 1e6), best.offered_text(),
+                         last.offered_text() if limit == "fc" else "", limit,
+                         time.strftime("%Y-%m-%d %H:%M:%S")])
+    logging.info("report written to %s", args.output)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(levelname)s\t[%(asctime)s]\t%(message)s",
+        level=logging.INFO)
+    main()
@@ -1,6 +1,6 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #import logger
-import logging, sys, os, time, shutil, pexpect, subprocess, re, csv
+import logging, sys, os, time, shutil, subprocess, re, csv, signal, argparse, json, select, socket
 
 csv_target = "profiler-data/output.csv"
 SIG_PROF_KILL = 2929
@@ -30,6 +30,28 @@ program-name        The name of the program to run
 program_arguments   Arguments to supply to the program program_name.
 
 -c|--csv="file"     The filename to use for CSV output.
+
+       ./runprog --pgo [--miml file] [--counts file] time program_name [program_arguments ...]
+
+--pgo               Profile-guided build. Run from a directory whose Makefile
+                    has the pgo-generate and pgo-use targets (see
+                    examples/devicelog). Builds and runs the plain build, an
+                    instrumented build and the profile-guided build for the
+                    given time each and reports the throughput and latency
+                    deltas. Call counts of the generated message functions
+                    are handed to codeGen.py to mark them hot or cold.
+
+       ./runprog --soak [--interval secs] [--warmup secs] [--series "file"]
+                 [--telemetry [--port port]] time program_name [program_arguments ...]
+
+--soak              Long runs. Samples the program's /proc/<pid> status, io,
+                    open fd count and scheduler stats every interval (10 s)
+                    and appends them to the series (profiler-data/soak.csv),
+                    next to the gprof profile of -pg builds. At the end of
+                    each run, trends in RSS, fd count, context switches and
+                    CPU time are flagged. With --telemetry the records of
+                    the program's log buckets (UDP port 5005) are counted,
+                    and CPU time is taken per message instead of per second.
 """
     )
 
@@ -106,20 +128,20 @@ class GProfOut:
 
     def __str__(self):
         s = "\n"
-        for (name, f) in self.functions.iteritems():
+        for (name, f) in self.functions.items():
             s += "%s" % f
             s += ">> Run time for %s: %s seconds" % (name, self.time_run)
         return s
 
     def tocsv(self):
         mycsvs = []
-        for (name,func) in self.functions.iteritems():
+        for (name,func) in self.functions.items():
             mycsvs.append("%s,%s" % (self.time_run, func.tocsv()))
         return '\n'.join(mycsvs)
 
     def as_list(self):
         lst = []
-        for func in self.functions.itervalues():
+        for func in self.functions.values():
             lst.append([str(self.time_run)] + func.as_list())
         return lst
 
@@ -127,8 +149,9 @@ class GProfOut:
 # Run the program for the specified number of times.
 # @param t: how long to run the program.
 # @param args: The program arguments.
+# @param monitor: A SoakMonitor to sample the child while it runs, or None.
 #
-def run_for_time(t, args):
+def run_for_time(t, args, monitor=None):
     pid = os.fork()
     outfd = 0
     sleep_time = t
@@ -138,10 +161,18 @@ def run_for_time(t, args):
         os.dup2(outfd, STDOUT)
         os.execvp(args[0], args)
     else:           # We're the parent.
-        time.sleep(sleep_time)
+        if monitor is None:
+            time.sleep(sleep_time)
+        elif not monitor.watch(pid, sleep_time):
+            logging.warning("The child exited before %d seconds" % (sleep_time))
+            os.dup2(STDOUT, outfd)
+            return
 
         # Send the SIGINT signal
         os.kill(pid, SIGINT)
+        if monitor is not None:
+            # gprof needs the gmon.out the child writes on its way out.
+            os.waitpid(pid, 0)
 
         os.dup2(STDOUT, outfd)
 
@@ -166,8 +197,9 @@ def print_test_header(arg_time, iter):
 # Given a filename in gprof format, parse its information
 # for analysis.
 # @param filename: The filename in gprof format.
+# @param program: The program and its arguments, by default from the command line.
 # @return A GProfOut object representing the information.
-def parse_output_file(filename):
+def parse_output_file(filename, program=None):
     line_regex = '((\d)?\s*\d+\.?\d+)+\s+\w*'
     split_regex = '(\s){1,7}'
 
@@ -175,8 +207,9 @@ def parse_output_file(filename):
     re_split = re.compile(split_regex)
 
     p = subprocess.Popen("gprof -b --flat-profile %s %s" %
-                    (' '.join(sys.argv[2:]),filename), shell=True,
-                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                    (' '.join(program or sys.argv[2:]),filename), shell=True,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    universal_newlines=True)
     lines = []
     line = ""
     while (True):
@@ -200,7 +233,7 @@ def parse_output_file(filename):
     for func in funclist:
         if len(func) != 7:
             func = fill_func(func)
-        print func
+        print(func)
         gpo.functions[func[6]] = CFunc(func)
 
     return gpo
@@ -226,8 +259,8 @@ def arr_to_secs(time):
 
 def secs_to_arr(time):
     return [
-        (time / 3600) % 3600,
-        (time / 60 ) % 60,
+        (time // 3600) % 3600,
+        (time // 60 ) % 60,
         (time % 60) % 60
     ]
 
@@ -252,26 +285,410 @@ def dump_to_csv_file(results, header):
         subprocess.call(["touch", csv_target])
         write_header = True
 
-    csv_file = open(csv_target, "r+b")
+    csv_file = open(csv_target, "r+")
 
     lines = csv_file.readlines()
     if len(lines) > 0:
         if lines[0] != header:
             csv_file.close()
-            csv_file = open(csv_target, "a+b")
+            csv_file = open(csv_target, "a+")
             csv_file.write(header)
             csv_file.writelines(lines)
             csv_file.close
 
-    with open(csv_target, "ab") as csv_file:
+    with open(csv_target, "a") as csv_file:
         target = csv.writer(csv_file)
         if (write_header):
             target.writerow(header)
         for res in results:
             target.writerow(res)
 
+PGO_CSV = "profiler-data/pgo.csv"
+PGO_COUNTS = "pgo-counts.yaml"
+CODEGEN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "codeGen.py")
+FINISHED_RE = re.compile(r"Finished with count: (\d+) in (\d+)\.(\d+) sec")
+
+##
+# Run the program for t seconds (or until it exits) and capture its output.
+# @param t: how long to run the program.
+# @param args: The program arguments.
+# @return (output, wall seconds)
+def run_captured(t, args):
+    start = time.time()
+    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         universal_newlines=True)
+    try:
+        out, _ = p.communicate(timeout=t)
+    except subprocess.TimeoutExpired:
+        p.send_signal(signal.SIGINT)
+        out, _ = p.communicate()
+    return out, time.time() - start
+
+##
+# Throughput and mean per message latency of a run, from the
+# "Finished with count: X in Y sec" line printed by the profile modules.
+# Runs that do not print it fall back to wall time with no message count.
+# @return (messages/sec, ns/message), None for unknown values.
+def run_stats(output, wall):
+    match = FINISHED_RE.search(output)
+    if match is None:
+        return None, None
+    count = int(match.group(1))
+    secs = int(match.group(2)) + int(match.group(3)) / 10.0 ** len(match.group(3))
+    if count == 0 or secs == 0:
+        return None, None
+    return count / secs, secs * 1e9 / count
+
+def make(*targets):
+    logging.info("make %s" % (" ".join(targets)))
+    subprocess.check_call(["make"] + list(targets))
+
+##
+# Read the execution counts of the functions in the generated code file
+# from the gcov notes and data left behind by the instrumented run.
+# @param source: The generated C file (fcfmain.c).
+# @return A dict of function name => call count.
+def collect_counts(source):
+    out = subprocess.check_output(["gcov", "--json-format", "--stdout", source],
+                                  stderr=subprocess.DEVNULL, universal_newlines=True)
+    counts = {}
+    for line in out.splitlines():
+        if not line.strip():
+            continue
+        for f in json.loads(line)["files"]:
+            for func in f["functions"]:
+                counts[func["name"]] = func["execution_count"]
+    return counts
+
+def build_and_run(targets, miml, t, args):
+    make("clean-objects")
+    # The Makefile regenerates the code from MAINMIML when that is newer than its
+    # miml.mk, so it must name the MIML the code was just generated from.
+    make("MAINMIML=" + miml, *targets)
+    out, wall = run_captured(t, args)
+    rate, latency = run_stats(out, wall)
+    logging.info("%s: %s msgs/sec, %s ns/msg" % (targets[-1], fmt(rate), fmt(latency)))
+    return rate, latency
+
+def fmt(value):
+    if value is None:
+        return "n/a"
+    return "%.1f" % value
+
+def delta(new, old):
+    if new is None or old is None:
+        return "n/a"
+    return "%+.1f%%" % ((new - old) * 100.0 / old)
+
+##
+# Profile-guided optimization pipeline, see print_usage().
+def run_pgo(argv):
+    argparser = argparse.ArgumentParser(prog="runprog.py --pgo")
+    argparser.add_argument("--miml", default="Main.miml", help="Main MIML file of the workload")
+    argparser.add_argument("--counts", default=PGO_COUNTS, help="where to store the call counts")
+    argparser.add_argument("--code", default="fcfmain.c", help="generated C file")
+    argparser.add_argument("time", help="run time per build, HH:MM:SS")
+    argparser.add_argument("program", nargs=argparse.REMAINDER)
+    args = argparser.parse_args(argv)
+    t = arr_to_secs(args.time.split(":"))
+
+    # Plain OPTSLIVE build, regenerated without hot/cold marks.
+    subprocess.check_call([sys.executable, CODEGEN, "-c", "-b", args.miml])
+    base_rate, base_latency = build_and_run(["all"], args.miml, t, args.program)
+
+    # Instrumented build and training run.
+    make("pgo-clean")
+    build_and_run(["pgo-generate"], args.miml, t, args.program)
+    counts = collect_counts(args.code)
+    with open(args.counts, "w") as f:
+        for name in sorted(counts):
+            f.write("%s: %d\n" % (name, counts[name]))
+    logging.info("call counts written to %s" % (args.counts))
+
+    # Profile-guided build, with hot/cold marks from the training run.
+    subprocess.check_call([sys.executable, CODEGEN, "-c", "-b", "--counts", args.counts, args.miml])
+    pgo_rate, pgo_latency = build_and_run(["pgo-use"], args.miml, t, args.program)
+
+    print("\n%-12s %16s %16s" % ("build", "msgs/sec", "ns/msg"))
+    print("%-12s %16s %16s" % ("OPTSLIVE", fmt(base_rate), fmt(base_latency)))
+    print("%-12s %16s %16s" % ("PGO", fmt(pgo_rate), fmt(pgo_latency)))
+    print("%-12s %16s %16s\n" % ("delta", delta(pgo_rate, base_rate), delta(pgo_latency, base_latency)))
+
+    target_dir = os.path.dirname(PGO_CSV)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    write_header = not os.path.exists(PGO_CSV)
+    with open(PGO_CSV, "a") as csv_file:
+        target = csv.writer(csv_file)
+        if write_header:
+            target.writerow(["Date", "Program", "Workload", "Time run",
+                             "Msgs/sec (OPTSLIVE)", "Msgs/sec (PGO)", "Throughput delta",
+                             "ns/msg (OPTSLIVE)", "ns/msg (PGO)", "Latency delta"])
+        target.writerow([time.strftime("%Y-%m-%d %H:%M:%S"), " ".join(args.program), args.miml, t,
+                         base_rate, pgo_rate, delta(pgo_rate, base_rate),
+                         base_latency, pgo_latency, delta(pgo_latency, base_latency)])
+    return 0
+
+SOAK_SERIES = "profiler-data/soak.csv"
+TELEMETRY_PORT = 5005
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+# Lines of /proc/<pid>/status and /proc/<pid>/io that go into a sample.
+STATUS_FIELDS = {"VmRSS": "rss_kb", "VmData": "data_kb", "Threads": "threads",
+                 "voluntary_ctxt_switches": "voluntary_ctxt", "nonvoluntary_ctxt_switches": "nonvoluntary_ctxt"}
+IO_FIELDS = ["rchar", "wchar", "syscr", "syscw"]
+SOAK_FIELDS = (list(STATUS_FIELDS.values()) + ["fds", "utime", "stime", "run_ns", "wait_ns"] +
+               IO_FIELDS + ["messages"])
+# A trend is flagged when its fitted growth over the soak exceeds its limit:
+# relative for RSS, rates and CPU time, in descriptors for the fd count. Rates
+# too low to matter (an idle process's context switches or CPU %) are not flagged.
+TREND_LIMITS = {"rss": 0.05, "fds": 1, "ctxt": 0.2, "cpu": 0.1}
+
+##
+# One sample of a process from /proc: memory, threads and context switches
+# from status, CPU ticks from stat, run and wait time summed over the
+# threads' schedstat, the I/O counters and the number of open descriptors.
+# Fields the kernel does not provide (e.g. io of another user) are left out.
+# @return A dict of SOAK_FIELDS, None when the process is gone.
+def read_proc(pid):
+    base = "/proc/%d/" % pid
+    sample = {}
+    try:
+        with open(base + "status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in STATUS_FIELDS:
+                    sample[STATUS_FIELDS[key]] = int(value.split()[0])
+        with open(base + "stat") as f:
+            # Fields after the command name, which may contain spaces.
+            fields = f.read().rsplit(")", 1)[1].split()
+        sample["utime"], sample["stime"] = int(fields[11]), int(fields[12])
+        sample["fds"] = len(os.listdir(base + "fd"))
+    except (OSError, IndexError, ValueError):
+        return None
+    try:
+        with open(base + "io") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in IO_FIELDS:
+                    sample[key] = int(value)
+    except OSError:
+        pass
+    run = wait = 0
+    try:
+        tasks = os.listdir(base + "task")
+    except OSError:
+        tasks = []
+    for task in tasks:
+        try:
+            with open(base + "task/" + task + "/schedstat") as f:
+                fields = f.read().split()
+            run += int(fields[0])
+            wait += int(fields[1])
+        except (OSError, IndexError, ValueError):
+            continue   # a thread that just exited
+    if tasks:
+        sample["run_ns"], sample["wait_ns"] = run, wait
+    return sample
+
+##
+# Records in a telemetry bucket: a sequence number, then 12 byte record
+# headers whose length field gives the size of the payload that follows.
+def count_records(bucket):
+    count, pos = 0, 4
+    while pos + 12 <= len(bucket):
+        pos += 12 + ((bucket[pos + 4] << 8) | bucket[pos + 5])
+        count += 1
+    return count
+
+##
+# Samples a child at a fixed interval while it runs. With a telemetry port,
+# the records of its log buckets are counted as well, for the CPU time per
+# message; without one, the trend is taken over CPU time per second.
+class SoakMonitor:
+    def __init__(self, interval, port=None):
+        self.interval = interval
+        self.samples = []
+        self.messages = 0
+        self.sock = None
+        if port is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+            self.sock.bind(("127.0.0.1", port))
+            self.sock.setblocking(False)
+
+    def drain(self):
+        while True:
+            try:
+                bucket = self.sock.recv(65536)
+            except BlockingIOError:
+                return
+            self.messages += count_records(bucket)
+
+    ##
+    # Sample the child every interval for t seconds.
+    # @return False if the child exited (and was reaped) before that.
+    def watch(self, pid, t):
+        self.samples = []
+        start = time.monotonic()
+        due = start
+        while True:
+            now = time.monotonic()
+            if now >= due:
+                sample = read_proc(pid)
+                if sample is not None:
+                    if self.sock is not None:
+                        self.drain()
+                        sample["messages"] = self.messages
+                    sample["elapsed"] = now - start
+                    self.samples.append(sample)
+                due += self.interval
+            if now - start >= t:
+                return True
+            if os.waitpid(pid, os.WNOHANG) != (0, 0):
+                return False
+            timeout = max(0.0, min(due, start + t) - time.monotonic())
+            if self.sock is not None:
+                if select.select([self.sock], [], [], timeout)[0]:
+                    self.drain()
+            else:
+                time.sleep(timeout)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+##
+# Least squares line through (x, y).
+# @return (value at the first x, value at the last x)
+def fit(xs, ys):
+    n = len(xs)
+    mx, my = sum(xs) / n, sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    slope = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx if sxx else 0.0
+    return my + slope * (xs[0] - mx), my + slope * (xs[-1] - mx)
+
+##
+# Per second rates of a counter between consecutive samples, or of a ratio
+# of two counters (e.g. CPU ticks per message).
+# @return (sample times, rates)
+def rates(samples, numerator, denominator=None):
+    xs, ys = [], []
+    for old, new in zip(samples, samples[1:]):
+        if any(key not in old or key not in new for key in numerator + (denominator or [])):
+            continue
+        num = sum(new[key] - old[key] for key in numerator)
+        den = (sum(new[key] - old[key] for key in denominator) if denominator
+               else new["elapsed"] - old["elapsed"])
+        if den > 0:
+            xs.append(new["elapsed"])
+            ys.append(num / den)
+    return xs, ys
+
+##
+# Fitted trends of a soak, after the warmup.
+# @return A list of (metric, start, end, change, flagged); change is relative
+#         but in descriptors for the fd count.
+def soak_trends(samples, warmup):
+    samples = [s for s in samples if s["elapsed"] >= warmup]
+    series = []
+    for key, name in (("rss_kb", "RSS [kB]"), ("fds", "open fds")):
+        points = [(s["elapsed"], s[key]) for s in samples if key in s]
+        series.append((name, "rss" if key == "rss_kb" else "fds", 0, [p[0] for p in points], [p[1] for p in points]))
+    xs, ys = rates(samples, ["voluntary_ctxt", "nonvoluntary_ctxt"])
+    series.append(("context switches/s", "ctxt", 10, xs, ys))
+    if any(s.get("messages") for s in samples):
+        xs, ys = rates(samples, ["utime", "stime"], ["messages"])
+        series.append(("CPU us/message", "cpu", 0, xs, [1e6 * y / CLK_TCK for y in ys]))
+    else:
+        xs, ys = rates(samples, ["utime", "stime"])
+        series.append(("CPU %", "cpu", 1, xs, [100.0 * y / CLK_TCK for y in ys]))
+
+    trends = []
+    for name, kind, floor, xs, ys in series:
+        if len(xs) < 3:
+            continue
+        start, end = fit(xs, ys)
+        if kind == "fds":
+            change = end - start
+            flagged = change >= TREND_LIMITS[kind]
+        else:
+            mean = sum(ys) / len(ys)
+            change = (end - start) / mean if mean else 0.0
+            flagged = change > TREND_LIMITS[kind] and mean >= floor
+        trends.append((name, start, end, change, flagged))
+    return trends
+
+def print_trends(trends, t, warmup):
+    print("\nsoak trends over %d s, after %d s of warmup" % (t, warmup))
+    print("%-22s %14s %14s %10s" % ("metric", "start", "end", "change"))
+    for name, start, end, change, flagged in trends:
+        shown = "%+.0f" % change if name == "open fds" else "%+.1f%%" % (100 * change)
+        print("%-22s %14.1f %14.1f %10s%s" % (name, start, end, shown, "  TREND" if flagged else ""))
+        if flagged:
+            logging.warning("%s drifts from %.1f to %.1f over the soak" % (name, start, end))
+    print("")
+
+##
+# Append the samples of one run to the soak series, next to the profile.
+def dump_series(samples, series, started, t):
+    target_dir = os.path.dirname(series)
+    if target_dir and not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    write_header = not os.path.exists(series)
+    with open(series, "a") as csv_file:
+        target = csv.writer(csv_file)
+        if write_header:
+            target.writerow(["Start", "Time run", "Elapsed"] + SOAK_FIELDS)
+        for sample in samples:
+            target.writerow([started, t, "%.3f" % sample["elapsed"]] + [sample.get(key, "") for key in SOAK_FIELDS])
+
+##
+# Soak runs, see print_usage().
+def run_soak(argv):
+    argparser = argparse.ArgumentParser(prog="runprog.py --soak")
+    argparser.add_argument("--interval", type=float, default=10, help="seconds between samples")
+    argparser.add_argument("--warmup", type=float, help="seconds left out of the trends (default: a tenth of the run)")
+    argparser.add_argument("--series", default=SOAK_SERIES, help="CSV file the samples are appended to")
+    argparser.add_argument("--telemetry", action="store_true",
+                           help="count the records of the child's log buckets, for the CPU time per message")
+    argparser.add_argument("--port", type=int, default=TELEMETRY_PORT, help="UDP port of the log buckets")
+    argparser.add_argument("time", help="run times, HH:MM:SS[,HH:MM:SS...]")
+    argparser.add_argument("program", nargs=argparse.REMAINDER)
+    args = argparser.parse_args(argv)
+    if not args.program:
+        argparser.error("no program to run")
+
+    monitor = SoakMonitor(args.interval, args.port if args.telemetry else None)
+    try:
+        for loop, t in enumerate(arr_to_secs(tm.split(":")) for tm in args.time.split(",")):
+            print_test_header(t, loop + 1)
+            started = time.strftime("%Y-%m-%d %H:%M:%S")
+            if os.path.exists("gmon.out"):
+                os.remove("gmon.out")
+            run_for_time(t, args.program, monitor)
+            if os.path.exists("gmon.out"):
+                gout = parse_output_file("gmon.out", args.program)
+                gout.time_run = t
+                dump_to_csv_file(gout.as_list(), headerlabels)
+            dump_series(monitor.samples, args.series, started, t)
+            logging.info("%d samples appended to %s" % (len(monitor.samples), args.series))
+            warmup = args.warmup if args.warmup is not None else t / 10.0
+            print_trends(soak_trends(monitor.samples, warmup), t, warmup)
+    finally:
+        monitor.close()
+    return 0
+
 def main():
 
+    # Profile-guided build mode
+    if len(sys.argv) > 1 and sys.argv[1] == "--pgo":
+        sys.exit(run_pgo(sys.argv[2:]))
+
+    # Soak mode
+    if len(sys.argv) > 1 and sys.argv[1] == "--soak":
+        sys.exit(run_soak(sys.argv[2:]))
+
+
     # Check that the user has valid arguments.
     if (len(sys.argv) < 3):
         logging.error("Invalid usage.")
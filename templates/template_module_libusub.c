@@ -46,10 +46,9 @@ static const int EPT = 0x81;	//< CHANGE IF NEEDED (Default)
 
 /**	START FUNCTIONS */
 
-static void data_callback(struct libusb_transfer *transfer){
+static void data_callback(struct libusb_transfer *transfer, void *data){
 	unsigned char *buf = NULL;
     int act_len;
-    int retErr;
 
 	switch(transfer->status){
     
@@ -57,10 +56,7 @@ static void data_callback(struct libusb_transfer *transfer){
 
 			buf = transfer->buffer;
 			act_len = transfer->actual_length;
-			retErr = libusb_submit_transfer(transfer);
-			if(retErr){
-				//print_libusb_transfer_error(transfer->status, "common_cb resub");
-			}
+			// the pool resubmits the transfer when this returns
 
 			/**
 			*	Data handler:
@@ -70,10 +66,6 @@ static void data_callback(struct libusb_transfer *transfer){
 
 			break;
 		
-		case LIBUSB_TRANSFER_CANCELLED:
-			printf("transfer cancelled\n");
-			break;
-		
 		default:
 			printf("data_callback() error\n");
 			break;
@@ -89,13 +81,14 @@ void init_###DEVTAG###() {
 	libusb_set_debug(context, 3);
 	handle = open_device("###DEVTAG###", VID, PID);
 	if (handle != NULL) {
-		transfer = start_usb_interrupt_transfer(handle, EPT, data_callback, NULL, -1, 0);
+		// transfers in flight: FCF_USB_DEPTH, or the token's usb_depth in the master MIML file
+		pool = start_usb_transfers(handle, EPT, LIBUSB_TRANSFER_TYPE_INTERRUPT, data_callback, NULL, -1, 0);
 	}
 }
 
 void finalize_###DEVTAG###() {
-	cancel_transfer(transfer);
+	stop_usb_transfers("###DEVTAG###", pool);
 	close_device(handle);
 	handle = NULL;
-	transfer = NULL;
+	pool = NULL;
 }
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# tracereader.py -- reads message traces of trace builds (codeGen.py --trace).
+#
+# fc writes the events of its threads to fcftrace.bin (or $FCF_TRACE) when it
+# exits, see examples/utils/utils_trace.h. The file is a 32 byte header
+#
+#     magic "FCFTRACE" | version (<u4) | event size (<u4) | events (<u8) | overwritten (<u8)
+#
+# followed by the events, thread by thread, oldest first:
+#
+#     timestamp (<u8, ns, CLOCK_MONOTONIC) | message (<u2) | receiver (<u2) | thread (<u2) | type (<u2)
+#
+# SEND and SENT events enclose the fan-out of a message, RECV and DONE the
+# call of one receiver; fcftrace.yaml, also written by codeGen.py, names the
+# message and receiver ids. Fan-outs nest when a receiver sends, so every
+# receiver call lies in a chain started by an outermost SEND: the chain's
+# origin, for example the completion of a USB transfer.
+#
+# The converter writes Chrome trace JSON, for chrome://tracing or
+# ui.perfetto.dev, and prints latency percentiles per receiver: how long the
+# call took, and how long after the chain's origin it began.
+#
+# Usage:
+#     tracereader.py fcftrace.bin --ids fcftrace.yaml [--chrome trace.json] [--save latencies.npz]
+
+import argparse
+import json
+import sys
+
+import numpy as np
+import yaml
+
+MAGIC = b'FCFTRACE'
+VERSION = 1
+HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('event_size', '<u4'), ('events', '<u8'), ('overwritten', '<u8')])
+EVENT = np.dtype([('ns', '<u8'), ('message', '<u2'), ('receiver', '<u2'), ('thread', '<u2'), ('type', '<u2')])
+SEND, SENT, RECV, DONE = range(4)
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class TraceError(Exception):
+    pass
+
+
+##
+# Events of a trace file.
+# @return (events as an EVENT array, number of events the rings overwrote)
+def read_trace(path):
+    data = np.fromfile(path, dtype=np.uint8)
+    if len(data) < HEADER.itemsize:
+        raise TraceError("%s: too short for a trace" % path)
+    header = data[:HEADER.itemsize].view(HEADER)[0]
+    if header['magic'] != MAGIC:
+        raise TraceError("%s: not a trace" % path)
+    if header['version'] != VERSION or header['event_size'] != EVENT.itemsize:
+        raise TraceError("%s: trace version %d with %d byte events, expected %d with %d" %
+                         (path, header['version'], header['event_size'], VERSION, EVENT.itemsize))
+    body = data[HEADER.itemsize:]
+    count = min(int(header['events']), len(body) // EVENT.itemsize)
+    return body[:count * EVENT.itemsize].view(EVENT), int(header['overwritten'])
+
+
+##
+# Names of the message and receiver ids, from fcftrace.yaml.
+# @return (message names, receiver names) as lists indexed by id
+def read_ids(path):
+    ids = yaml.safe_load(open(path, 'r')) or {}
+    messages = ids.get('messages') or []
+    receivers = [entry['receiver'] for entry in ids.get('receivers') or []]
+    return messages, receivers
+
+
+##
+# Start of the chain of every event: the timestamp of the outermost SEND it
+# lies in, NaN for events the trace has no outermost SEND for (the rings
+# overwrote it). Events of a thread are contiguous and in order.
+def chain_origins(events):
+    n = len(events)
+    if n == 0:
+        return np.empty(0)
+    step = np.zeros(n, dtype=np.int64)
+    step[events['type'] == SEND] = 1
+    step[events['type'] == SENT] = -1
+    # Nesting depth before each event, per thread.
+    starts = np.flatnonzero(np.r_[True, events['thread'][1:] != events['thread'][:-1]])
+    depth = np.cumsum(step) - step
+    thread_start = np.repeat(starts, np.diff(np.r_[starts, n]))
+    depth -= depth[thread_start]
+    # A trace that starts inside a chain climbs out of it below the first depth.
+    baseline = np.repeat(np.minimum.reduceat(depth, starts), np.diff(np.r_[starts, n]))
+    roots = (events['type'] == SEND) & (depth == baseline)
+    last_root = np.maximum.accumulate(np.where(roots, np.arange(n), -1))
+    origins = np.full(n, np.nan)
+    valid = last_root >= thread_start
+    origins[valid] = events['ns'][last_root[valid]]
+    return origins
+
+
+##
+# Receiver calls: the RECV event of each, paired with the DONE that follows it
+# on the same thread. A receiver that recurses into itself is counted once.
+# @return (RECV indexes into events, call durations in ns)
+def receiver_calls(events):
+    calls = np.flatnonzero((events['type'] == RECV) | (events['type'] == DONE))
+    order = np.lexsort((calls, events['receiver'][calls], events['thread'][calls]))
+    calls = calls[order]
+    first, second = calls[:-1], calls[1:]
+    paired = ((events['type'][first] == RECV) & (events['type'][second] == DONE) &
+              (events['receiver'][first] == events['receiver'][second]) &
+              (events['thread'][first] == events['thread'][second]))
+    first, second = first[paired], second[paired]
+    return first, (events['ns'][second] - events['ns'][first]).astype(np.int64)
+
+
+##
+# Latency percentiles of every receiver.
+# @return A dict of receiver id => {'calls', 'duration', 'from_origin'}, the
+#         latter two arrays of PERCENTILES then the maximum, in ns
+def latencies(events):
+    origins = chain_origins(events)
+    recv, durations = receiver_calls(events)
+    from_origin = events['ns'][recv] - origins[recv]
+    stats = {}
+    receivers = events['receiver'][recv]
+    for receiver in np.unique(receivers):
+        mine = receivers == receiver
+        waits = from_origin[mine]
+        waits = waits[~np.isnan(waits)]
+        stats[int(receiver)] = {
+            'calls': int(mine.sum()),
+            'duration': np.r_[np.percentile(durations[mine], PERCENTILES), durations[mine].max()],
+            'from_origin': (np.r_[np.percentile(waits, PERCENTILES), waits.max()] if len(waits)
+                            else np.full(len(PERCENTILES) + 1, np.nan)),
+        }
+    return stats
+
+
+##
+# The trace as a Chrome trace event document: a slice per fan-out and one per
+# receiver call, nested as they ran, on a track per thread.
+def chrome_trace(events, messages, receivers):
+    def name(names, i):
+        return names[i] if i < len(names) else str(i)
+
+    if len(events) == 0:
+        return {'traceEvents': []}
+    start = int(events['ns'].min())
+    timestamps = ((events['ns'] - start) / 1e3).tolist()
+    trace = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': int(thread), 'args': {'name': 'fc thread %d' % thread}}
+             for thread in np.unique(events['thread'])]
+    for ts, message, receiver, thread, kind in zip(timestamps, events['message'].tolist(), events['receiver'].tolist(),
+                                                  events['thread'].tolist(), events['type'].tolist()):
+        if kind in (SEND, SENT):
+            trace.append({'name': name(messages, message), 'cat': 'message', 'ph': 'B' if kind == SEND else 'E',
+                          'ts': ts, 'pid': 1, 'tid': thread})
+        else:
+            trace.append({'name': name(receivers, receiver), 'cat': 'receiver', 'ph': 'B' if kind == RECV else 'E',
+                          'ts': ts, 'pid': 1, 'tid': thread, 'args': {'message': name(messages, message)}})
+    return {'traceEvents': trace, 'displayTimeUnit': 'ns'}
+
+
+def summary(stats, receivers):
+    columns = ' '.join('%9s' % ('p%g' % p) for p in PERCENTILES) + ' %9s' % 'max'
+    print("\nreceiver call duration [us]")
+    print("%-40s %9s %s" % ('receiver', 'calls', columns))
+    for receiver, entry in sorted(stats.items()):
+        name = receivers[receiver] if receiver < len(receivers) else str(receiver)
+        print("%-40s %9d %s" % (name, entry['calls'], ' '.join('%9.3f' % (v / 1e3) for v in entry['duration'])))
+    print("\nreceiver call after the origin of its chain [us]")
+    print("%-40s %9s %s" % ('receiver', 'calls', columns))
+    for receiver, entry in sorted(stats.items()):
+        name = receivers[receiver] if receiver < len(receivers) else str(receiver)
+        print("%-40s %9d %s" % (name, entry['calls'], ' '.join('%9.3f' % (v / 1e3) for v in entry['from_origin'])))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Read message traces of trace builds.')
+    argparser.add_argument('trace', help='trace file written by fc (fcftrace.bin)')
+    argparser.add_argument('--ids', default='fcftrace.yaml', help='message and receiver ids written by codeGen.py')
+    argparser.add_argument('--chrome', help='write Chrome trace JSON to this file')
+    argparser.add_argument('--save', help='save the latency percentiles to this .npz file')
+    args = argparser.parse_args()
+
+    try:
+        events, overwritten = read_trace(args.trace)
+        messages, receivers = read_ids(args.ids)
+    except (TraceError, IOError, OSError) as err:
+        sys.stderr.write("%s\n" % err)
+        sys.exit(-1)
+    threads = len(np.unique(events['thread']))
+    print("%d events of %d threads, %d older ones overwritten" % (len(events), threads, overwritten))
+    stats = latencies(events)
+    summary(stats, receivers)
+    if args.chrome:
+        with open(args.chrome, 'w') as f:
+            json.dump(chrome_trace(events, messages, receivers), f)
+    if args.save:
+        np.savez(args.save, percentiles=np.array(PERCENTILES),
+                 **dict(('%s.%s' % (receivers[r] if r < len(receivers) else r, key), entry[key])
+                        for r, entry in stats.items() for key in ('duration', 'from_origin')))
+
+
+if __name__ == '__main__':
+    main()